@@ -0,0 +1,105 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+DESCRIPTION = """
+Compare cold load time and peak RSS of the geojson cache against the binary
+snapshot.
+
+Each load runs in a fresh interpreter so neither path benefits from the
+other's imports or allocations.
+
+    python -m benchmarks.snapshot --servers 1000 10000 100000
+"""
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_LOADERS = {
+    'json': "model.GeoJson(None, {cache!r}).servers",
+    'snapshot': "snapshot.load({snapshot!r})",
+}
+
+# ru_maxrss survives exec so would report the parent's peak; VmHWM is reset.
+_CHILD = """
+import time
+start = time.perf_counter()
+from vanish import model, snapshot
+servers = {loader}
+seconds = time.perf_counter() - start
+with open('/proc/self/status') as h:
+    rss = [l.split()[1] for l in h if l.startswith('VmHWM')][0]
+print(seconds, rss)
+"""
+
+
+def _write(directory, count):
+    from vanish import model, snapshot
+    from vanish.test.support import synthetic_features
+
+    servers = [model.Server.fromFeature(f)
+               for f in synthetic_features(count)]
+
+    cache = os.path.join(directory, 'servers.geojson')
+    path = os.path.join(directory, 'servers.snapshot')
+
+    with open(cache, 'w') as h:
+        json.dump([s.toDict() for s in servers], h, indent=4)
+
+    snapshot.dump(servers, path)
+
+    return cache, path
+
+
+def _measure(loader, cache, path):
+    """Run a loader in a child interpreter.
+
+    :return: A tuple of (seconds, peak rss in KiB).
+    """
+    code = _CHILD.format(loader=_LOADERS[loader].format(
+        cache=cache, snapshot=path))
+
+    seconds, rss = subprocess.check_output(
+        [sys.executable, '-c', code], cwd=_ROOT).split()
+
+    return float(seconds), int(rss)
+
+
+def run(counts, repeat):
+    results = []
+    directory = tempfile.mkdtemp()
+
+    try:
+        for count in counts:
+            cache, path = _write(directory, count)
+
+            for loader in sorted(_LOADERS):
+                timings, rss = zip(*(
+                    _measure(loader, cache, path) for _ in range(repeat)))
+
+                results.append({
+                    'servers': count,
+                    'loader': loader,
+                    'seconds': min(timings),
+                    'peak_rss_kib': min(rss),
+                    'bytes': os.path.getsize(
+                        cache if loader == 'json' else path)
+                })
+    finally:
+        shutil.rmtree(directory)
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=DESCRIPTION,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--servers', type=int, nargs='+', default=[1000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    json.dump(run(args.servers, args.repeat), sys.stdout, indent=4)
+    print()
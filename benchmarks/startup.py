@@ -0,0 +1,113 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+DESCRIPTION = """
+Measure how long the vanish CLI takes to start.
+
+Runs commands that don't touch the network in fresh interpreters and reports
+the wall time along with the cumulative import time of vanish.application
+from python -X importtime. Exits non-zero if the median wall time of any
+command exceeds --budget milliseconds or if a command imports a module that
+should only be loaded on demand.
+
+    python -m benchmarks.startup --budget 60
+"""
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+COMMANDS = [
+    ['version'],
+    ['--help'],
+]
+
+"""
+Modules that are slow to import and must not be loaded by COMMANDS.
+"""
+HEAVY = ['requests', 'tabulate', 'zipfile', 'subprocess', 'tempfile',
+         'vanish.probe']
+
+# Modules loaded before vanish is imported, e.g. by site, are reported too so
+# they aren't blamed on vanish.
+_CHILD = """
+import sys
+sys.stderr.write('baseline ' + ' '.join(sys.modules) + '\\n')
+from vanish.application import Vanish
+try:
+    Vanish().run({args!r})
+except SystemExit:
+    pass
+sys.stderr.write('loaded ' + ' '.join(sys.modules) + '\\n')
+"""
+
+
+def _run(args):
+    """Run the CLI with args in a fresh interpreter.
+
+    :return: A tuple of (wall seconds, import microseconds, heavy modules).
+    """
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', _CHILD.format(args=args)],
+        cwd=_ROOT,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        check=True,
+        universal_newlines=True)
+    seconds = time.perf_counter() - start
+
+    imports = 0
+    modules = {}
+
+    for line in result.stderr.splitlines():
+        if line.startswith('import time:'):
+            _, cumulative, name = line[len('import time:'):].split('|')
+
+            if name.strip() == 'vanish.application':
+                imports = int(cumulative)
+        elif line.startswith(('baseline ', 'loaded ')):
+            kind, _, names = line.partition(' ')
+            modules[kind] = set(names.split())
+
+    loaded = modules['loaded'] - modules['baseline']
+
+    return seconds, imports, [m for m in HEAVY if m in loaded]
+
+
+def run(repeat):
+    results = []
+
+    for args in COMMANDS:
+        samples = sorted(_run(args) for _ in range(repeat))
+        seconds, imports, heavy = samples[len(samples) // 2]
+
+        results.append({
+            'command': ' '.join(args),
+            'wall_ms': round(seconds * 1000, 2),
+            'import_ms': round(imports / 1000, 2),
+            'heavy_imports': heavy
+        })
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=DESCRIPTION,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--budget', type=float, default=None,
+                        help="maximum median wall time in ms")
+    args = parser.parse_args()
+
+    results = run(args.repeat)
+    json.dump(results, sys.stdout, indent=4)
+    print()
+
+    failed = [r for r in results if r['heavy_imports']
+              or (args.budget and r['wall_ms'] > args.budget)]
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,326 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from vanish import model
+from vanish.application import Vanish
+from vanish.config import config
+from vanish.history import Score
+from vanish.probe import SubprocessProber
+from vanish.scoring import FACTORS, Scorer, _numpy
+from vanish.test.support import (FAKE_OPENVPN, FAKE_PING, LocalServer,
+                                 fake_executable, prepend_path,
+                                 synthetic_configs, synthetic_features,
+                                 synthetic_zip)
+DESCRIPTION = """
+Time the main vanish code paths against synthetic server catalogues.
+
+IPVanish is replaced by a local HTTP server serving a synthetic geojson and
+configs.zip of each size, and ping and openvpn by fake executables on PATH,
+so results only depend on vanish and the machine.
+
+    python -m benchmarks.suite --servers 1000 10000 100000 > results.json
+
+Results are written as JSON. Pass a previous run with --baseline to compare
+against it; the suite exits non-zero if any benchmark got slower by more
+than --tolerance.
+
+    python -m benchmarks.suite --baseline results.json --tolerance 0.25
+"""
+
+"""
+ServerContainer queries timed, as (name, method, keyword arguments).
+"""
+QUERIES = [
+    ('servers', 'getServers', {}),
+    ('servers.country', 'getServers', {'countries': ['de']}),
+    ('servers.filters', 'getServers',
+     {'continents': ['Europe', 'NA'], 'countries': ['gb', 'us'],
+      'cities': ['London', 'New York']}),
+    ('nearest', 'getNearest',
+     {'latitude': 51.5, 'longitude': -0.1, 'count': 20}),
+    ('nearest.country', 'getNearest',
+     {'latitude': 51.5, 'longitude': -0.1, 'count': 20,
+      'countries': ['us']}),
+    ('continents', 'getContinents', {}),
+    ('countries', 'getCountries', {'continents': ['eu']}),
+    ('regions', 'getRegions', {'countries': ['us']}),
+    ('cities', 'getCities', {'continents': ['Europe']}),
+]
+
+
+class _Environment(object):
+    def __init__(self, count):
+        """A catalogue of count servers with local stand-ins for the network.
+
+        Each benchmark gets a fresh config directory under the environment so
+        caches from one don't leak into another.
+
+        :param count: The number of servers in the catalogue.
+        """
+        self.count = count
+        self.features = synthetic_features(count)
+        self._files = {
+            '/servers.geojson': json.dumps(self.features).encode('utf-8'),
+            '/configs.zip': synthetic_zip(synthetic_configs(self.features))
+        }
+        self._stack = contextlib.ExitStack()
+        self.directory = None
+
+    def __enter__(self):
+        self.directory = tempfile.mkdtemp(prefix='vanish-bench-')
+        self._stack.callback(shutil.rmtree, self.directory)
+
+        executables = os.path.join(self.directory, 'bin')
+        os.mkdir(executables)
+        fake_executable(executables, 'ping', FAKE_PING)
+        fake_executable(executables, 'openvpn', FAKE_OPENVPN)
+
+        self._stack.enter_context(prepend_path(executables))
+        self.server = self._stack.enter_context(LocalServer(self._files))
+        self._stack.callback(config.update, dict(config))
+
+        return self
+
+    def __exit__(self, *args):
+        self._stack.close()
+
+    def configure(self):
+        """Point the config at a fresh directory and the local server."""
+        directory = tempfile.mkdtemp(dir=self.directory)
+        configs = os.path.join(directory, 'openvpn')
+
+        config.update({
+            'config.dir': directory,
+            'geojson.url': self.server.url('/servers.geojson'),
+            'geojson.cache.path': os.path.join(directory, 'servers.geojson'),
+            'geojson.snapshot.path': os.path.join(
+                directory, 'servers.snapshot'),
+            'geojson.cache.timeout': 3600,
+            'completion.index.path': os.path.join(
+                directory, 'servers.completion'),
+            'ovpn.configs.url': self.server.url('/configs.zip'),
+            'ovpn.configs.path': configs,
+            'ovpn.cert': os.path.join(configs, 'ca.ipvanish.com.crt'),
+            'history.path': os.path.join(directory, 'history.sqlite3'),
+            'daemon.socket': os.path.join(directory, 'daemon.sock'),
+            'ping.backend': 'subprocess',
+            'ping.count': 1,
+            'ping.timeout': 5,
+        })
+
+        return directory
+
+
+def _time(function, repeat, setup=None, number=1):
+    """Time function repeat times.
+
+    Anything printed is discarded so it doesn't end up in the results.
+
+    :param setup: Called before each run, untimed. Its result is passed to
+        function.
+    :param number: Calls to function per run, for functions too quick to
+        time once.
+    :return: A list of seconds per call.
+    """
+    timings = []
+
+    with open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        for _ in range(repeat):
+            argument = setup() if setup else None
+            start = time.perf_counter()
+
+            for _ in range(number):
+                function(argument)
+
+            timings.append((time.perf_counter() - start) / number)
+
+    return timings
+
+
+def _geojson():
+    return model.GeoJson(
+        config['geojson.url'],
+        config['geojson.cache.path'],
+        config['geojson.cache.timeout'],
+        config['geojson.snapshot.path'])
+
+
+def _ovpnconfigs():
+    return model.OvpnConfigs(
+        config['ovpn.configs.url'], config['ovpn.configs.path'])
+
+
+def bench_geojson(env, repeat):
+    yield 'geojson.download', _time(
+        lambda _: _geojson().update(), repeat, env.configure)
+
+    env.configure()
+    _geojson().update()
+    yield 'geojson.revalidate', _time(
+        lambda _: _geojson().update(force=True), repeat)
+    yield 'geojson.load', _time(lambda _: _geojson().servers, repeat)
+
+
+def bench_ovpnconfigs(env, repeat):
+    yield 'ovpnconfigs.sync', _time(
+        lambda _: _ovpnconfigs().update(), repeat, env.configure)
+
+    env.configure()
+    _ovpnconfigs().update()
+    yield 'ovpnconfigs.resync', _time(
+        lambda _: _ovpnconfigs().update(), repeat)
+
+
+def bench_servercontainer(env, repeat):
+    env.configure()
+    geojson = _geojson()
+    geojson.update()
+
+    yield 'servercontainer.index', _time(
+        lambda _: model.ServerContainer(geojson), repeat)
+
+    container = model.ServerContainer(geojson)
+
+    for name, method, filters in QUERIES:
+        query = getattr(container, method)
+        yield 'servercontainer.' + name, _time(
+            lambda _: query(**filters), repeat, number=100)
+
+
+def bench_ping(env, repeat, fanout):
+    env.configure()
+    servers = _geojson().servers[:fanout]
+    prober = SubprocessProber(timeout=5, concurrency=64)
+
+    yield 'ping.fanout', _time(
+        lambda _: model.Vanish.ping(servers, prober), repeat)
+
+
+def bench_scoring(env, repeat):
+    """Rank the whole catalogue on every factor with each backend."""
+    env.configure()
+    servers = _geojson().servers
+    latency = {s.hostname: Score(s.hostname, 20.0, 2.0, 0.0, 0, 1)
+               for s in servers[::2]}
+    distances = [float(i % 5000) for i in range(len(servers))]
+    weights = dict.fromkeys(FACTORS, 1.0)
+
+    for backend in ('python', 'numpy'):
+        if backend == 'numpy' and _numpy() is None:
+            continue
+
+        scorer = Scorer(weights, backend)
+        yield 'scoring.rank.' + backend, _time(
+            lambda _: scorer.rank(servers, latency, distances, k=20), repeat)
+
+
+def bench_connect(env, repeat):
+    """Select a server and run a fake openvpn, cold and from history."""
+    def prepare():
+        env.configure()
+        app = Vanish()
+        app.run(['sync'])
+        return app
+
+    args = ['connect', '--country', 'de']
+
+    yield 'connect.cold', _time(lambda app: app.run(args), repeat, prepare)
+
+    def warm():
+        app = prepare()
+        app.run(args)
+        return app
+
+    yield 'connect.warm', _time(lambda app: app.run(args), repeat, warm)
+
+
+def run(counts, repeat, fanout):
+    results = []
+
+    for count in counts:
+        with _Environment(count) as env:
+            benchmarks = [
+                bench_geojson(env, repeat),
+                bench_ovpnconfigs(env, repeat),
+                bench_servercontainer(env, repeat),
+                bench_ping(env, repeat, min(fanout, count)),
+                bench_scoring(env, repeat),
+                bench_connect(env, repeat),
+            ]
+
+            for benchmark in benchmarks:
+                for name, timings in benchmark:
+                    results.append({
+                        'benchmark': name,
+                        'servers': count,
+                        'seconds': min(timings),
+                        'median': statistics.median(timings),
+                        'repeat': len(timings)
+                    })
+                    print("{:>7} {:<32} {:.6f}s".format(
+                        count, name, min(timings)), file=sys.stderr)
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Find benchmarks slower than the baseline by more than tolerance.
+
+    :return: A list of (benchmark, servers, baseline, seconds).
+    """
+    previous = {(r['benchmark'], r['servers']): r['seconds']
+                for r in baseline['results']}
+    regressions = []
+
+    for result in results:
+        key = (result['benchmark'], result['servers'])
+
+        if key in previous and \
+                result['seconds'] > previous[key] * (1 + tolerance):
+            regressions.append(key + (previous[key], result['seconds']))
+
+    return regressions
+
+
+if __name__ == "__main__":
+    from vanish.__version__ import VERSION
+
+    parser = argparse.ArgumentParser(
+        description=DESCRIPTION,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--servers', type=int, nargs='+', default=[1000])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--fanout', type=int, default=100,
+                        help="the most servers pinged at once")
+    parser.add_argument('--baseline', help="results of a previous run")
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+
+    results = run(args.servers, args.repeat, args.fanout)
+
+    json.dump({
+        'version': VERSION,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'time': time.time(),
+        'results': results
+    }, sys.stdout, indent=4)
+    print()
+
+    if args.baseline:
+        with open(args.baseline) as h:
+            regressions = compare(results, json.load(h), args.tolerance)
+
+        for benchmark, servers, before, after in regressions:
+            print("{} with {} servers regressed: {:.6f}s -> {:.6f}s".format(
+                benchmark, servers, before, after), file=sys.stderr)
+
+        sys.exit(1 if regressions else 0)
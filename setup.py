@@ -47,5 +47,9 @@ setup(
 
     install_requires=requirements,
 
+    extras_require={
+        'numpy': ['numpy']
+    },
+
     scripts=['bin/vanish']
 )
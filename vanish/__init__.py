@@ -4,5 +4,17 @@ __all__ = [
     'model',
     'utils',
     'commands',
-    'config'
+    'config',
+    'probe',
+    'snapshot',
+    'history',
+    'daemon',
+    'supervisor',
+    'trace',
+    'scoring',
+    'geo',
+    'completion',
+    'output',
+    'mirror',
+    'rendezvous'
 ]
@@ -1,11 +1,16 @@
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
 from .commands import (List,
                        Connect,
                        UpdateOvpnConfigs,
                        PingServers,
-                       Version)
+                       Version,
+                       RunDaemon,
+                       Completion,
+                       ServeMirror)
 from .utils import ServiceProvider, PersistentCache
 from .config import config
+from . import trace
+from .output import FORMATS
 from .model import GeoJson, OvpnConfigs, ServerContainer
 
 
@@ -37,10 +42,34 @@ class Vanish(object):
             command = "cmd.{}".format(arguments[VanishArgumentParser.COMMAND])
 
         if command in self._services:
-            self._services[command].execute(arguments)
+            with self._services.scope():
+                if arguments['profile'] or arguments['profile_dump']:
+                    self._profile(command, arguments)
+                else:
+                    self._services[command].execute(arguments)
         else:
             self._parser.print_help()
 
+    def _profile(self, command, arguments):
+        """Execute command timing its phases.
+
+        With --profile the breakdown, or spans as JSON, is logged once the
+        command finishes even if it exits early. --profile-dump alone only
+        saves cProfile statistics.
+        """
+        from .logger import logger
+
+        with trace.tracing(arguments['profile_dump']) as tracer:
+            try:
+                with trace.span(command[len('cmd.'):]):
+                    self._services[command].execute(arguments)
+            finally:
+                if arguments['profile']:
+                    if arguments['profile_format'] == 'json':
+                        logger.info(tracer.toJson())
+                    else:
+                        logger.info(tracer.breakdown())
+
     def _setupCommands(self, provider):
         provider.update({
             'cmd.list.continents': lambda p: List(p),
@@ -52,30 +81,129 @@ class Vanish(object):
             'cmd.connect': lambda p: Connect(p),
             'cmd.sync': lambda p: UpdateOvpnConfigs(p),
             'cmd.ping': lambda p: PingServers(p),
-            'cmd.version': lambda p: Version(p)
+            'cmd.version': lambda p: Version(p),
+            'cmd.daemon': lambda p: RunDaemon(p),
+            'cmd.completion': lambda p: Completion(p),
+            'cmd.mirror.serve': lambda p: ServeMirror(p)
             })
 
     def _setupServices(self, provider):
         provider.update({
             'config': lambda p: config,
+            'parser': lambda p: self._parser,
             'cache': ServiceProvider.singleton(
                 lambda p: PersistentCache(p['config']['cache.path'])
                 ),
-            'servers': ServiceProvider.singleton(
-                lambda p: ServerContainer(p['geojson'])
-                ),
             'ovpnconfigs': lambda p: OvpnConfigs(
-                p['config']['ovpn.configs.url'],
-                p['config']['ovpn.configs.path']
+                _url(p['config'], 'ovpn.configs.url'),
+                p['config']['ovpn.configs.path'],
+                p['config']['ovpn.configs.max_size'],
+                p['config']['ovpn.configs.retries'],
+                p['config']['ovpn.configs.mode'],
+                p['config']['ovpn.render.dir']
                 ),
-            'geojson': lambda p: GeoJson(
-                p['config']['geojson.url'],
-                p['config']['geojson.cache.path']
+            'local.servers': ServiceProvider.singleton(
+                lambda p: ServerContainer(p['local.geojson'])
                 ),
-
+            'local.geojson': ServiceProvider.singleton(
+                lambda p: GeoJson(
+                    _url(p['config'], 'geojson.url'),
+                    p['config']['geojson.cache.path'],
+                    p['config']['geojson.cache.timeout'],
+                    p['config']['geojson.snapshot.path'],
+                    p['config']['completion.index.path']
+                    )
+                ),
+            'local.prober': lambda p: _prober(p['config']['ping.backend'])(
+                timeout=p['config']['ping.timeout'],
+                concurrency=p['config']['ping.concurrency'],
+                interval=p['config']['ping.interval']
+                ),
+            'local.history': ServiceProvider.singleton(
+                lambda p: _history()(
+                    p['config']['history.path'],
+                    p['config']['history.alpha'],
+                    p['config']['history.retention']
+                    )
+                ),
+            'daemon': ServiceProvider.singleton(
+                lambda p: _daemon().DaemonClient(p['config']['daemon.socket'])
+                ),
+            'servers': _local_or_remote('servers', 'RemoteServerContainer'),
+            'geojson': _local_or_remote('geojson', 'RemoteGeoJson'),
+            'prober': _local_or_remote('prober', 'RemoteProber'),
+            'history': _local_or_remote('history', 'RemoteLatencyHistory'),
+            'updated': ServiceProvider.scoped(lambda p: set()),
             })
 
 
+def _prober(backend):
+    from .probe import PROBERS
+    return PROBERS[backend]
+
+
+def _history():
+    from .history import LatencyHistory
+    return LatencyHistory
+
+
+def _daemon():
+    from . import daemon
+    return daemon
+
+
+def _url(config, key):
+    """The URL at config[key] or its mirror's if mirror.url is set."""
+    if not config['mirror.url']:
+        return config[key]
+
+    from . import mirror
+    return mirror.url(config, key)
+
+
+def _weight(value):
+    """Parse a --weight FACTOR=W argument into a (factor, weight) tuple."""
+    from .scoring import FACTORS
+
+    factor, _, weight = value.partition('=')
+
+    if factor not in FACTORS:
+        raise ArgumentTypeError("unknown factor '{}', choose from {}".format(
+            factor, ", ".join(FACTORS)))
+
+    try:
+        return factor, float(weight)
+    except ValueError:
+        raise ArgumentTypeError("invalid weight '{}'".format(weight))
+
+
+def _coordinates(value):
+    """Parse a --near LAT,LON argument into a (latitude, longitude) tuple."""
+    from .geo import parse
+
+    try:
+        return parse(value)
+    except ValueError as e:
+        raise ArgumentTypeError(str(e))
+
+
+def _local_or_remote(name, remote):
+    """A service answered by the daemon if it's running or locally if not.
+
+    :param name: The service name, the local service is local.<name>.
+    :param remote: Name of the daemon module class standing in for it.
+    """
+    def factory(p):
+        client = p['daemon']
+
+        if client.available:
+            return getattr(_daemon(), remote)(client)
+
+        return p['local.' + name]
+
+    return ServiceProvider.singleton(factory)
+
+
 class VanishArgumentParser(ArgumentParser):
 
     COMMAND = "command"
@@ -84,14 +212,72 @@ class VanishArgumentParser(ArgumentParser):
     def __init__(self, *args, **kwargs):
         super(VanishArgumentParser, self).__init__(*args, **kwargs)
 
+        self.add_argument(
+            '--profile',
+            action='store_true',
+            help="print how long each phase of the command took"
+            )
+        self.add_argument(
+            '--profile-format',
+            default='breakdown',
+            choices=['breakdown', 'json'],
+            help="with --profile, print the phases as a breakdown or as "
+                 "JSON spans"
+            )
+        self.add_argument(
+            '--profile-dump',
+            metavar="PATH",
+            help="write cProfile statistics of the command to PATH"
+            )
+
         command = self.add_subparsers(
             dest=self.COMMAND,
             parser_class=ArgumentParser
             )
 
         ping = command.add_parser('ping', help="ping servers")
+        self._addCountArgument(ping)
+        self._addNearArguments(ping)
+        self._addFormatArgument(ping)
         self._addAllServerFilters(ping.add_argument_group('filters'))
 
+        command.add_parser("version", help="show the vanish version")
+
+        command.add_parser(
+            "daemon",
+            help="serve queries from memory so other commands answer faster"
+            )
+
+        completion = command.add_parser(
+            "completion",
+            help="print a shell completion script, e.g. "
+                 "source <(vanish completion bash)"
+            )
+        completion.add_argument(
+            'shell',
+            choices=['bash', 'zsh']
+            )
+
+        mirror = command.add_parser(
+            "mirror",
+            help="serve the geojson and ovpn configs to other vanish hosts"
+            )
+        mirror.add_argument(
+            self.SUBCOMMAND,
+            choices=['serve']
+            )
+        mirror.add_argument(
+            '--host',
+            default=None,
+            help="address to listen on, default: mirror.host"
+            )
+        mirror.add_argument(
+            '--port',
+            type=int,
+            default=None,
+            help="port to listen on, default: mirror.port"
+            )
+
         command.add_parser(
             "sync",
             help="sync openvpn config cache with server"
@@ -106,6 +292,49 @@ class VanishArgumentParser(ArgumentParser):
             default=None,
             nargs="*"
             )
+        self._addCountArgument(connect)
+        self._addNearArguments(connect)
+        connect.add_argument(
+            '--probe',
+            action='store_true',
+            help="ping every candidate, ignoring the latency history"
+            )
+        connect.add_argument(
+            '--supervise',
+            action='store_true',
+            help="reconnect to the next best server if the tunnel fails"
+            )
+        connect.add_argument(
+            '--race',
+            type=int,
+            default=None,
+            metavar="K",
+            help="start tunnels to the best K servers and keep the first "
+                 "to connect"
+            )
+        connect.add_argument(
+            '--weight',
+            action='append',
+            dest='weights',
+            type=_weight,
+            metavar="FACTOR=W",
+            help="weight of a factor servers are ranked on: capacity, rtt, "
+                 "jitter, loss or distance"
+            )
+        connect.add_argument(
+            '--spread',
+            action='store_true',
+            help="pick among the servers by rendezvous hashing of this "
+                 "node's id, weighted by remaining capacity, so many nodes "
+                 "spread over them"
+            )
+        connect.add_argument(
+            '--node-id',
+            default=None,
+            metavar="ID",
+            help="the id to --spread with, default: spread.node or the "
+                 "machine id"
+            )
         self._addAllServerFilters(connect.add_argument_group('filters'))
 
         list = command.add_parser(
@@ -120,8 +349,44 @@ class VanishArgumentParser(ArgumentParser):
             nargs="?",
             choices=['servers', 'continents', 'countries', 'regions', 'cities']
             )
+        self._addFormatArgument(list)
         self._addAllServerFilters(list.add_argument_group('filters'))
 
+    def _addCountArgument(self, parser):
+        parser.add_argument(
+            '--count',
+            type=int,
+            default=None,
+            metavar="K",
+            help="number of ping samples per server"
+        )
+
+    def _addFormatArgument(self, parser):
+        parser.add_argument(
+            '--format',
+            default='table',
+            choices=list(FORMATS),
+            help="output format, every format but table writes each row as "
+                 "soon as it's known"
+        )
+
+    def _addNearArguments(self, parser):
+        parser.add_argument(
+            '--near',
+            type=_coordinates,
+            default=None,
+            metavar="LAT,LON",
+            help="only consider the servers nearest this point, write "
+                 "--near=LAT,LON if LAT is negative"
+        )
+        parser.add_argument(
+            '--nearest',
+            type=int,
+            default=None,
+            metavar="N",
+            help="number of the nearest servers to consider"
+        )
+
     def _addAllServerFilters(self, parser):
         self._addContinentsFilter(parser)
         self._addCountriesFilter(parser)
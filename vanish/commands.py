@@ -1,6 +1,10 @@
-import os
-import tabulate
+import contextlib
+import math
 import operator
+import os
+import sys
+from . import geo, output, trace
+from .output import Column
 from .model import Vanish
 from .__version__ import VERSION
 
@@ -20,109 +24,494 @@ class Command(object):
     def execute(self, arguments):
         raise NotImplementedError()
 
+    def _update(self, name):
+        """Update a service at most once while running a command.
+
+        :param name: Name of a service with an update method.
+        """
+        updated = self._services['updated']
+
+        if name not in updated:
+            updated.add(name)
+            self._services[name].update()
+
+    def _query(self, method, **filters):
+        """Call a ServerContainer query method.
+
+        :param method: The name of the method, e.g. getServers.
+        :param filters: Filters to pass to the method.
+        """
+        with trace.span('query', method=method):
+            return getattr(self._services['servers'], method)(**filters)
+
+    def _matching(self, arguments):
+        """Query the servers matching the filters in arguments.
+
+        With --near or --nearest only the servers nearest the origin are
+        returned, nearest first.
+        """
+        filters = {
+            'continents': arguments['continents'],
+            'countries': arguments['countries'],
+            'regions': arguments['regions'],
+            'cities': arguments['cities']
+        }
+
+        if not (arguments.get('near') or arguments.get('nearest')):
+            return self._query('getServers', **filters)
+
+        origin = self._origin(arguments)
+
+        if origin is None:
+            print("--nearest needs --near LAT,LON or geo.origin configured")
+            exit(1)
+
+        count = (arguments.get('nearest')
+                 or self._services['config']['geo.nearest'])
+
+        return self._query(
+            'getNearest', latitude=origin[0], longitude=origin[1],
+            count=count, **filters)
+
+    def _origin(self, arguments):
+        """The (latitude, longitude) given by --near or geo.origin or None."""
+        origin = (arguments.get('near')
+                  or self._services['config']['geo.origin'])
+
+        return tuple(origin) if origin else None
+
+    @staticmethod
+    def _distances(servers, origin):
+        """The distance in km of each server from origin.
+
+        :return: A list of distances, None where a server's coordinates
+            aren't known, or None if origin is None.
+        """
+        if origin is None:
+            return None
+
+        return [geo.distance(origin, s.latitude, s.longitude)
+                for s in servers]
+
+    @staticmethod
+    def _status(arguments, message):
+        """Print a progress message.
+
+        It goes to stderr when stdout is machine readable output.
+        """
+        table = (arguments.get('format') or 'table') == 'table'
+        print(message, file=sys.stdout if table else sys.stderr)
+
+    def _iping(self, servers, arguments):
+        """Ping servers yielding each as soon as its probe completes.
+
+        The results are recorded in the latency history once every probe
+        has completed or the caller stops early.
+        """
+        count = (arguments.get('count')
+                 or self._services['config']['ping.count'])
+        probed = []
+
+        try:
+            for server in Vanish.iping(
+                    servers, self._services['prober'], count):
+                probed.append(server)
+                yield server
+        finally:
+            self._services['history'].record(probed)
+
+    def _ping(self, servers, arguments):
+        """Ping servers and record the results in the latency history."""
+        count = (arguments.get('count')
+                 or self._services['config']['ping.count'])
+        servers = Vanish.ping(servers, self._services['prober'], count)
+        self._services['history'].record(servers)
+
+        return servers
+
 
 class Version(Command):
     def execute(self, arguments):
         print("Vanish version {}".format(VERSION))
 
 
+class RunDaemon(Command):
+    def execute(self, arguments):
+        from .daemon import Daemon, DaemonError
+
+        path = self._services['config']['daemon.socket']
+        daemon = Daemon(self._services, path)
+
+        print("Vanish daemon listening on {}".format(path))
+
+        try:
+            daemon.serve()
+        except DaemonError as e:
+            print(e)
+            exit(1)
+        except KeyboardInterrupt:
+            pass
+
+
+class ServeMirror(Command):
+    def execute(self, arguments):
+        from .mirror import ARTIFACTS, Mirror, MirrorServer
+
+        config = self._services['config']
+        mirror = Mirror(
+            {name: config[key] for name, key in ARTIFACTS.items()},
+            config['mirror.path'],
+            config['mirror.timeout'])
+
+        try:
+            server = MirrorServer(mirror, (
+                arguments['host'] or config['mirror.host'],
+                arguments['port'] or config['mirror.port']))
+        except OSError as e:
+            print("Unable to start the mirror: {}".format(e))
+            exit(1)
+
+        print("Vanish mirror serving {} on {}".format(
+            ", ".join(mirror.names), server.url()))
+
+        try:
+            server.serve()
+        except KeyboardInterrupt:
+            pass
+
+
+class Completion(Command):
+    def execute(self, arguments):
+        from . import completion
+
+        print(completion.script(
+            arguments['shell'], self._services['parser']), end='')
+
+
 class Connect(Command):
     def execute(self, arguments):
         print("Updating server status.")
-        self._services['geojson'].update()
+        self._update('geojson')
 
         if "server" not in arguments:
             print("Selecting a server ...")
-            servers = self._services['servers'].getServers(
-                continents=arguments['continents'],
-                countries=arguments['countries'],
-                regions=arguments['regions'],
-                cities=arguments['cities']
-            )
+            servers = self._matching(arguments)
 
             if not servers:
                 print("No servers available with current filters")
                 exit()
 
-            servers = sorted(servers, key=lambda x: x['capacity'])
-            servers = Vanish.ping(servers[:20])
-            servers = sorted(servers, key=lambda x: x['rtt'])
-            server = servers[0]
+            if self._spreading(arguments):
+                servers = self._spread(servers, arguments)
+                with trace.span('score', servers=len(servers)):
+                    scores = self._scores(servers, arguments)
+            else:
+                scorer = self._scorer(arguments)
+                origin = self._origin(arguments)
+                servers = self._candidates(scorer, servers, origin)
+                with trace.span('score', servers=len(servers)):
+                    scores = self._scores(servers, arguments)
+                ranked = scorer.rank(
+                    servers, scores, self._distances(servers, origin))
+                servers = [s for s, _ in ranked]
+
+            servers = [s for s in servers
+                       if math.isfinite(scores[s.hostname].value)]
+
+            if not servers:
+                print("No servers responded to ping")
+                exit()
 
-            config_file = "{}.ovpn".format(
-                "-".join([
-                    server['countryCode'],
-                    server['hostname'].split('.')[0]])
-                .lower())
+            server = servers[0]
+            score = scores[server.hostname]
+            config_file = server.ovpnFile
         else:
             config_file = "{}.ovpn".format(arguments['server'].lower())
 
-        print("Selected {} ({}); Capacity {}%; Ping {}ms".format(
-            server['title'],
-            server['hostname'],
-            server['capacity'],
-            server['rtt']
-        ))
-
-        Vanish.connect(
-            os.path.join(
-                self._services['config']['ovpn.configs.path'],
-                config_file),
-            self._services['config']['ovpn.cert'],
-            *(arguments['bucket'])
-        )
-
+        print("Selected {} ({}); Capacity {}%; Ping {:.1f}ms; Loss {:.0%}"
+              .format(server.title,
+                      server.hostname,
+                      server.capacity,
+                      score.rtt,
+                      score.loss))
+
+        race = (arguments.get('race')
+                or self._services['config']['openvpn.race'])
+
+        if arguments.get('supervise') or race > 1:
+            self._supervise(servers, race, arguments)
+            return
+
+        with contextlib.ExitStack() as stack:
+            try:
+                path = stack.enter_context(
+                    self._services['ovpnconfigs'].config(config_file))
+            except FileNotFoundError as e:
+                print("{}; run `vanish sync` to download the configs"
+                      .format(e))
+                sys.exit(1)
+
+            Vanish.connect(
+                path,
+                self._services['config']['ovpn.cert'],
+                *(arguments['bucket']),
+                openvpn=self._services['config']['openvpn.path']
+            )
 
-class PingServers(Command):
-    def execute(self, arguments):
-        print("Updating server status.")
-        self._services['geojson'].update()
+    def _scorer(self, arguments):
+        """A Scorer weighted by the config and any --weight arguments."""
+        from .scoring import FACTORS, Scorer
+
+        config = self._services['config']
+        weights = {f: config['scoring.weight.' + f] for f in FACTORS}
+        weights.update(arguments.get('weights') or [])
+
+        try:
+            return Scorer(weights, config['scoring.backend'])
+        except ValueError as e:
+            print(e)
+            exit(1)
+
+    def _candidates(self, scorer, servers, origin):
+        """The best servers to check the latency of, ranked on history.
+
+        :param origin: The (latitude, longitude) distances are scored from
+            or None.
+        :return: At most scoring.candidates servers, best first.
+        """
+        candidates = self._services['config']['scoring.candidates']
+
+        with trace.span('rank', servers=len(servers), backend=scorer.backend):
+            history = self._services['history'].scores(
+                s.hostname for s in servers)
+            ranked = scorer.rank(
+                servers, history, self._distances(servers, origin),
+                k=candidates)
+
+        return [s for s, _ in ranked]
+
+    def _spreading(self, arguments):
+        return bool(arguments.get('spread')
+                    or self._services['config']['spread.enabled'])
+
+    def _spread(self, servers, arguments):
+        """The servers to check the latency of in this node's rendezvous order.
+
+        Servers are ordered by weighted rendezvous hashing of the node id so
+        many nodes connecting with the same filters spread over the servers
+        rather than all picking the least loaded one.
+
+        :return: At most scoring.candidates servers, most preferred first.
+        """
+        from . import rendezvous
+
+        config = self._services['config']
+        node = rendezvous.nodeId(
+            arguments.get('node_id') or config['spread.node'])
+
+        with trace.span('spread', servers=len(servers)):
+            servers = rendezvous.rank(node, servers)
+
+        return servers[:config['scoring.candidates']]
+
+    def _supervise(self, servers, race, arguments):
+        """Race tunnels to the best servers, failing over if supervising."""
+        from .supervisor import Supervisor, TunnelError
+
+        config = self._services['config']
+        supervisor = Supervisor(
+            servers,
+            lambda server: self._tunnel(server, arguments),
+            config['openvpn.connect.timeout'],
+            config['openvpn.stall.timeout'],
+            race,
+            config['openvpn.race.stagger'],
+            failover=bool(arguments.get('supervise')))
+
+        try:
+            supervisor.run()
+        except TunnelError as e:
+            print(e)
+            exit(1)
+        except KeyboardInterrupt:
+            print("Disconnected")
+
+    @contextlib.contextmanager
+    def _tunnel(self, server, arguments):
+        """Start a supervised tunnel to server, stopping it on exit."""
+        import shutil
+        import tempfile
+        from .supervisor import Tunnel, TunnelError
+
+        config = self._services['config']
+        directory = tempfile.mkdtemp(prefix='vanish-')
+
+        try:
+            with contextlib.ExitStack() as stack:
+                try:
+                    path = stack.enter_context(
+                        self._services['ovpnconfigs'].config(server.ovpnFile))
+                except FileNotFoundError as e:
+                    raise TunnelError(str(e))
+
+                tunnel = Tunnel(
+                    server.hostname,
+                    path,
+                    config['ovpn.cert'],
+                    os.path.join(directory, 'management.sock'),
+                    arguments['bucket'],
+                    config['openvpn.path'],
+                    config['openvpn.bytecount.interval'])
+                stack.callback(tunnel.stop)
+                tunnel.start()
+
+                yield tunnel
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def _scores(self, servers, arguments):
+        """Score servers from the latency history, pinging if it's stale.
+
+        Servers whose history is older than history.max_age are pinged. If
+        none of the servers with fresh history are reachable, or --probe is
+        given, every server is pinged.
+
+        :return: A dictionary of {hostname: history.Score} for every server.
+        """
+        store = self._services['history']
+        max_age = self._services['config']['history.max_age']
+        scores = store.scores(s.hostname for s in servers)
+
+        if arguments.get('probe'):
+            stale = servers
+        else:
+            stale = [s for s in servers if s.hostname not in scores
+                     or scores[s.hostname].age() > max_age]
+            fresh = [scores[s.hostname] for s in servers if s not in stale]
 
-        servers = self._services['servers'].getServers(
-            continents=arguments['continents'],
-            countries=arguments['countries'],
-            regions=arguments['regions'],
-            cities=arguments['cities'])
+            if not any(math.isfinite(f.value) for f in fresh):
+                stale = servers
 
-        print("Pinging servers ...")
+        if stale:
+            print("Pinging {} servers ...".format(len(stale)))
+            self._ping(stale, arguments)
+            scores = store.scores(s.hostname for s in servers)
 
-        servers = Vanish.ping(servers)
+        return scores
 
-        table = []
-        for server in servers:
-            server_handle = "{}-{}".format(server['countryCode'].lower(),
-                                           server['hostname'].split('.')[0])
 
-            table.append([
-                server['title'],
-                server_handle,
-                str(server['capacity']) + "%",
-                str(server['rtt']) + " ms"
-            ])
+class PingServers(Command):
+    COLUMNS = [
+        Column('location', 'Location'),
+        Column('handle', 'Handle'),
+        Column('capacity', 'Load', "{}%".format),
+        Column('minimum', 'Min', "{:.1f} ms".format),
+        Column('median', 'Median', "{:.1f} ms".format),
+        Column('p95', 'P95', "{:.1f} ms".format),
+        Column('jitter', 'Jitter', "{:.1f} ms".format),
+        Column('loss', 'Loss', "{:.0%}".format),
+        Column('hostname'),
+        Column('ip'),
+        Column('sent'),
+        Column('received'),
+    ]
+
+    DISTANCE = Column('distance', 'Distance', "{:.0f} km".format)
 
-        print(tabulate.tabulate(
-            sorted(table),
-            headers=["Location", "Handle", "Load", "Response"],
-            tablefmt="fancy_grid"))
+    def execute(self, arguments):
+        self._status(arguments, "Updating server status.")
+        self._update('geojson')
+
+        servers = self._matching(arguments)
+        origin = self._origin(arguments)
+        columns = self.COLUMNS + ([self.DISTANCE] if origin else [])
+
+        self._status(arguments, "Pinging servers ...")
+
+        with output.writer(arguments['format'], columns) as out:
+            for server in self._iping(servers, arguments):
+                latency = server.latency
+
+                if not latency.received:
+                    self._status(arguments, "Failed to ping {}".format(
+                        server.hostname))
+
+                out.write({
+                    'location': server.title,
+                    'handle': server.handle,
+                    'capacity': server.capacity,
+                    'minimum': latency.minimum,
+                    'median': latency.median,
+                    'p95': latency.p95,
+                    'jitter': latency.jitter,
+                    'loss': latency.loss,
+                    'hostname': server.hostname,
+                    'ip': server.ip,
+                    'sent': latency.sent,
+                    'received': latency.received,
+                    'distance': origin and geo.distance(
+                        origin, server.latitude, server.longitude)
+                })
 
 
 class UpdateGeoJson(Command):
     def execute(self, arguments):
         print("Updating geojson ...")
-        self._services['geojson'].update()
+        self._update('geojson')
         print("IPVanish GeoJson updated")
 
 
 class UpdateOvpnConfigs(Command):
     def execute(self, arguments):
         print("Updating configs ...")
-        self._services['ovpnconfigs'].update()
-        print("Open VPN configs updated.")
+        stats = self._services['ovpnconfigs'].update(self._progress)
+        print()
+        print("Open VPN configs updated: {added} added, {changed} changed, "
+              "{removed} removed.".format(**stats))
+
+    @staticmethod
+    def _progress(downloaded, total):
+        if total:
+            print("\rDownloaded {:.0%}".format(downloaded / total), end='')
+        else:
+            print("\rDownloaded {} KiB".format(downloaded // 1024), end='')
 
 
 class List(Command):
+    COLUMNS = {
+        'continents': [
+            Column('name', 'Name'),
+            Column('code', 'Code'),
+        ],
+        'countries': [
+            Column('continent', 'Continent'),
+            Column('name', 'Name'),
+            Column('code', 'Code'),
+        ],
+        'regions': [
+            Column('country', 'Country'),
+            Column('name', 'Region'),
+            Column('code', 'Code'),
+        ],
+        'cities': [
+            Column('continent', 'Continent'),
+            Column('country', 'Country'),
+            Column('name', 'City'),
+        ],
+        'servers': [
+            Column('continent', 'Continent'),
+            Column('country', 'Country'),
+            Column('region', 'Region'),
+            Column('city', 'City'),
+            Column('name', 'Server'),
+            Column('hostname'),
+            Column('ip'),
+            Column('capacity'),
+        ],
+    }
+
     def execute(self, args):
-        self._services['geojson'].update()
+        self._update('geojson')
 
         filters = {
             "continents": args['continents'] if args['continents'] else None,
@@ -136,83 +525,58 @@ class List(Command):
         else:
             subcommand = args["subcommand"]
 
-        if subcommand == "continents":
-            self._continents()
-        elif subcommand == "countries":
-            self._countries(filters)
-        elif subcommand == "regions":
-            self._regions(filters)
-        elif subcommand == "cities":
-            self._cities(filters)
-        else:
-            self._servers(filters)
+        if subcommand not in self.COLUMNS:
+            subcommand = "servers"
 
-    def _continents(self):
-        continents = self._services['servers'].getContinents()
+        records = getattr(self, '_' + subcommand)(filters)
 
-        headers = ['Name', 'Code']
+        with output.writer(args['format'], self.COLUMNS[subcommand]) as out:
+            for record in records:
+                out.write(record)
 
-        print(tabulate.tabulate(
-            sorted(continents, key=lambda e: e[0]),
-            headers=headers,
-            tablefmt="fancy_grid"
-        ))
+    def _continents(self, filters):
+        for name, code in self._query('getContinents'):
+            yield {'name': name, 'code': code}
 
     def _countries(self, filters):
-        countries = self._services['servers'].getCountries(
+        countries = self._query(
+            'getCountries',
             continents=filters["continents"]
             )
 
-        headers = ['Continent', 'Code', 'Name']
-
-        print(tabulate.tabulate(
-            sorted(countries, key=lambda e: (e[0], e[1])),
-            headers=headers,
-            tablefmt="fancy_grid"
-        ))
+        for continent, name, code in countries:
+            yield {'continent': continent, 'name': name, 'code': code}
 
     def _regions(self, filters):
-        regions = self._services['servers'].getRegions(
+        regions = self._query(
+            'getRegions',
             continents=filters["continents"],
             countries=filters["countries"]
             )
 
-        headers = ['Country', 'Region', 'Code']
-
-        print(tabulate.tabulate(
-            sorted(regions, key=lambda e: (e[0], e[1])),
-            headers=headers,
-            tablefmt="fancy_grid"
-        ))
+        for country, name, code in regions:
+            yield {'country': country, 'name': name, 'code': code}
 
     def _cities(self, filters):
-        cities = self._services['servers'].getCities(
+        cities = self._query(
+            'getCities',
             continents=filters["continents"],
             countries=filters["countries"],
             regions=filters["regions"]
             )
 
-        headers = ['Continent', 'Country', 'City']
-
-        print(tabulate.tabulate(
-            sorted(cities, key=lambda e: (e[0], e[1])),
-            headers=headers,
-            tablefmt="fancy_grid"
-            ))
+        for continent, country, name in cities:
+            yield {'continent': continent, 'country': country, 'name': name}
 
     def _servers(self, filters):
-        servers = self._services['servers'].getServers(**filters)
-
-        headers = ['Continent', 'Country', 'Region', 'City', 'Server']
-
-        server_data = [
-            (s['continent'], s['country'], s['region'],
-             s['city'], s['hostname'].split(".")[0])
-            for s in servers
-        ]
-
-        print(tabulate.tabulate(
-            sorted(server_data),
-            headers=headers,
-            tablefmt="fancy_grid"
-        ))
+        for s in self._query('getServers', **filters):
+            yield {
+                'continent': s.continent,
+                'country': s.country,
+                'region': s.region,
+                'city': s.city,
+                'name': s.name,
+                'hostname': s.hostname,
+                'ip': s.ip,
+                'capacity': s.capacity
+            }
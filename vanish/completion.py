@@ -0,0 +1,278 @@
+import mmap
+import os
+import sys
+"""
+This module answers shell completion for the location filters.
+
+A prefix index of every case folded location name and code is written next
+to the geojson cache whenever the servers are downloaded. It's a sorted text
+file of lines
+
+    kind<TAB>folded<TAB>value
+
+so completing a prefix is a bisect into its lines, done over a memory map
+of the file so only the pages it touches are read. bin/vanish answers
+`vanish __complete KIND PREFIX` from here before the application, or
+anything slow to import, is loaded.
+"""
+
+MAGIC = 'VNCI 1'
+
+"""
+The location fields completed for each kind and the option taking them.
+"""
+KINDS = {
+    'continents': (('continent', 'continentCode'), '--continent'),
+    'countries': (('country', 'countryCode'), '--country'),
+    'regions': (('region', 'regionCode', 'regionAbbr'), '--region'),
+    'cities': (('city',), '--city'),
+}
+
+
+def dump(servers, path):
+    """Write the completion index of servers to path.
+
+    :param servers: A list of model.Server instances.
+    :param path: Path to write the index to.
+    """
+    entries = set()
+
+    for kind, (fields, _) in KINDS.items():
+        for server in servers:
+            for field in fields:
+                value = getattr(server, field)
+
+                # Tabs and newlines would break the format and can't be
+                # typed at a prompt anyway.
+                if value and value.isprintable():
+                    entries.add((kind, value.casefold(), value))
+
+    temp_path = path + '.tmp'
+
+    with open(temp_path, 'w', encoding='utf-8') as h:
+        h.write(MAGIC + '\n')
+
+        for entry in sorted(entries):
+            h.write('\t'.join(entry) + '\n')
+
+    os.replace(temp_path, path)
+
+
+def lookup(path, kind, prefix=''):
+    """Complete prefix from the index at path.
+
+    :param kind: One of KINDS.
+    :param prefix: What's been typed so far, matched case insensitively.
+    :raises FileNotFoundError: If there's no index.
+    :raises ValueError: If the index is invalid.
+    :return: A list of values starting with prefix.
+    """
+    # UTF-8 sorts bytes in the same order as the strings they encode.
+    key = "{}\t{}".format(kind, prefix.casefold()).encode('utf-8')
+    values = []
+
+    with open(path, 'rb') as h:
+        if h.readline().rstrip(b'\n') != MAGIC.encode('utf-8'):
+            raise ValueError("Invalid completion index {}".format(path))
+
+        start = h.tell()
+
+        with mmap.mmap(h.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            position = _bisect(buffer, key, start)
+
+            while position < len(buffer):
+                end = _lineEnd(buffer, position)
+                line = buffer[position:end]
+
+                if not line.startswith(key):
+                    break
+
+                value = line.rpartition(b'\t')[2].decode('utf-8')
+
+                if value not in values:
+                    values.append(value)
+
+                position = end + 1
+
+    return values
+
+
+def _bisect(buffer, key, start):
+    """The offset of the first line in buffer not less than key.
+
+    :param start: The offset of the first line.
+    """
+    low, high = start, len(buffer)
+
+    # low and high are always the start of a line.
+    while low < high:
+        middle = (low + high) // 2
+        line = buffer.rfind(b'\n', low, middle) + 1 or low
+        end = _lineEnd(buffer, line)
+
+        if buffer[line:end] < key:
+            low = end + 1
+        else:
+            high = line
+
+    return low
+
+
+def _lineEnd(buffer, position):
+    end = buffer.find(b'\n', position)
+    return len(buffer) if end == -1 else end
+
+
+def main(args):
+    """Print completions, one per line, for `vanish __complete KIND PREFIX`.
+
+    If the index hasn't been written yet it's built from the cached servers;
+    nothing is downloaded while completing.
+
+    :param args: KIND and an optional PREFIX.
+    :return: An exit code.
+    """
+    if not args or args[0] not in KINDS:
+        return 2
+
+    from .config import config
+
+    kind, prefix = args[0], args[1] if len(args) > 1 else ''
+    path = config['completion.index.path']
+
+    try:
+        values = lookup(path, kind, prefix)
+    except (FileNotFoundError, ValueError):
+        if not os.path.exists(config['geojson.cache.path']):
+            return 1
+
+        from .model import GeoJson
+
+        try:
+            dump(GeoJson(config['geojson.url'],
+                         config['geojson.cache.path'],
+                         config['geojson.cache.timeout'],
+                         config['geojson.snapshot.path']).servers,
+                 path)
+            values = lookup(path, kind, prefix)
+        except ValueError:
+            return 1
+
+    for value in values:
+        sys.stdout.write(value + '\n')
+
+    return 0
+
+
+def script(shell, parser):
+    """Generate a completion script.
+
+    :param shell: 'bash' or 'zsh'.
+    :param parser: The vanish ArgumentParser whose commands and options are
+        completed.
+    :return: The script.
+    """
+    commands = _commands(parser)
+    kinds = "\n".join("        {}) kind={} ;;".format(option, kind)
+                      for kind, (_, option) in sorted(KINDS.items()))
+    options = "\n".join(
+        "        {}) choices=\"{}\" ;;".format(
+            "|".join(names), " ".join(words))
+        for names, words in commands[1:])
+
+    return (_BASH if shell == 'bash' else _ZSH).format(
+        commands=" ".join(commands[0][1]), kinds=kinds, options=options)
+
+
+def _commands(parser):
+    """The words to complete after each command.
+
+    :return: A list of (names, words) tuples; the first are the commands
+        themselves.
+    """
+    import argparse
+
+    subparsers = [a for a in parser._actions
+                  if isinstance(a, argparse._SubParsersAction)][0]
+    aliases = {}
+
+    for name, subparser in subparsers.choices.items():
+        aliases.setdefault(id(subparser), (subparser, []))[1].append(name)
+
+    commands = [((), list(subparsers.choices))]
+
+    for subparser, names in aliases.values():
+        words = []
+
+        for action in subparser._actions:
+            words.extend(o for o in action.option_strings if o != '-h')
+
+            if not action.option_strings and action.choices:
+                words.extend(action.choices)
+
+        commands.append((names, words))
+
+    return commands
+
+
+_BASH = """# vanish bash completion, load with:
+# source <(vanish completion bash)
+_vanish() {{
+    local cur="${{COMP_WORDS[COMP_CWORD]}}"
+    local prev="${{COMP_WORDS[COMP_CWORD-1]}}"
+    local kind choices IFS=$'\\n'
+
+    case "$prev" in
+{kinds}
+    esac
+
+    if [ -n "$kind" ]; then
+        COMPREPLY=($(vanish __complete "$kind" "${{cur//\\\\/}}" 2>/dev/null |
+                     while read -r value; do printf '%q\\n' "$value"; done))
+        return
+    fi
+
+    if [ "$COMP_CWORD" -eq 1 ]; then
+        choices="{commands}"
+    else
+        case "${{COMP_WORDS[1]}}" in
+{options}
+        esac
+    fi
+
+    IFS=$' \\t\\n'
+    COMPREPLY=($(compgen -W "$choices" -- "$cur"))
+}}
+complete -F _vanish vanish
+"""
+
+_ZSH = """#compdef vanish
+# vanish zsh completion, load with:
+# source <(vanish completion zsh)
+_vanish() {{
+    local kind choices
+
+    case "$words[CURRENT-1]" in
+{kinds}
+    esac
+
+    if [[ -n $kind ]]; then
+        local -a values
+        values=("${{(@f)$(vanish __complete $kind "$PREFIX" 2>/dev/null)}}")
+        # Matched case insensitively so don't let zsh filter them again.
+        compadd -U -- ${{values:#}}
+        return
+    fi
+
+    if (( CURRENT == 2 )); then
+        choices="{commands}"
+    else
+        case "$words[2]" in
+{options}
+        esac
+    fi
+
+    compadd -- ${{=choices}}
+}}
+compdef _vanish vanish
+"""
@@ -1,3 +1,4 @@
+import json
 import os
 """
 This module contains the application configuration values.
@@ -37,11 +38,216 @@ config['geojson.cache.path'] = os.path.join(
     config['config.dir'], 'servers.geojson')
 
 """
-A timeout value indicating how long the geojson is valid for.
+A path to a binary snapshot of the geojson cache which loads much faster than
+the cache itself.
+"""
+config['geojson.snapshot.path'] = os.path.join(
+    config['config.dir'], 'servers.snapshot')
+
+"""
+A path to the prefix index of location names shell completion answers from.
+It's written alongside the geojson cache.
+"""
+config['completion.index.path'] = os.path.join(
+    config['config.dir'], 'servers.completion')
+
+"""
+The number of seconds the cached geojson is considered fresh for. Once it
+expires the cache is revalidated with IPVanish and only downloaded again if
+it has changed.
 """
 config['geojson.cache.timeout'] = 30
 
 
+""" PING """
+
+"""
+Seconds to wait for a reply to a single ping probe.
+"""
+config['ping.timeout'] = 1
+
+"""
+The maximum number of ping probes that may be in flight at once.
+"""
+config['ping.concurrency'] = 64
+
+"""
+The number of samples taken from each server when pinging. Servers are
+ranked on statistics over all samples so more samples give a steadier choice.
+"""
+config['ping.count'] = 3
+
+"""
+Seconds between consecutive samples sent to the same server.
+"""
+config['ping.interval'] = 0.2
+
+"""
+The probe backend used to ping servers. 'icmp' sends echo requests from
+within the process and falls back to 'subprocess', which runs the system ping
+binary, if ICMP sockets aren't available.
+"""
+config['ping.backend'] = 'icmp'
+
+
+""" HISTORY """
+
+"""
+Path to the SQLite database recording every ping probe.
+"""
+config['history.path'] = os.path.join(config['config.dir'], 'history.sqlite3')
+
+"""
+Weight given to the newest probe in each server's moving average latency,
+between 0 and 1. Higher values react faster to changes but are noisier.
+"""
+config['history.alpha'] = 0.3
+
+"""
+Seconds a server's latency history is trusted for. Connecting to servers with
+fresher history doesn't ping them again.
+"""
+config['history.max_age'] = 300
+
+"""
+Seconds raw probe samples are kept for.
+"""
+config['history.retention'] = 30 * 24 * 60 * 60
+
+
+""" LOCATION """
+
+"""
+Where you are as [latitude, longitude], e.g. [51.5, -0.13], or None. Servers
+are then scored on their distance from it and connect and ping --nearest
+narrow the candidates to the servers closest to it. --near LAT,LON
+overrides it.
+"""
+config['geo.origin'] = None
+
+"""
+The number of servers --near narrows the candidates to when --nearest isn't
+given.
+"""
+config['geo.nearest'] = 20
+
+""" SCORING """
+
+"""
+Weights of the factors servers are ranked on when connecting, see
+vanish.scoring. A weight of 0 ignores the factor. connect --weight overrides
+them for a single connection.
+"""
+config['scoring.weight.capacity'] = 1.0
+config['scoring.weight.rtt'] = 1.0
+config['scoring.weight.jitter'] = 1.0
+config['scoring.weight.loss'] = 1.0
+config['scoring.weight.distance'] = 0.0
+
+"""
+The number of the best ranked servers whose latency is checked, pinging them
+if their history is stale, before choosing one to connect to.
+"""
+config['scoring.candidates'] = 20
+
+"""
+How scores are computed. 'auto' uses NumPy if it's installed and pure Python
+if not; 'numpy' and 'python' force one or the other.
+"""
+config['scoring.backend'] = 'auto'
+
+""" SPREAD """
+
+"""
+Whether connect spreads nodes over servers, as --spread does, rather than
+picking the best scoring server. Each node prefers servers in its own order,
+given by weighted rendezvous hashing of its id and weighted by the servers'
+remaining capacity, and connects to the first of them that responds.
+"""
+config['spread.enabled'] = False
+
+"""
+The id of this node when spreading. None to use the machine id or, failing
+that, the hostname. Nodes must have distinct ids to be spread.
+"""
+config['spread.node'] = None
+
+""" DAEMON """
+
+"""
+Path to the Unix domain socket the vanish daemon listens on. Commands use the
+daemon transparently whenever one is listening.
+"""
+config['daemon.socket'] = os.path.join(config['config.dir'], 'daemon.sock')
+
+"""
+Seconds between the daemon pinging every server to refresh its latency table.
+"""
+config['daemon.ping.interval'] = 60
+
+""" MIRROR """
+
+"""
+URL of a vanish mirror to download the servers geojson and ovpn configs from
+instead of IPVanish, e.g. http://mirror.lan:8470. None to use IPVanish.
+"""
+config['mirror.url'] = None
+
+"""
+The address and port `vanish mirror serve` listens on.
+"""
+config['mirror.host'] = '0.0.0.0'
+config['mirror.port'] = 8470
+
+"""
+Where a mirror keeps its copies of the geojson and configs.
+"""
+config['mirror.path'] = os.path.join(config['config.dir'], 'mirror')
+
+"""
+Seconds a mirror serves its copies for before revalidating them with
+IPVanish. Requests made while that's in progress wait for it so IPVanish is
+asked at most once per artifact in this time.
+"""
+config['mirror.timeout'] = 300
+
+
+""" OPENVPN """
+
+"""
+The openvpn executable.
+"""
+config['openvpn.path'] = 'openvpn'
+
+"""
+Seconds a supervised tunnel (connect --supervise) has to connect before
+failing over to the next server.
+"""
+config['openvpn.connect.timeout'] = 30
+
+"""
+Seconds a supervised tunnel may go without receiving any traffic before it's
+considered dead and we fail over. 0 disables the check.
+"""
+config['openvpn.stall.timeout'] = 60
+
+"""
+Seconds between openvpn reporting traffic counts to a supervised connection.
+"""
+config['openvpn.bytecount.interval'] = 5
+
+"""
+The number of the best servers to start tunnels to when connecting, keeping
+whichever connects first. 1 connects to the best server alone.
+"""
+config['openvpn.race'] = 1
+
+"""
+Seconds between starting each tunnel of a race.
+"""
+config['openvpn.race.stagger'] = 0.5
+
+
 """ OVPN CONFIG """
 
 """
@@ -56,8 +262,43 @@ The location the ovpn configuration files will be stored.
 config["ovpn.configs.path"] = os.path.join(
     config['config.dir'], 'openvpn')
 
+"""
+How the ovpn configs are stored. 'files' keeps every ovpn file from the
+archive. 'templates' only stores the few distinct templates they're made from
+and renders a server's config when connecting.
+"""
+config["ovpn.configs.mode"] = 'files'
+
+"""
+Directory configs are rendered to in 'templates' mode. A tmpfs keeps them off
+disk; None uses the system temporary directory.
+"""
+config["ovpn.render.dir"] = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+"""
+The largest configs archive in bytes we'll download.
+"""
+config["ovpn.configs.max_size"] = 64 * 1024 * 1024
+
+"""
+How many times an interrupted configs download is resumed before giving up.
+"""
+config["ovpn.configs.retries"] = 3
+
 """
 The IPVanish cert file
 """
 config["ovpn.cert"] = os.path.join(
     config['ovpn.configs.path'], 'ca.ipvanish.com.crt')
+
+
+""" USER CONFIG """
+
+"""
+Path to an optional JSON file whose values override the defaults above.
+"""
+config['config.path'] = os.path.join(config['config.dir'], 'config.json')
+
+if os.path.exists(config['config.path']):
+    with open(config['config.path']) as h:
+        config.update(json.load(h))
@@ -0,0 +1,424 @@
+import json
+import os
+import signal
+import socket
+import socketserver
+import threading
+import time
+from . import trace
+from .model import Server
+"""
+This module contains the vanish daemon and the clients the CLI uses to talk
+to it.
+
+The daemon keeps the server catalogue, its indexes and a continuously
+refreshed latency table in memory and answers queries over a Unix domain
+socket. Requests and responses are single lines of JSON:
+
+    {"method": "servers", "params": {"countries": ["de"]}}
+    {"result": [...]} or {"error": "..."}
+
+The Remote* classes stand in for the services of the same name so commands
+work the same whether or not a daemon is running.
+"""
+
+
+class DaemonError(RuntimeError):
+    pass
+
+
+class DaemonClient(object):
+    def __init__(self, path, timeout=60):
+        """A connection to the vanish daemon.
+
+        :param path: Path to the daemon's socket.
+        :param timeout: Seconds to wait for a response.
+        """
+        self._path = path
+        self._timeout = timeout
+        self._socket = None
+        self._file = None
+        self._available = None
+        self._lock = threading.Lock()
+
+    @property
+    def available(self):
+        """Whether a daemon is listening, checked on first use."""
+        if self._available is None:
+            with self._lock:
+                try:
+                    self._connect()
+                    self._available = True
+                except OSError:
+                    self._available = False
+
+        return self._available
+
+    def call(self, method, **params):
+        """Call a daemon method.
+
+        :param method: The method name.
+        :param params: Keyword parameters of the method.
+        :raises DaemonError: If the daemon can't be reached or the call
+            failed.
+        :return: The decoded result.
+        """
+        request = json.dumps({'method': method, 'params': params})
+
+        with self._lock, trace.span('daemon.call', method=method):
+            try:
+                if self._socket is None:
+                    self._connect()
+
+                self._file.write(request.encode('utf-8') + b'\n')
+                self._file.flush()
+                line = self._file.readline()
+            except OSError as e:
+                self._close()
+                raise DaemonError("Daemon unavailable: {}".format(e))
+
+            if not line:
+                self._close()
+                raise DaemonError("Daemon closed the connection")
+
+        response = json.loads(line.decode('utf-8'))
+
+        if 'error' in response:
+            raise DaemonError(response['error'])
+
+        return response['result']
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self._timeout)
+
+        try:
+            sock.connect(self._path)
+        except OSError:
+            sock.close()
+            raise
+
+        self._socket = sock
+        self._file = sock.makefile('rwb')
+
+    def _close(self):
+        if self._socket is not None:
+            self._file.close()
+            self._socket.close()
+            self._socket = self._file = None
+
+
+class RemoteGeoJson(object):
+    def __init__(self, client):
+        """GeoJson served by the daemon.
+
+        :param client: A DaemonClient.
+        """
+        self._client = client
+
+    @property
+    def servers(self):
+        return [Server.fromDict(s) for s in self._client.call('servers')]
+
+    def subscribe(self, callback):
+        # The daemon keeps its own indexes up to date.
+        pass
+
+    def update(self, force=False):
+        self._client.call('update', force=force)
+
+
+class RemoteServerContainer(object):
+    def __init__(self, client):
+        """ServerContainer queries answered by the daemon.
+
+        :param client: A DaemonClient.
+        """
+        self._client = client
+
+    def getServers(self, continents=None, countries=None, regions=None,
+                   cities=None):
+        servers = self._client.call(
+            'servers', continents=continents, countries=countries,
+            regions=regions, cities=cities)
+
+        return [Server.fromDict(s) for s in servers]
+
+    def getNearest(self, latitude, longitude, count, continents=None,
+                   countries=None, regions=None, cities=None):
+        servers = self._client.call(
+            'nearest', latitude=latitude, longitude=longitude, count=count,
+            continents=continents, countries=countries, regions=regions,
+            cities=cities)
+
+        return [Server.fromDict(s) for s in servers]
+
+    def getContinents(self):
+        return self._listing('continents')
+
+    def getCountries(self, continents=None):
+        return self._listing('countries', continents=continents)
+
+    def getRegions(self, continents=None, countries=None):
+        return self._listing(
+            'regions', continents=continents, countries=countries)
+
+    def getCities(self, continents=None, countries=None, regions=None):
+        return self._listing(
+            'cities', continents=continents, countries=countries,
+            regions=regions)
+
+    def _listing(self, method, **filters):
+        return [tuple(row) for row in self._client.call(method, **filters)]
+
+
+class RemoteProber(object):
+    def __init__(self, client):
+        """A prober answering from the daemon's latency table.
+
+        Addresses the daemon hasn't probed recently are probed on demand.
+
+        :param client: A DaemonClient.
+        """
+        self._client = client
+
+    def probe(self, addresses, count=1):
+        return dict(self.iprobe(addresses, count))
+
+    def iprobe(self, addresses, count=1):
+        from .probe import LatencyStats
+
+        results = self._client.call(
+            'ping', addresses=list(addresses), count=count)
+
+        for address, samples in results.items():
+            yield address, LatencyStats(samples)
+
+
+class RemoteLatencyHistory(object):
+    def __init__(self, client):
+        """The daemon's latency history.
+
+        :param client: A DaemonClient.
+        """
+        self._client = client
+
+    def record(self, servers, now=None):
+        # The daemon records every probe it makes itself.
+        return {}
+
+    def scores(self, hostnames):
+        from .history import Score
+
+        scores = self._client.call('scores', hostnames=list(hostnames))
+
+        return {h: Score(h, *values) for h, values in scores.items()}
+
+
+class Daemon(object):
+    def __init__(self, services, path):
+        """Serve vanish queries over a Unix domain socket.
+
+        :param services: The application ServiceProvider. The daemon uses
+            the local.* services so it never talks to itself.
+        :param path: Path to create the socket at.
+        """
+        self._services = services
+        self._config = services['config']
+        self._path = path
+        self._latency = {}
+        self._lock = threading.Lock()
+        self._server = None
+        self._stop = threading.Event()
+        self.ready = threading.Event()
+
+    def serve(self):
+        """Serve until shutdown() is called or the process is terminated."""
+        self._removeStale()
+
+        self._services['local.geojson'].update()
+        self._services['local.servers']
+
+        self._server = _UnixServer(self._path, _Handler)
+        self._server.daemon = self
+        os.chmod(self._path, 0o600)
+
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda *args: threading.Thread(
+                target=self.shutdown).start())
+
+        workers = [
+            threading.Thread(target=self._refresh, daemon=True),
+            threading.Thread(target=self._monitor, daemon=True)
+        ]
+
+        for worker in workers:
+            worker.start()
+
+        self.ready.set()
+
+        try:
+            self._server.serve_forever()
+        finally:
+            self._stop.set()
+            self._server.server_close()
+
+            if os.path.exists(self._path):
+                os.unlink(self._path)
+
+    def shutdown(self):
+        self._stop.set()
+
+        if self._server is not None:
+            self._server.shutdown()
+
+    def dispatch(self, method, params):
+        """Call the daemon method named method.
+
+        :raises KeyError: If there's no such method.
+        """
+        if method not in self.METHODS:
+            raise KeyError("Unknown method {}".format(method))
+
+        return getattr(self, '_' + method)(**params)
+
+    METHODS = ('status', 'update', 'servers', 'nearest', 'continents',
+               'countries', 'regions', 'cities', 'ping', 'scores')
+
+    def _status(self):
+        return {
+            'pid': os.getpid(),
+            'servers': len(self._services['local.servers'].getServers()),
+            'probed': len(self._latency)
+        }
+
+    def _update(self, force=False):
+        self._services['local.geojson'].update(force)
+
+    def _servers(self, **filters):
+        servers = self._services['local.servers'].getServers(**filters)
+        return [s.toDict() for s in servers]
+
+    def _nearest(self, latitude, longitude, count, **filters):
+        servers = self._services['local.servers'].getNearest(
+            latitude, longitude, count, **filters)
+        return [s.toDict() for s in servers]
+
+    def _continents(self):
+        return self._services['local.servers'].getContinents()
+
+    def _countries(self, **filters):
+        return self._services['local.servers'].getCountries(**filters)
+
+    def _regions(self, **filters):
+        return self._services['local.servers'].getRegions(**filters)
+
+    def _cities(self, **filters):
+        return self._services['local.servers'].getCities(**filters)
+
+    def _ping(self, addresses, count=None):
+        """Latency samples of addresses, probing those that are stale."""
+        fresh = self._fresh(addresses)
+        stale = [a for a in addresses if a not in fresh]
+
+        if stale:
+            fresh.update(self._measure(stale, count))
+
+        return {a: stats.samples for a, stats in fresh.items()}
+
+    def _scores(self, hostnames):
+        scores = self._services['local.history'].scores(hostnames)
+
+        return {h: [s.rtt, s.jitter, s.loss, s.updated, s.probes]
+                for h, s in scores.items()}
+
+    def _fresh(self, addresses):
+        deadline = time.time() - self._config['history.max_age']
+
+        with self._lock:
+            return {a: self._latency[a][0] for a in addresses
+                    if a in self._latency and self._latency[a][1] > deadline}
+
+    def _measure(self, addresses, count=None):
+        """Probe addresses, updating the latency table and history."""
+        count = count or self._config['ping.count']
+        results = {}
+
+        for address, stats in self._services['local.prober'].iprobe(
+                addresses, count):
+            results[address] = stats
+
+            with self._lock:
+                self._latency[address] = (stats, time.time())
+
+        # The servers are shared by every thread so their latency isn't set,
+        # another measurement could overwrite it before it's recorded.
+        latencies = {s.hostname: results[s.ip]
+                     for s in self._services['local.servers'].getServers()
+                     if s.ip in results}
+
+        self._services['local.history'].recordLatency(latencies)
+
+        return results
+
+    def _refresh(self):
+        interval = max(1, self._config['geojson.cache.timeout'])
+
+        while not self._stop.wait(interval):
+            try:
+                self._services['local.geojson'].update()
+            except Exception as e:
+                print("Failed to update servers: {}".format(e))
+
+    def _monitor(self):
+        interval = self._config['daemon.ping.interval']
+
+        while not self._stop.is_set():
+            servers = self._services['local.servers'].getServers()
+
+            try:
+                self._measure([s.ip for s in servers])
+            except Exception as e:
+                print("Failed to ping servers: {}".format(e))
+
+            self._stop.wait(interval)
+
+    def _removeStale(self):
+        """Remove a socket left behind by a daemon that didn't exit cleanly.
+
+        :raises DaemonError: If another daemon is listening on the socket.
+        """
+        if not os.path.exists(self._path):
+            return
+
+        client = DaemonClient(self._path)
+
+        if client.available:
+            client.close()
+            raise DaemonError(
+                "A daemon is already listening on {}".format(self._path))
+
+        os.unlink(self._path)
+
+
+class _UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode('utf-8'))
+                result = self.server.daemon.dispatch(
+                    request['method'], request.get('params') or {})
+                response = {'result': result}
+            except Exception as e:
+                response = {'error': "{}: {}".format(type(e).__name__, e)}
+
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+            self.wfile.flush()
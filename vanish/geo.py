@@ -0,0 +1,134 @@
+import heapq
+import math
+"""
+This module finds the servers nearest to a point on the globe.
+
+Coordinates are mapped on to the unit sphere and indexed in a 3-d k-d tree.
+The straight line distance between two points on the sphere grows with the
+great circle distance between them, so the nearest points by one are the
+nearest by the other and queries don't need to worry about the poles or the
+antimeridian.
+"""
+
+"""
+The mean radius of the Earth in km.
+"""
+EARTH_RADIUS = 6371.0
+
+
+def parse(value):
+    """Parse a LAT,LON string.
+
+    :raises ValueError: If it isn't a valid pair of coordinates.
+    :return: A (latitude, longitude) tuple of floats.
+    """
+    try:
+        latitude, longitude = (float(v) for v in value.split(','))
+    except ValueError:
+        raise ValueError("expected LAT,LON, got '{}'".format(value))
+
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError("coordinates out of range: '{}'".format(value))
+
+    return latitude, longitude
+
+
+def distance(origin, latitude, longitude):
+    """The great circle distance between two points in km.
+
+    :param origin: A (latitude, longitude) tuple.
+    :return: The distance or None if either coordinate is unknown.
+    """
+    if latitude is None or longitude is None:
+        return None
+
+    return _chordToKm(_chord(_point(*origin), _point(latitude, longitude)))
+
+
+def _point(latitude, longitude):
+    latitude, longitude = math.radians(latitude), math.radians(longitude)
+    cos = math.cos(latitude)
+
+    return (cos * math.cos(longitude), cos * math.sin(longitude),
+            math.sin(latitude))
+
+
+def _chord(a, b):
+    return math.sqrt((a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2
+                     + (a[2] - b[2]) ** 2)
+
+
+def _chordToKm(chord):
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, chord / 2))
+
+
+class KdTree(object):
+    def __init__(self, coordinates):
+        """A k-d tree over points on the globe.
+
+        :param coordinates: A list of (latitude, longitude) tuples. Points
+            are identified by their position in the list and those with a
+            None coordinate are left out.
+        """
+        self._points = [
+            (_point(lat, lon), i) for i, (lat, lon) in enumerate(coordinates)
+            if lat is not None and lon is not None]
+        # Nodes are (point, id, axis, left, right) tuples.
+        self._root = self._build(self._points, 0)
+
+    def __len__(self):
+        return len(self._points)
+
+    def nearest(self, origin, count):
+        """The count points nearest to origin.
+
+        :param origin: A (latitude, longitude) tuple.
+        :param count: The number of points to find.
+        :return: A list of (km, id) tuples, nearest first.
+        """
+        if count <= 0:
+            return []
+
+        target = _point(*origin)
+        # A max heap of the best found so far, as (-chord, -id).
+        best = []
+        # Subtrees to search with a lower bound on their distance from target.
+        stack = [(self._root, 0.0)]
+
+        while stack:
+            node, bound = stack.pop()
+
+            if node is None or (len(best) == count and bound >= -best[0][0]):
+                continue
+
+            point, id, axis, left, right = node
+
+            item = (-_chord(target, point), -id)
+
+            if len(best) < count:
+                heapq.heappush(best, item)
+            elif item > best[0]:
+                heapq.heapreplace(best, item)
+
+            difference = target[axis] - point[axis]
+            near, far = (left, right) if difference < 0 else (right, left)
+            # Searching the near side first tightens the bound before the far
+            # side is considered.
+            stack.append((far, max(bound, abs(difference))))
+            stack.append((near, bound))
+
+        return sorted((_chordToKm(-chord), -id) for chord, id in best)
+
+    @classmethod
+    def _build(cls, points, depth):
+        if not points:
+            return None
+
+        axis = depth % 3
+        points = sorted(points, key=lambda p: p[0][axis])
+        middle = len(points) // 2
+        point, id = points[middle]
+
+        return (point, id, axis,
+                cls._build(points[:middle], depth + 1),
+                cls._build(points[middle + 1:], depth + 1))
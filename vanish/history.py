@@ -0,0 +1,218 @@
+import os
+import sqlite3
+import threading
+import time
+"""
+This module keeps a durable history of latency probes so servers can be
+ranked without probing them again.
+
+Every probe result is recorded against the server's hostname and folded into
+an exponentially weighted moving average (EWMA) of its round trip time,
+jitter and loss. Recent probes therefore count for more than old ones and a
+single bad sample doesn't sink a good server.
+"""
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    hostname TEXT NOT NULL,
+    time REAL NOT NULL,
+    sent INTEGER NOT NULL,
+    received INTEGER NOT NULL,
+    median REAL,
+    jitter REAL
+);
+CREATE INDEX IF NOT EXISTS samples_hostname ON samples (hostname, time);
+CREATE TABLE IF NOT EXISTS scores (
+    hostname TEXT PRIMARY KEY,
+    rtt REAL,
+    jitter REAL,
+    loss REAL NOT NULL,
+    updated REAL NOT NULL,
+    probes INTEGER NOT NULL
+);
+"""
+
+
+class Score(object):
+    __slots__ = ('hostname', 'rtt', 'jitter', 'loss', 'updated', 'probes')
+
+    def __init__(self, hostname, rtt, jitter, loss, updated, probes):
+        """The weighted latency history of a server.
+
+        :param hostname: The server's hostname.
+        :param rtt: Weighted median round trip time in ms or None if the
+            server has never replied.
+        :param jitter: Weighted jitter in ms or None.
+        :param loss: Weighted loss ratio.
+        :param updated: When the server was last probed, seconds since the
+            epoch.
+        :param probes: The number of probes recorded.
+        """
+        self.hostname = hostname
+        self.rtt = rtt
+        self.jitter = jitter
+        self.loss = loss
+        self.updated = updated
+        self.probes = probes
+
+    @property
+    def value(self):
+        """A figure for ranking servers, lower is better.
+
+        Computed the same way as probe.LatencyStats.score so scores from the
+        history and from fresh probes are comparable.
+        """
+        if self.rtt is None or self.loss >= 1:
+            return float('inf')
+
+        return (self.rtt + self.jitter) / (1 - self.loss)
+
+    def age(self, now=None):
+        return (time.time() if now is None else now) - self.updated
+
+    def __repr__(self):
+        return "Score({!r}, rtt={!r}, loss={!r})".format(
+            self.hostname, self.rtt, self.loss)
+
+
+class LatencyHistory(object):
+    def __init__(self, path, alpha=0.3, retention=30 * 24 * 60 * 60):
+        """A SQLite store of latency probes.
+
+        :param path: Path to the database, created if it doesn't exist.
+        :param alpha: Weight of the newest probe in the moving averages,
+            between 0 and 1.
+        :param retention: Seconds raw samples are kept for. Scores are kept
+            indefinitely.
+        """
+        if not 0 < alpha <= 1:
+            raise ValueError("alpha must be in (0, 1]")
+
+        self._path = path
+        self._alpha = alpha
+        self._retention = retention
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def record(self, servers, now=None):
+        """Record the latency of servers that have been probed.
+
+        :param servers: Servers with their latency set, those without are
+            ignored.
+        :param now: The time of the probes; defaults to the current time.
+        :return: A dictionary of {hostname: Score} of the updated scores.
+        """
+        return self.recordLatency(
+            {s.hostname: s.latency for s in servers if s.latency is not None},
+            now)
+
+    def recordLatency(self, latencies, now=None):
+        """Record the latency of servers by hostname, see record().
+
+        :param latencies: A dictionary of {hostname: LatencyStats}.
+        """
+        now = time.time() if now is None else now
+
+        with self._lock, self._connect() as db:
+            previous = self._scores(db, list(latencies))
+            scores = {}
+
+            for hostname, latency in latencies.items():
+                score = self._update(
+                    previous.get(hostname), hostname, latency, now)
+                scores[hostname] = score
+
+                db.execute(
+                    "INSERT INTO samples VALUES (?, ?, ?, ?, ?, ?)",
+                    (hostname, now, latency.sent, latency.received,
+                     latency.median, latency.jitter))
+                db.execute(
+                    "INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?, ?, ?)",
+                    (score.hostname, score.rtt, score.jitter, score.loss,
+                     score.updated, score.probes))
+
+            db.execute("DELETE FROM samples WHERE time < ?",
+                       (now - self._retention,))
+
+        return scores
+
+    def scores(self, hostnames):
+        """Look up the scores of servers.
+
+        :param hostnames: An iterable of hostnames.
+        :return: A dictionary of {hostname: Score} for the hostnames that have
+            been probed before.
+        """
+        with self._lock, self._connect() as db:
+            return self._scores(db, list(hostnames))
+
+    def samples(self, hostname):
+        """The raw samples recorded for a server, oldest first.
+
+        :param hostname: The server's hostname.
+        :return: A list of (time, sent, received, median, jitter) tuples.
+        """
+        with self._lock, self._connect() as db:
+            return db.execute(
+                "SELECT time, sent, received, median, jitter FROM samples "
+                "WHERE hostname = ? ORDER BY time", (hostname,)).fetchall()
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def _update(self, score, hostname, latency, now):
+        loss = latency.loss
+
+        if score is None:
+            return Score(hostname, latency.median, latency.jitter, loss, now,
+                         1)
+
+        alpha = self._alpha
+        rtt, jitter = score.rtt, score.jitter
+
+        # Only replies carry round trip times, a lost probe just adds to the
+        # loss.
+        if latency.received:
+            if rtt is None:
+                rtt, jitter = latency.median, latency.jitter
+            else:
+                rtt = alpha * latency.median + (1 - alpha) * rtt
+                jitter = alpha * latency.jitter + (1 - alpha) * jitter
+
+        loss = alpha * loss + (1 - alpha) * score.loss
+
+        return Score(hostname, rtt, jitter, loss, now, score.probes + 1)
+
+    def _scores(self, db, hostnames):
+        scores = {}
+
+        # Stay well within SQLite's limit on the number of parameters.
+        for i in range(0, len(hostnames), 500):
+            batch = hostnames[i:i + 500]
+            rows = db.execute(
+                "SELECT hostname, rtt, jitter, loss, updated, probes "
+                "FROM scores WHERE hostname IN ({})".format(
+                    ", ".join("?" * len(batch))),
+                batch)
+
+            for row in rows:
+                scores[row[0]] = Score(*row)
+
+        return scores
+
+    def _connect(self):
+        if self._connection is None:
+            directory = os.path.dirname(os.path.abspath(self._path))
+            os.makedirs(directory, exist_ok=True)
+
+            connection = sqlite3.connect(
+                self._path, timeout=5, check_same_thread=False)
+            # WAL lets other vanish processes read while we write.
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(_SCHEMA)
+            self._connection = connection
+
+        return self._connection
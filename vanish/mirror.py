@@ -0,0 +1,399 @@
+import gzip
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from . import trace, utils
+"""
+This module lets one host fetch the server catalogue and ovpn configs from
+IPVanish and serve them to the rest of a fleet.
+
+`vanish mirror serve` keeps a copy of each artifact and serves it over HTTP
+with an ETag, honouring If-None-Match and Range requests, so clients
+revalidate and resume against the mirror exactly as they do against
+IPVanish. A copy older than mirror.timeout is revalidated with IPVanish on
+the next request for it. Requests arriving while that's in flight wait for
+it rather than making their own, so IPVanish sees at most one request per
+artifact per mirror.timeout however many clients there are.
+
+Clients are pointed at a mirror by setting mirror.url in their config.
+"""
+
+"""
+The artifacts a mirror serves, by name, and the config key of the upstream
+URL they're fetched from.
+"""
+ARTIFACTS = {
+    'servers.geojson': 'geojson.url',
+    'configs.zip': 'ovpn.configs.url'
+}
+
+
+def url(config, key):
+    """The URL to download the artifact at config[key] from.
+
+    :param config: The application config.
+    :param key: One of the ARTIFACTS config keys.
+    :return: The artifact's URL on the mirror if mirror.url is set, otherwise
+        config[key].
+    """
+    if not config.get('mirror.url'):
+        return config[key]
+
+    name = [n for n, k in ARTIFACTS.items() if k == key][0]
+
+    return "{}/{}".format(config['mirror.url'].rstrip('/'), name)
+
+
+class MirrorError(RuntimeError):
+    pass
+
+
+class Mirror(object):
+    """
+    Compress artifacts with names ending in these when they're fetched so
+    clients accepting gzip are sent the smaller copy.
+    """
+    COMPRESS = ('.geojson',)
+
+    CHUNK_SIZE = 65536
+
+    def __init__(self, artifacts, path, timeout=300):
+        """A local copy of artifacts kept up to date with their upstream.
+
+        Each artifact is stored in path alongside a .meta file recording
+        its ETag, the upstream validators and when it was last checked.
+
+        :param artifacts: A dictionary of {name: upstream url}.
+        :param path: Directory to keep the copies in.
+        :param timeout: Seconds a copy is served before it's revalidated.
+        """
+        self._artifacts = artifacts
+        self._path = path
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._flight = utils.SingleFlight()
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    @property
+    def names(self):
+        return sorted(self._artifacts)
+
+    def refresh(self, name, force=False):
+        """Revalidate the copy of name if it's expired.
+
+        Concurrent refreshes of the same artifact are coalesced. If IPVanish
+        can't be reached the current copy is kept and checked again once it
+        expires.
+
+        :param force: Revalidate the copy even if it hasn't expired.
+        :raises KeyError: If name isn't an artifact.
+        :raises MirrorError: If there's no copy and it can't be fetched.
+        :return: The artifact's metadata.
+        """
+        if name not in self._artifacts:
+            raise KeyError(name)
+
+        meta = self._readMeta(name)
+
+        if not force and self._isFresh(meta):
+            return meta
+
+        return self._flight.do(name, lambda: self._refresh(name, force))
+
+    def open(self, name, encoding=None):
+        """Open the current copy of name, refreshing it first if expired.
+
+        :param encoding: 'gzip' to open the compressed copy, if there is one.
+        :return: A (meta, file) tuple; file is None if there's no such
+            encoding. The caller closes the file.
+        """
+        self.refresh(name)
+
+        # Opened under the lock so the file always matches its metadata.
+        with self._lock:
+            meta = self._readMeta(name)
+
+            if encoding is not None and encoding not in meta['encodings']:
+                return meta, None
+
+            return meta, open(self._file(name, encoding), 'rb')
+
+    def _refresh(self, name, force):
+        meta = self._readMeta(name)
+
+        if not force and self._isFresh(meta):
+            return meta
+
+        import requests
+
+        headers = {}
+
+        if 'upstream-etag' in meta:
+            headers['If-None-Match'] = meta['upstream-etag']
+
+        if 'last-modified' in meta:
+            headers['If-Modified-Since'] = meta['last-modified']
+
+        try:
+            with trace.span('mirror.request', artifact=name) as span:
+                response = requests.get(
+                    self._artifacts[name], headers=headers, stream=True,
+                    timeout=30)
+                span.set(status=response.status_code)
+
+            with response:
+                if response.status_code != 304:
+                    response.raise_for_status()
+
+                    with trace.span('mirror.download', artifact=name):
+                        return self._download(name, response)
+        except requests.RequestException as e:
+            if 'etag' not in meta:
+                raise MirrorError("Unable to fetch {}: {}".format(name, e))
+
+            print("Unable to refresh {}, serving the copy from {}: {}".format(
+                name, time.ctime(meta['fetched']), e), file=sys.stderr)
+
+        meta['checked'] = time.time()
+
+        with self._lock:
+            self._writeMeta(name, meta)
+
+        return meta
+
+    def _download(self, name, response):
+        """Stream response into new copies of name and swap them into place.
+
+        :return: The new metadata.
+        """
+        paths = {None: self._file(name)}
+
+        if name.endswith(self.COMPRESS):
+            paths['gzip'] = self._file(name, 'gzip')
+
+        digest = hashlib.sha1()
+        size = 0
+        files = {}
+
+        try:
+            files[None] = open(paths[None] + '.tmp', 'wb')
+
+            if 'gzip' in paths:
+                files['gzip'] = gzip.open(paths['gzip'] + '.tmp', 'wb')
+
+            for chunk in response.iter_content(self.CHUNK_SIZE):
+                digest.update(chunk)
+                size += len(chunk)
+
+                for h in files.values():
+                    h.write(chunk)
+        except BaseException:
+            for encoding, h in files.items():
+                h.close()
+                os.remove(paths[encoding] + '.tmp')
+
+            raise
+
+        for h in files.values():
+            h.close()
+
+        meta = {
+            'etag': digest.hexdigest(),
+            'size': size,
+            'encodings': [e for e in paths if e],
+            'fetched': time.time(),
+            'checked': time.time(),
+            'upstream-etag': response.headers.get('ETag'),
+            'last-modified': response.headers.get('Last-Modified')
+        }
+
+        with self._lock:
+            for path in paths.values():
+                os.replace(path + '.tmp', path)
+
+            self._writeMeta(name, meta)
+
+        return meta
+
+    def _isFresh(self, meta):
+        return ('etag' in meta
+                and time.time() - meta.get('checked', 0) < self._timeout)
+
+    def _file(self, name, encoding=None):
+        path = os.path.join(self._path, name)
+        return path + '.gz' if encoding == 'gzip' else path
+
+    def _readMeta(self, name):
+        try:
+            with open(self._file(name) + '.meta') as h:
+                meta = json.load(h)
+        except (IOError, ValueError):
+            return {}
+
+        # A copy missing since the meta was written has to be fetched again.
+        if not os.path.exists(self._file(name)):
+            return {}
+
+        return meta
+
+    def _writeMeta(self, name, meta):
+        path = self._file(name) + '.meta'
+
+        with open(path + '.tmp', 'w') as h:
+            json.dump({k: v for k, v in meta.items() if v is not None}, h)
+
+        os.replace(path + '.tmp', path)
+
+
+class MirrorServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, mirror, address):
+        """Serve the artifacts of mirror over HTTP.
+
+        :param mirror: A Mirror.
+        :param address: A (host, port) tuple to listen on; port 0 picks a
+            free port.
+        """
+        super(MirrorServer, self).__init__(address, _Handler)
+        self.mirror = mirror
+        self.ready = threading.Event()
+
+    def url(self, path=''):
+        host, port = self.server_address[:2]
+        return "http://{}:{}/{}".format(
+            '127.0.0.1' if host == '0.0.0.0' else host, port, path)
+
+    def serve(self):
+        """Fetch every artifact then serve until shutdown() is called.
+
+        Artifacts that can't be fetched yet are fetched when first
+        requested.
+        """
+        for name in self.mirror.names:
+            try:
+                self.mirror.refresh(name)
+            except MirrorError as e:
+                print(e, file=sys.stderr)
+
+        self.ready.set()
+
+        try:
+            self.serve_forever()
+        finally:
+            self.server_close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    _RANGE = re.compile(r'^bytes=(\d+)-(\d*)$')
+
+    def do_HEAD(self):
+        self._serve(body=False)
+
+    def do_GET(self):
+        self._serve(body=True)
+
+    def _serve(self, body):
+        name = self.path.split('?')[0].lstrip('/')
+
+        if name not in self.server.mirror.names:
+            self.send_error(404)
+            return
+
+        accepts = self.headers.get('Accept-Encoding', '')
+        encoding = 'gzip' if 'gzip' in accepts else None
+
+        try:
+            meta, h = self.server.mirror.open(name, encoding)
+
+            if h is None:
+                encoding = None
+                meta, h = self.server.mirror.open(name)
+        except MirrorError as e:
+            self.send_error(502, str(e))
+            return
+
+        with h:
+            self._send(meta, h, encoding, body)
+
+    def _send(self, meta, h, encoding, body):
+        etag = '"{}"'.format(meta['etag'])
+        # Each encoding is a different representation so has its own tag.
+        tag = '"{}-gzip"'.format(meta['etag']) if encoding else etag
+        matches = [t.strip() for t in
+                   self.headers.get('If-None-Match', '').split(',')]
+
+        if '*' in matches or etag in matches or tag in matches:
+            self.send_response(304)
+            self._headers(meta, tag)
+            self.end_headers()
+            return
+
+        size = os.fstat(h.fileno()).st_size
+        start, end = 0, size - 1
+        range = self._RANGE.match(self.headers.get('Range', ''))
+
+        # A reversed range is invalid and ignored, as if there was no Range.
+        if (range and range.group(2)
+                and int(range.group(2)) < int(range.group(1))):
+            range = None
+
+        if (range and encoding is None
+                and self.headers.get('If-Range', etag) == etag):
+            start = int(range.group(1))
+            end = min(int(range.group(2) or end), end)
+
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{}'.format(size))
+                self.end_headers()
+                return
+
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                start, end, size))
+        else:
+            range = None
+            self.send_response(200)
+
+        self._headers(meta, tag)
+
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+
+        if body:
+            h.seek(start)
+            _copy(h, self.wfile, end - start + 1)
+
+    def _headers(self, meta, tag):
+        self.send_header('ETag', tag)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Vary', 'Accept-Encoding')
+
+        if 'last-modified' in meta:
+            self.send_header('Last-Modified', meta['last-modified'])
+
+    def log_message(self, *args):
+        pass
+
+
+def _copy(source, dest, length):
+    while length > 0:
+        chunk = source.read(min(Mirror.CHUNK_SIZE, length))
+
+        if not chunk:
+            break
+
+        dest.write(chunk)
+        length -= len(chunk)
@@ -1,105 +1,743 @@
-import requests
+import codecs
+import contextlib
+import heapq
 import os
-import tempfile
-import zipfile
 import re
 import shutil
 import json
-import subprocess
 import sys
+import time
+import zlib
+from . import geo, snapshot, trace, utils
+
+# requests, zipfile, tempfile, subprocess and the probes are slow to import
+# and most commands never need them so they're imported where they're used.
+
+
+class Server(object):
+    """A single IPVanish server.
+
+    Location strings are interned as they're shared by many servers and the
+    names derived from the hostname are computed once up front.
+    """
+
+    FIELDS = ('continent', 'continentCode', 'country', 'countryCode',
+              'region', 'regionCode', 'regionAbbr', 'city', 'title',
+              'hostname', 'ip', 'capacity', 'latitude', 'longitude')
+
+    _INTERNED = ('continent', 'continentCode', 'country', 'countryCode',
+                 'region', 'regionCode', 'regionAbbr', 'city', 'title')
+
+    __slots__ = FIELDS + ('name', 'handle', 'ovpnFile', 'latency')
+
+    def __init__(self, **fields):
+        """Server.
+
+        :param **fields: A value for each of Server.FIELDS. Missing strings
+            default to empty, capacity to 0 and coordinates to None.
+        """
+        for field in self._INTERNED:
+            setattr(self, field, sys.intern(fields.get(field) or ''))
+
+        self.hostname = fields.get('hostname') or ''
+        self.ip = fields.get('ip') or ''
+        self.capacity = fields.get('capacity') or 0
+        self.latitude = fields.get('latitude')
+        self.longitude = fields.get('longitude')
+
+        self.name = self.hostname.split('.')[0]
+        self.handle = "{}-{}".format(self.countryCode, self.name).lower()
+        self.ovpnFile = "{}.ovpn".format(self.handle)
+        self.latency = None
+
+    @classmethod
+    def fromDict(cls, properties):
+        return cls(**{f: properties.get(f) for f in cls.FIELDS})
+
+    @classmethod
+    def fromFeature(cls, feature):
+        """A server from a servers.geojson feature.
+
+        GeoJSON points are [longitude, latitude].
+        """
+        server = cls.fromDict(feature['properties'])
+        coordinates = (feature.get('geometry') or {}).get('coordinates')
+
+        if coordinates and len(coordinates) >= 2:
+            server.longitude, server.latitude = coordinates[:2]
+
+        return server
+
+    def toDict(self):
+        return {f: getattr(self, f) for f in self.FIELDS}
+
+    @property
+    def rtt(self):
+        """The median round trip time of the last ping or None."""
+        return self.latency.median if self.latency else None
+
+    def __repr__(self):
+        return "Server({!r})".format(self.hostname)
 
 
 class GeoJson(object):
-    def __init__(self, url, cache_path):
+    """IPVanish server information, cached and kept up to date."""
+
+    # Bump CACHE_VERSION whenever the fields kept in the cache change so
+    # caches written by older versions are downloaded again rather than
+    # revalidated.
+    CACHE_VERSION = 2
+
+    def __init__(self, url, cache_path, timeout=0, snapshot_path=None,
+                 index_path=None):
+        """IPVanish server information.
+
+        The servers are cached at cache_path. The cache is considered fresh
+        for timeout seconds after which update() revalidates it with the
+        server using the ETag and Last-Modified headers of the last download.
+
+        A binary snapshot of the servers is written alongside the cache
+        when snapshot_path is given and loaded in preference to the JSON.
+        Likewise a completion index of location names is written to
+        index_path when given.
+
+        The servers are loaded, or downloaded if there's no cache, when
+        first used. Concurrent loads and updates are coalesced so each runs
+        once and callbacks registered with subscribe() are given the new
+        servers whenever they change.
+
+        :param url: URL to the servers geojson.
+        :param cache_path: Path to cache the servers.
+        :param timeout: Seconds the cache is fresh for.
+        :param snapshot_path: Path to a snapshot of the cache.
+        :param index_path: Path to a completion index of the cache.
+        """
         self._url = url
         self._cache_path = cache_path
+        self._meta_path = cache_path + '.meta'
+        self._snapshot_path = snapshot_path
+        self._index_path = index_path
+        self._timeout = timeout
+        self._servers = None
+        self._subscribers = []
+        self._flight = utils.SingleFlight()
 
-        if not os.path.exists(self._cache_path):
-            self.update()
-        else:
-            with open(self._cache_path) as f:
-                self.servers = json.load(f)
+        cache_dir = os.path.dirname(os.path.abspath(self._cache_path))
+
+        if not os.path.isdir(cache_dir):
+            print("Invalid path {}".format(self._cache_path), file=sys.stderr)
+            raise FileNotFoundError(cache_dir)
 
-    def update(self):
-        response = requests.get(self._url, allow_redirects=True).json()
+    @property
+    def servers(self):
+        if self._servers is None:
+            self._flight.do('load', self._initialLoad)
 
-        servers = []
-        for server in response:
-            properties = server["properties"]
+        return self._servers
 
-            properties.pop("marker-color")
-            properties.pop("marker-cluster-small")
+    def subscribe(self, callback):
+        """Call callback with the list of servers whenever it changes.
 
-            # The GB code isn't present in the ovpn configurations so upgrade
-            # to UK which includes GB.
-            if properties['countryCode'] == "GB":
-                properties.update({"countryCode": "UK"})
+        :param callback: Takes the new list of servers.
+        """
+        self._subscribers.append(callback)
+
+    def update(self, force=False):
+        """Update the servers if the cache has expired.
+
+        :param force: Revalidate the cache even if it's fresh.
+        """
+        with trace.span('geojson.update', force=force):
+            # Forced updates don't join an unforced one, which may find the
+            # cache fresh and skip revalidating it.
+            return self._flight.do(
+                ('update', force), lambda: self._update(force))
 
-            servers.append(properties)
+    def _update(self, force):
+        if not force and self._isFresh():
+            return
+
+        headers = {'Accept-Encoding': 'gzip'}
+
+        meta = self._readMeta() if os.path.exists(self._cache_path) else {}
+
+        if meta.get('version') == self.CACHE_VERSION:
+            if 'etag' in meta:
+                headers['If-None-Match'] = meta['etag']
+
+            if 'last-modified' in meta:
+                headers['If-Modified-Since'] = meta['last-modified']
+
+        with trace.span('geojson.request') as span:
+            import requests
+
+            response = requests.get(
+                self._url, headers=headers, allow_redirects=True, stream=True)
+            span.set(status=response.status_code)
+
+        with response:
+            if response.status_code == 304:
+                os.utime(self._cache_path, None)
+
+                if (self._snapshot_path
+                        and os.path.exists(self._snapshot_path)):
+                    os.utime(self._snapshot_path, None)
+
+                return
+
+            response.raise_for_status()
+
+            with trace.span('geojson.download') as span:
+                servers = self._download(response)
+                span.set(servers=len(servers))
+
+        self._writeIndexes(servers)
+        self._writeMeta({
+            'version': self.CACHE_VERSION,
+            'etag': response.headers.get('ETag'),
+            'last-modified': response.headers.get('Last-Modified')
+        })
+
+        self._setServers(servers)
+
+    def _download(self, response):
+        """Stream the servers from response into the cache.
+
+        Features are decoded one at a time and only the fields of a Server,
+        including its coordinates, are kept. The cache is written to a
+        temporary file as we go and moved into place once the download
+        completes.
+
+        :param response: A streaming requests response.
+        :return: A list of servers.
+        """
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        chunks = (decoder.decode(c) for c in response.iter_content(65536))
+        temp_path = self._cache_path + '.tmp'
+        servers = []
 
         try:
-            with open(self._cache_path, 'w+') as h:
-                json.dump(servers, h, indent=4)
+            with open(temp_path, 'w') as h:
+                h.write('[')
+
+                for feature in utils.json_array_items(chunks):
+                    properties = feature["properties"]
+
+                    # The GB code isn't present in the ovpn configurations so
+                    # upgrade to UK which includes GB.
+                    if properties['countryCode'] == "GB":
+                        properties['countryCode'] = "UK"
+
+                    server = Server.fromFeature(feature)
+
+                    h.write(',\n' if servers else '\n')
+                    json.dump(server.toDict(), h)
+                    servers.append(server)
+
+                h.write('\n]\n')
         except FileNotFoundError as e:
             print("Invalid path {}".format(self._cache_path), file=sys.stderr)
             raise e
+        except BaseException:
+            os.remove(temp_path)
+            raise
 
-        self.servers = servers
+        os.replace(temp_path, self._cache_path)
+
+        return servers
+
+    def _setServers(self, servers):
+        self._servers = servers
+
+        for callback in self._subscribers:
+            callback(servers)
+
+    def _initialLoad(self):
+        if self._servers is not None:
+            return
+
+        if os.path.exists(self._cache_path):
+            self._load()
+        else:
+            self.update()
+
+    def _load(self):
+        """Load the servers from the snapshot falling back to the cache."""
+        if self._hasSnapshot():
+            try:
+                with trace.span('geojson.load', source='snapshot'):
+                    servers = snapshot.load(self._snapshot_path)
+
+                self._setServers(servers)
+                return
+            except snapshot.SnapshotError:
+                pass
+
+        with trace.span('geojson.load', source='json'):
+            with open(self._cache_path) as f:
+                servers = [Server.fromDict(s) for s in json.load(f)]
+
+        self._writeIndexes(servers)
+        self._setServers(servers)
+
+    def _writeIndexes(self, servers):
+        """Write the snapshot and completion index of servers."""
+        if self._snapshot_path:
+            with trace.span('geojson.snapshot'):
+                snapshot.dump(servers, self._snapshot_path)
+
+        if self._index_path:
+            from . import completion
+
+            with trace.span('geojson.completion'):
+                completion.dump(servers, self._index_path)
+
+    def _hasSnapshot(self):
+        # A snapshot older than the cache wasn't written from it.
+        return (self._snapshot_path is not None
+                and os.path.exists(self._snapshot_path)
+                and os.path.getmtime(self._snapshot_path)
+                >= os.path.getmtime(self._cache_path))
+
+    def _isFresh(self):
+        if not os.path.exists(self._cache_path):
+            return False
+
+        age = time.time() - os.path.getmtime(self._cache_path)
+
+        return age < self._timeout
+
+    def _readMeta(self):
+        try:
+            with open(self._meta_path) as h:
+                return json.load(h)
+        except (IOError, ValueError):
+            return {}
+
+    def _writeMeta(self, meta):
+        with open(self._meta_path, 'w') as h:
+            json.dump({k: v for k, v in meta.items() if v}, h)
+
+
+class DownloadError(RuntimeError):
+    pass
 
 
 class OvpnConfigs(object):
-    def __init__(self, url, path):
+    """The IPVanish OpenVPN configuration files.
+
+    Syncing only writes the files that changed in the IPVanish archive. The
+    new set of files is built in a staging directory, where unchanged files
+    are hard links to the current ones, and then swapped into place. A
+    failed sync leaves the current configs untouched.
+
+    The archive is streamed to a partial file next to the configs. If the
+    download is interrupted it's resumed with a range request, either by a
+    retry or by the next sync.
+
+    In 'templates' mode the near identical ovpn files aren't written at all.
+    Instead a handful of templates and a table of each server's parameters
+    are stored and configs are rendered on demand by config().
+    """
+
+    MANIFEST = '.manifest.json'
+
+    TEMPLATES = 'templates.json'
+
+    PLACEHOLDER = '{{hostname}}'
+
+    CHUNK_SIZE = 65536
+
+    _CONFIG_NAME = re.compile(
+        '^ipvanish-([A-Z]{2})-.+-([a-z]{3}-[a-c]{1}[0-9]{2}.ovpn)$')
+
+    _REMOTE = re.compile(r'^remote\s+(\S+)', re.MULTILINE)
+
+    def __init__(self, url, path, max_size=None, retries=0, mode='files',
+                 render_dir=None):
         """OvpnConfigs.
 
         :param url: URL ovpn configs zip file.
         :param path: Path to write ovpn configs.
+        :param max_size: The largest archive in bytes we'll download.
+        :param retries: Times to resume a download that fails part way.
+        :param mode: 'files' to write every ovpn file or 'templates'.
+        :param render_dir: Where configs are rendered from templates.
         """
         self._url = url
         self._path = path
+        self._max_size = max_size
+        self._retries = retries
+        self._mode = mode
+        self._render_dir = render_dir
+        self._staging_path = path + '.staging'
+        self._old_path = path + '.old'
+        self._download_path = path + '.zip.part'
+        self._download_meta_path = self._download_path + '.meta'
+
+    def update(self, progress=None):
+        """Sync the configs with IPVanish.
+
+        :param progress: Called with (bytes downloaded, total bytes or None)
+            as the archive downloads.
+        :return: A dictionary counting the files 'added', 'changed',
+            'removed' and 'unchanged'.
+        """
+        with trace.span('ovpnconfigs.update') as span:
+            stats = self._update(progress)
+            span.set(**stats)
 
-    def update(self):
-        working_dir = tempfile.mkdtemp()
+        return stats
 
-        if os.path.exists(self._path):
-            shutil.rmtree(self._path)
+    def _update(self, progress):
+        import zipfile
 
-        response = requests.get(self._url)
+        self._recover()
 
-        new_configs = os.path.join(working_dir, 'configs.zip')
+        try:
+            with trace.span('ovpnconfigs.download'):
+                archive = self._download(progress)
+        except DownloadError:
+            self._removeDownload()
+            raise
+
+        try:
+            with zipfile.ZipFile(archive, 'r') as zip, \
+                    trace.span('ovpnconfigs.sync'):
+                stats = self._sync(zip)
+        except zipfile.BadZipFile:
+            # Don't resume from a corrupt archive.
+            self._removeDownload()
+            raise
+
+        self._removeDownload()
+
+        return stats
+
+    def _download(self, progress):
+        """Download the archive resuming any partial download.
+
+        :return: Path to the downloaded archive.
+        """
+        import requests
+
+        directory = os.path.dirname(self._download_path)
+
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        for attempt in range(self._retries + 1):
+            try:
+                self._fetch(progress)
+                return self._download_path
+            except (requests.ConnectionError,
+                    requests.Timeout,
+                    requests.exceptions.ChunkedEncodingError):
+                if attempt == self._retries:
+                    raise
+
+    def _fetch(self, progress):
+        import requests
+
+        offset = 0
+        headers = {'Accept-Encoding': 'identity'}
+        validator = self._readDownloadMeta().get('validator')
+
+        if os.path.exists(self._download_path) and validator:
+            offset = os.path.getsize(self._download_path)
+            headers['Range'] = 'bytes={}-'.format(offset)
+            headers['If-Range'] = validator
+
+        response = requests.get(
+            self._url, headers=headers, stream=True, timeout=30)
 
-        with open(new_configs, 'w+b') as h:
-            h.write(response.content)
+        with response:
+            if response.status_code == 416:
+                # Nothing left to download.
+                return
 
-        with zipfile.ZipFile(new_configs, 'r') as zip:
-            zip.extractall(self._path)
+            response.raise_for_status()
 
-        for file in os.listdir(self._path):
-            if "ovpn" in file:
-                parts = re.search(
-                    '^ipvanish-([A-Z]{2})-.+-([a-z]{3}-[a-c]{1}[0-9]{2}.ovpn)$',
-                    file
+            if response.status_code != 206:
+                offset = 0
+
+            length = response.headers.get('Content-Length')
+            total = offset + int(length) if length else None
+
+            if self._max_size and total and total > self._max_size:
+                raise DownloadError("Archive is {} bytes, the limit is {}"
+                                    .format(total, self._max_size))
+
+            self._writeDownloadMeta({
+                'validator': (response.headers.get('ETag')
+                              or response.headers.get('Last-Modified'))
+            })
+
+            with open(self._download_path, 'ab' if offset else 'wb') as h:
+                for chunk in response.iter_content(self.CHUNK_SIZE):
+                    h.write(chunk)
+                    offset += len(chunk)
+
+                    if self._max_size and offset > self._max_size:
+                        raise DownloadError("Archive exceeds {} bytes"
+                                            .format(self._max_size))
+
+                    if progress:
+                        progress(offset, total)
+
+    def _readDownloadMeta(self):
+        try:
+            with open(self._download_meta_path) as h:
+                return json.load(h)
+        except (IOError, ValueError):
+            return {}
+
+    def _writeDownloadMeta(self, meta):
+        with open(self._download_meta_path, 'w') as h:
+            json.dump(meta, h)
+
+    def _removeDownload(self):
+        for path in (self._download_path, self._download_meta_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _sync(self, zip):
+        entries = self._entries(zip)
+        manifest = self._readManifest()
+        stats = dict.fromkeys(['added', 'changed', 'removed', 'unchanged'], 0)
+
+        if os.path.exists(self._staging_path):
+            shutil.rmtree(self._staging_path)
+
+        os.makedirs(self._staging_path)
+
+        try:
+            for name, (crc, size, write) in entries.items():
+                current = os.path.join(self._path, name)
+                staged = os.path.join(self._staging_path, name)
+
+                if not os.path.exists(current):
+                    stats['added'] += 1
+                elif self._isUnchanged(current, manifest.get(name), crc,
+                                       size):
+                    stats['unchanged'] += 1
+                    self._link(current, staged)
+                    continue
+                else:
+                    stats['changed'] += 1
+
+                with open(staged, 'wb') as dest:
+                    write(dest)
+
+            if os.path.exists(self._path):
+                current = set(os.listdir(self._path)) - {self.MANIFEST}
+                stats['removed'] = len(current - set(entries))
+
+            with open(os.path.join(self._staging_path, self.MANIFEST),
+                      'w') as h:
+                json.dump({
+                    name: [crc, size]
+                    for name, (crc, size, _) in entries.items()
+                }, h)
+
+            self._publish()
+        except BaseException:
+            shutil.rmtree(self._staging_path, ignore_errors=True)
+            raise
+
+        return stats
+
+    def _entries(self, zip):
+        """Work out the files the configs directory should contain.
+
+        :return: A dictionary of {name: (crc, size, write)} where write is
+            called with a file object to write the file's contents.
+        """
+        entries = {}
+        configs = {}
+
+        for info in zip.infolist():
+            if info.filename.endswith('/'):
+                continue
+
+            name = self._configName(info.filename)
+
+            if self._mode == 'templates' and name.endswith('.ovpn'):
+                configs[name] = zip.read(info).decode('utf-8')
+                continue
+
+            entries[name] = (
+                info.CRC,
+                info.file_size,
+                lambda dest, info=info: self._extract(zip, info, dest)
                 )
-                dest = "-".join([parts.group(1), parts.group(2)]).lower()
 
-                os.rename(
-                    os.path.join(self._path, file),
-                    os.path.join(self._path, dest)
+        if configs:
+            content = json.dumps(
+                self._templates(configs), indent=1, sort_keys=True
+                ).encode('utf-8')
+
+            entries[self.TEMPLATES] = (
+                zlib.crc32(content),
+                len(content),
+                lambda dest: dest.write(content)
                 )
 
-        shutil.rmtree(working_dir)
+        return entries
+
+    @staticmethod
+    def _extract(zip, info, dest):
+        with zip.open(info) as src:
+            shutil.copyfileobj(src, dest)
+
+    def _templates(self, configs):
+        """Split configs into templates and per-server parameters.
+
+        The configs only really differ by the hostname of the server so each
+        is reduced to a template with the hostname replaced by a placeholder.
+
+        :param configs: A dictionary of {name: config contents}.
+        :return: A dictionary with a list of 'templates' and 'servers', a
+            dictionary of {name: [template index, hostname]}.
+        """
+        templates = []
+        indexes = {}
+        servers = {}
+
+        for name, content in sorted(configs.items()):
+            remote = self._REMOTE.search(content)
+            hostname = remote.group(1) if remote else None
+
+            if hostname:
+                content = content.replace(hostname, self.PLACEHOLDER)
+
+            if content not in indexes:
+                indexes[content] = len(templates)
+                templates.append(content)
+
+            servers[name] = [indexes[content], hostname]
+
+        return {'templates': templates, 'servers': servers}
+
+    @contextlib.contextmanager
+    def config(self, name):
+        """Provide a path to the config file with name.
+
+        Synced config files are used as they are. Otherwise the config is
+        rendered from its template to a temporary file in render_dir which is
+        removed again afterwards.
+
+        :param name: The name of a config, see Server.ovpnFile.
+        :raises FileNotFoundError: If there's no config with name.
+        """
+        import tempfile
+
+        path = os.path.join(self._path, name)
+
+        if os.path.exists(path):
+            yield path
+            return
+
+        try:
+            with open(os.path.join(self._path, self.TEMPLATES)) as h:
+                templates = json.load(h)
+
+            index, hostname = templates['servers'][name]
+        except (IOError, ValueError, KeyError):
+            raise FileNotFoundError("No ovpn config {}".format(path))
+
+        content = templates['templates'][index]
+
+        if hostname:
+            content = content.replace(self.PLACEHOLDER, hostname)
+
+        handle, path = tempfile.mkstemp(
+            suffix='-' + name, dir=self._render_dir)
+
+        try:
+            with os.fdopen(handle, 'w') as h:
+                h.write(content)
+
+            yield path
+        finally:
+            os.remove(path)
+
+    def _configName(self, filename):
+        """Map an archive member to the name we store it under.
+
+        ovpn files are renamed to <country code>-<server>.ovpn, the name
+        Connect derives from a server.
+        """
+        filename = os.path.basename(filename)
+        parts = self._CONFIG_NAME.search(filename)
+
+        if not parts:
+            return filename
+
+        return "-".join([parts.group(1), parts.group(2)]).lower()
+
+    @staticmethod
+    def _isUnchanged(path, recorded, crc, size):
+        if os.path.getsize(path) != size:
+            return False
+
+        if recorded is not None:
+            return recorded == [crc, size]
+
+        # Configs synced before the manifest existed have to be checked.
+        current = 0
+
+        with open(path, 'rb') as h:
+            for block in iter(lambda: h.read(65536), b''):
+                current = zlib.crc32(block, current)
+
+        return current == crc
+
+    @staticmethod
+    def _link(src, dest):
+        try:
+            os.link(src, dest)
+        except OSError:
+            shutil.copy2(src, dest)
+
+    def _readManifest(self):
+        try:
+            with open(os.path.join(self._path, self.MANIFEST)) as h:
+                return json.load(h)
+        except (IOError, ValueError):
+            return {}
+
+    def _publish(self):
+        """Swap the staging directory into place."""
+        if os.path.exists(self._old_path):
+            shutil.rmtree(self._old_path)
+
+        if os.path.exists(self._path):
+            os.rename(self._path, self._old_path)
+
+        os.rename(self._staging_path, self._path)
+        shutil.rmtree(self._old_path, ignore_errors=True)
+
+    def _recover(self):
+        """Restore the configs if a previous sync died mid swap."""
+        if not os.path.exists(self._path) and os.path.exists(self._old_path):
+            os.rename(self._old_path, self._path)
 
 
 class Vanish(object):
     @staticmethod
-    def connect(config_file, ca_file, *kargs):
+    def connect(config_file, ca_file, *kargs, openvpn='openvpn'):
         """Connect to IPVanishs servers.
 
         :param config_file: The ovpn configuration file
         :param ca_file: The certificate file for IPVanishs servers.
         :param *kargs: Any additional arguments to pass to openvpn command.
+        :param openvpn: The openvpn executable.
         """
+        import subprocess
+
         command = [
-            'openvpn',
+            openvpn,
             '--config', config_file,
             '--ca', ca_file
         ]
@@ -107,7 +745,8 @@ class Vanish(object):
         command.extend(kargs)
 
         try:
-            subprocess.check_call(command)
+            with trace.span('openvpn'):
+                subprocess.check_call(command)
         except subprocess.CalledProcessError:
             print("Failed to run openvpn command:")
             print("\t" + " ".join(command))
@@ -115,26 +754,65 @@ class Vanish(object):
             print("Disconnected")
 
     @staticmethod
-    def ping(servers):
-        for i, server in enumerate(servers):
-            try:
-                response = subprocess.check_output(
-                    ['ping', '-c', '1', '-W', '1', server['ip']])
-
-                response_time = re.search(
-                    "(?<=time=)([\d\.]+)", response.decode('utf-8'))
+    def ping(servers, prober=None, count=1):
+        """Measure the round trip time to each server.
 
-                servers[i]['rtt'] = float(response_time.group(0))
+        Probes are run concurrently by the prober and each server has its
+        latency set to the probe.LatencyStats of its samples.
 
-            except subprocess.CalledProcessError:
-                print("Failed to ping {}".format(server['hostname']))
+        :param servers: A list of servers.
+        :param prober: A probe.Prober instance; defaults to the system ping.
+        :param count: The number of samples to take from each server.
+        :return: The list of servers.
+        """
+        for server in Vanish.iping(servers, prober, count):
+            if not server.latency.received:
+                print("Failed to ping {}".format(server.hostname))
 
         return servers
 
+    @staticmethod
+    def iping(servers, prober=None, count=1):
+        """Measure the round trip time to each server as ping() does.
+
+        :return: A generator yielding each server as soon as its probe
+            completes.
+        """
+        from .probe import SubprocessProber
+
+        if prober is None:
+            prober = SubprocessProber()
+
+        addresses = {}
+
+        for server in servers:
+            addresses.setdefault(server.ip, []).append(server)
+
+        with trace.span('probe', servers=len(servers), count=count):
+            for address, latency in prober.iprobe(list(addresses), count):
+                for server in addresses.get(address, ()):
+                    server.latency = latency
+                    yield server
+
 
 class ServerContainer(object):
     def __init__(self, geojson):
-        self._servers = geojson.servers
+        """Query servers by location.
+
+        Case folded indexes from every location name and code to the servers
+        at that location are built up front so filtering is a handful of set
+        operations. The indexes are rebuilt whenever geojson is updated.
+
+        :param geojson: A GeoJson instance.
+        """
+        self._indexes = None
+        geojson.subscribe(self._index)
+        servers = geojson.servers
+
+        # A cold load has already indexed the servers through the
+        # subscription.
+        if self._indexes is None:
+            self._index(servers)
 
     def getServers(self,
                    continents=None,
@@ -153,91 +831,66 @@ class ServerContainer(object):
         :param cities: A list of city names
         :return: A list of servers.
         '''
-        servers = self._servers
+        indexes = self._indexes
+        ids = indexes.select(continents, countries, regions, cities)
+
+        if ids is None:
+            return list(indexes.servers)
 
-        if continents:
-            servers = self._filterContinents(servers, continents)
+        return [indexes.servers[i] for i in sorted(ids)]
 
-        if countries:
-            servers = self._filterCountries(servers, countries)
+    def getNearest(self,
+                   latitude,
+                   longitude,
+                   count,
+                   continents=None,
+                   countries=None,
+                   regions=None,
+                   cities=None):
+        '''
+        Retrieve the servers nearest a point, nearest first.
 
-        if regions:
-            servers = self._filterRegions(servers, regions)
+        Servers without coordinates are never included. The filters are
+        those of getServers.
 
-        if cities:
-            servers = self._filterCities(servers, cities)
+        :param latitude: Latitude of the point in degrees.
+        :param longitude: Longitude of the point in degrees.
+        :param count: The most servers to return.
+        :return: A list of servers.
+        '''
+        indexes = self._indexes
+        nearest = indexes.nearest(
+            (latitude, longitude), count, continents, countries, regions,
+            cities)
 
-        return list(servers)
+        return [indexes.servers[i] for _, i in nearest]
 
     def getContinents(self):
         '''
-        Retrieve a dictionary of continents.
+        Retrieve a list of continents.
 
-        :return: A dictionary of continents {code: name}
+        :return: A list of continents [(name, code)]
         '''
-        codes = []
-        continents = []
-
-        for s in self._servers:
-            if s['continentCode'] not in codes:
-                codes.append(s['continentCode'])
-                continents.append((s['continent'], s['continentCode']))
-
-        return continents
+        return self._indexes.listing('continents')
 
     def getCountries(self, continents=None):
         '''
-        Retrieve a dictionary of countries.
+        Retrieve a list of countries.
 
         :param continents: A list of continent names or codes
-        :return: A dictionary of countries {code: name}
+        :return: A list of countries [(continent, name, code)]
         '''
-        servers = self._servers
-
-        if continents:
-            servers = self._filterContinents(servers, continents)
-
-        codes = []
-        countries = []
-
-        for s in servers:
-            if s['countryCode'] not in codes:
-                codes.append(s["countryCode"])
-                countries.append(
-                    (s['continent'], s['country'], s['countryCode'])
-                    )
-
-        return countries
+        return self._indexes.listing('countries', continents)
 
     def getRegions(self, continents=None, countries=None):
         '''
-        Retrieve a dictionary of regions.
+        Retrieve a list of regions.
 
         :param continents: A list of continent names or codes
         :param countries: A list of country names of codes
-        :return: A dictionary of regions {code: name}
+        :return: A list of regions [(country, name, code)]
         '''
-        servers = self._servers
-
-        if continents:
-            servers = self._filterContinents(servers, continents)
-
-        if countries:
-            servers = self._filterCountries(servers, countries)
-
-        codes = []
-        regions = []
-
-        for s in servers:
-            if s['region'] and s['regionCode'] not in codes:
-                codes.append(s['regionCode'])
-                regions.append((
-                    s['country'],
-                    s['region'],
-                    s['regionCode']
-                    ))
-
-        return regions
+        return self._indexes.listing('regions', continents, countries)
 
     def getCities(self, continents=None, countries=None, regions=None):
         '''
@@ -246,49 +899,152 @@ class ServerContainer(object):
         :param continents: A list of continent names or codes
         :param countries: A list of country names of codes
         :param regions: A list of region names, codes, or abbreviations
-        :return: A unique set of cities.
+        :return: A unique list of cities [(continent, country, name)]
         '''
-        servers = self._servers
-
-        if continents:
-            servers = self._filterContinents(servers, continents)
-
-        if countries:
-            servers = self._filterCountries(servers, countries)
-
-        if regions:
-            servers = self._filterRegions(servers, regions)
-
-        cities_added = []
-        cities = []
-
-        for s in servers:
-            if s['city'] not in cities_added:
-                cities_added.append(s['city'])
-                cities.append((
-                    s['continent'],
-                    s['country'],
-                    s['city']
-                    ))
-
-        return cities
-
-    def _filterContinents(self, servers, continents):
-        continents = list(map(lambda c: c.lower(), continents))
-        return filter(lambda s: s['continent'].lower() in continents
-            or s['continentCode'].lower() in continents, servers)
-
-    def _filterCountries(self, servers, countries):
-        countries = list(map(lambda c: c.lower(), countries))
-        return filter(lambda s: s['country'].lower() in countries
-            or s['countryCode'].lower() in countries, servers)
-
-    def _filterRegions(self, servers, regions):
-        regions = list(map(lambda c: c.lower(), regions))
-        return filter(lambda s: s['region'].lower() in regions
-            or s['regionCode'].lower() in regions
-            or s['regionAbbr'].lower() in regions, servers)
-
-    def _filterCities(self, servers, cities):
-        cities = list(map(lambda c: c.lower(), cities))
-        return filter(lambda x: x['city'].lower() in cities, servers)
+        return self._indexes.listing(
+            'cities', continents, countries, regions)
+
+    def _index(self, servers):
+        # The indexes are swapped in whole so queries running while they're
+        # rebuilt see either the old or the new servers, never a mix.
+        with trace.span('servers.index', servers=len(servers)):
+            self._indexes = _Indexes(servers)
+
+
+class _Indexes(object):
+    def __init__(self, servers):
+        self.servers = servers
+        # Built on first use as most commands never need it.
+        self._tree = None
+
+        self._continents = self._buildIndex(
+            servers, ('continent', 'continentCode'))
+        self._countries = self._buildIndex(
+            servers, ('country', 'countryCode'))
+        self._regions = self._buildIndex(
+            servers, ('region', 'regionCode', 'regionAbbr'))
+        self._cities = self._buildIndex(servers, ('city',))
+
+        self._rows = {
+            'continents': self._buildRows(
+                servers,
+                lambda s: s.continentCode,
+                lambda s: (s.continent, s.continentCode)),
+            'countries': self._buildRows(
+                servers,
+                lambda s: s.countryCode,
+                lambda s: (s.continent, s.country, s.countryCode)),
+            'regions': self._buildRows(
+                servers,
+                lambda s: s.regionCode if s.region else None,
+                lambda s: (s.country, s.region, s.regionCode)),
+            'cities': self._buildRows(
+                servers,
+                lambda s: s.city,
+                lambda s: (s.continent, s.country, s.city)),
+        }
+
+    @staticmethod
+    def _buildIndex(servers, fields):
+        """Map every case folded value of fields to a set of server ids."""
+        index = {}
+
+        for i, server in enumerate(servers):
+            for field in fields:
+                value = getattr(server, field)
+
+                if value:
+                    index.setdefault(value.casefold(), set()).add(i)
+
+        return index
+
+    @staticmethod
+    def _buildRows(servers, key, row):
+        """Group server ids by key keeping the row for the first server seen.
+
+        :return: A list of (row, ids) in the order keys were first seen.
+        """
+        groups = {}
+        rows = []
+
+        for i, server in enumerate(servers):
+            k = key(server)
+
+            if k is None:
+                continue
+
+            if k not in groups:
+                groups[k] = set()
+                rows.append((row(server), groups[k]))
+
+            groups[k].add(i)
+
+        return rows
+
+    def select(self, continents=None, countries=None, regions=None,
+               cities=None):
+        """Find the ids of servers matching all filters.
+
+        :return: A set of server ids or None if no filters were given.
+        """
+        ids = None
+
+        for values, index in ((continents, self._continents),
+                              (countries, self._countries),
+                              (regions, self._regions),
+                              (cities, self._cities)):
+            if not values:
+                continue
+
+            matched = set().union(
+                *(index.get(v.casefold(), ()) for v in values))
+            ids = matched if ids is None else ids & matched
+
+        return ids
+
+    def nearest(self, origin, count, *filters):
+        """The servers nearest origin matching filters.
+
+        Filtered servers are scanned directly as selecting them already
+        takes time in proportion to their number. The k-d tree only pays off
+        when searching every server.
+
+        :param origin: A (latitude, longitude) tuple.
+        :param count: The most servers to find.
+        :param filters: Filters as passed to select().
+        :return: A list of (km, id) tuples, nearest first.
+        """
+        ids = self.select(*filters)
+
+        if ids is not None:
+            servers = self.servers
+            distances = ((geo.distance(origin, servers[i].latitude,
+                                       servers[i].longitude), i)
+                         for i in ids)
+
+            return heapq.nsmallest(
+                count, (d for d in distances if d[0] is not None))
+
+        tree = self._tree
+
+        if tree is None:
+            with trace.span('servers.kdtree', servers=len(self.servers)):
+                tree = self._tree = geo.KdTree(
+                    [(s.latitude, s.longitude) for s in self.servers])
+
+        return tree.nearest(origin, count)
+
+    def listing(self, name, *filters):
+        """The rows of a listing with servers matching filters.
+
+        :param name: One of continents, countries, regions or cities.
+        :param filters: Filters as passed to select().
+        :return: A list of rows.
+        """
+        rows = self._rows[name]
+        ids = self.select(*filters)
+
+        if ids is None:
+            return [row for row, _ in rows]
+
+        return [row for row, members in rows if not ids.isdisjoint(members)]
@@ -0,0 +1,153 @@
+import json
+import sys
+from . import trace
+"""
+This module writes command results as tables or machine readable records.
+
+Commands describe their results as columns and write one record, a dict keyed
+by column, at a time:
+
+    with output.writer(format, COLUMNS) as out:
+        for server in servers:
+            out.write({'hostname': server.hostname, ...})
+
+The interactive table has to see every row to size and sort its columns so
+it's printed when the writer closes. Every other format writes and flushes
+each record as soon as it's given so results can be piped while they're
+still being produced.
+"""
+
+
+class Column(object):
+    __slots__ = ('key', 'header', 'format')
+
+    def __init__(self, key, header=None, format=str):
+        """A column of results.
+
+        :param key: The record key, used as the field name by machine
+            readable formats.
+        :param header: The table heading. Columns without one are only
+            written by the machine readable formats.
+        :param format: Formats a value for the table; machine readable
+            formats write raw values.
+        """
+        self.key = key
+        self.header = header
+        self.format = format
+
+
+class _Writer(object):
+    def __init__(self, columns, stream):
+        self._columns = columns
+        self._stream = stream
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close(exc_type is None)
+        return False
+
+    def write(self, record):
+        raise NotImplementedError()
+
+    def close(self, complete=True):
+        """Finish the output.
+
+        :param complete: Whether every record was written. Partial
+            machine readable output is still terminated so it parses.
+        """
+        self._stream.flush()
+
+    def _values(self, record):
+        return [record.get(c.key) for c in self._columns]
+
+
+class _TableWriter(_Writer):
+    def __init__(self, columns, stream):
+        super(_TableWriter, self).__init__(
+            [c for c in columns if c.header is not None], stream)
+        self._rows = []
+
+    def write(self, record):
+        self._rows.append([
+            "-" if value is None else column.format(value)
+            for column, value in zip(self._columns, self._values(record))])
+
+    def close(self, complete=True):
+        if not complete:
+            return
+
+        with trace.span('render', rows=len(self._rows)):
+            # tabulate is slow to import so only do so when printing a table.
+            import tabulate
+
+            table = tabulate.tabulate(
+                sorted(self._rows),
+                headers=[c.header for c in self._columns],
+                tablefmt="fancy_grid")
+
+        print(table, file=self._stream)
+
+
+class _JsonWriter(_Writer):
+    def __init__(self, columns, stream):
+        super(_JsonWriter, self).__init__(columns, stream)
+        self._count = 0
+
+    def write(self, record):
+        self._stream.write(',\n' if self._count else '[\n')
+        self._stream.write(json.dumps(self._record(record)))
+        self._stream.flush()
+        self._count += 1
+
+    def close(self, complete=True):
+        self._stream.write('\n]\n' if self._count else '[]\n')
+        self._stream.flush()
+
+    def _record(self, record):
+        return {c.key: record.get(c.key) for c in self._columns}
+
+
+class _JsonLinesWriter(_JsonWriter):
+    def write(self, record):
+        self._stream.write(json.dumps(self._record(record)) + '\n')
+        self._stream.flush()
+
+    def close(self, complete=True):
+        self._stream.flush()
+
+
+class _DelimitedWriter(_Writer):
+    def __init__(self, columns, stream, delimiter):
+        import csv
+
+        super(_DelimitedWriter, self).__init__(columns, stream)
+        self._writer = csv.writer(
+            stream, delimiter=delimiter, lineterminator='\n')
+        self._writer.writerow([c.key for c in columns])
+
+    def write(self, record):
+        self._writer.writerow(
+            ['' if v is None else v for v in self._values(record)])
+        self._stream.flush()
+
+
+FORMATS = {
+    'table': _TableWriter,
+    'json': _JsonWriter,
+    'jsonl': _JsonLinesWriter,
+    'csv': lambda columns, stream: _DelimitedWriter(columns, stream, ','),
+    'tsv': lambda columns, stream: _DelimitedWriter(columns, stream, '\t'),
+}
+
+
+def writer(format, columns, stream=None):
+    """A writer of records in format.
+
+    :param format: One of FORMATS.
+    :param columns: A list of Columns.
+    :param stream: The file to write to; defaults to stdout.
+    :return: A writer to use as a context manager.
+    """
+    return FORMATS[format](columns, stream or sys.stdout)
@@ -0,0 +1,340 @@
+import math
+import os
+import re
+import selectors
+import socket
+import struct
+import subprocess
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+"""
+This module contains the latency probes used to measure round trip times to
+IPVanish servers.
+"""
+
+
+class LatencyStats(object):
+    __slots__ = ('samples', 'sent', 'received', 'minimum', 'median', 'p95',
+                 'jitter', 'loss')
+
+    def __init__(self, samples):
+        """Summary statistics over a series of round trip time samples.
+
+        :param samples: Round trip times in ms in the order the probes were
+            sent. Lost probes are recorded as None.
+        """
+        self.samples = list(samples)
+        received = [s for s in self.samples if s is not None]
+        ordered = sorted(received)
+
+        self.sent = len(self.samples)
+        self.received = len(received)
+        self.loss = 1 - self.received / self.sent if self.sent else 1.0
+
+        if ordered:
+            middle = len(ordered) // 2
+
+            self.minimum = ordered[0]
+            self.median = (ordered[middle] if len(ordered) % 2
+                           else (ordered[middle - 1] + ordered[middle]) / 2)
+            self.p95 = ordered[int(math.ceil(0.95 * len(ordered))) - 1]
+        else:
+            self.minimum = self.median = self.p95 = None
+
+        # Mean variation between consecutive replies.
+        if len(received) > 1:
+            self.jitter = sum(
+                abs(b - a) for a, b in zip(received, received[1:])
+            ) / (len(received) - 1)
+        else:
+            self.jitter = 0.0 if received else None
+
+    @property
+    def score(self):
+        """A robust figure for ranking servers, lower is better.
+
+        The median plus jitter, scaled up by the loss ratio. Servers that
+        didn't reply at all score infinity.
+        """
+        if not self.received:
+            return float('inf')
+
+        return (self.median + self.jitter) / (1 - self.loss)
+
+    def __repr__(self):
+        return "LatencyStats({!r})".format(self.samples)
+
+
+class Prober(object):
+    def __init__(self, timeout=1, concurrency=32, interval=0.2):
+        """Base class for latency probes.
+
+        :param timeout: Seconds to wait for a reply to a single probe.
+        :param concurrency: Maximum number of servers probed at once.
+        :param interval: Seconds between samples sent to the same server.
+        """
+        self._timeout = timeout
+        self._concurrency = max(1, concurrency)
+        self._interval = interval
+
+    def probe(self, addresses, count=1):
+        """Probe all addresses and wait for every result.
+
+        :param addresses: An iterable of IP addresses.
+        :param count: The number of samples to take from each address.
+        :return: A dictionary of {address: LatencyStats}.
+        """
+        return dict(self.iprobe(addresses, count))
+
+    def iprobe(self, addresses, count=1):
+        """Probe all addresses yielding results as they complete.
+
+        :param addresses: An iterable of IP addresses.
+        :param count: The number of samples to take from each address.
+        :return: A generator of (address, LatencyStats) tuples.
+        """
+        raise NotImplementedError()
+
+    @staticmethod
+    def _unique(addresses):
+        seen = set()
+        return [a for a in addresses if not (a in seen or seen.add(a))]
+
+
+class SubprocessProber(Prober):
+    """Probe servers by running the system ping binary from a worker pool."""
+
+    _RTT = re.compile(r"(?<=time=)([\d\.]+)")
+
+    def iprobe(self, addresses, count=1):
+        addresses = self._unique(addresses)
+
+        if not addresses:
+            return
+
+        workers = min(self._concurrency, len(addresses))
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {
+                pool.submit(self._ping, a, count): a for a in addresses
+            }
+
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+
+    def _ping(self, address, count):
+        command = [
+            'ping', '-c', str(count),
+            '-i', str(self._interval),
+            '-W', str(int(math.ceil(self._timeout))),
+            address
+        ]
+
+        try:
+            response = subprocess.check_output(
+                command,
+                stderr=subprocess.DEVNULL,
+                timeout=self._timeout + count * self._interval + 1
+            )
+        except subprocess.CalledProcessError as e:
+            response = e.output
+        except (subprocess.TimeoutExpired, OSError):
+            response = b''
+
+        samples = [
+            float(rtt) for rtt in self._RTT.findall(response.decode('utf-8'))
+        ][:count]
+
+        return LatencyStats(samples + [None] * (count - len(samples)))
+
+
+class IcmpProber(Prober):
+    """Probe servers in-process with ICMP echo requests.
+
+    All echo requests are multiplexed over a single socket and replies are
+    matched by sequence number (and identifier where the kernel doesn't
+    rewrite it). An unprivileged ICMP datagram socket is used where the
+    system allows it, otherwise a raw socket which requires root. If neither
+    can be opened probing falls back to the system ping binary.
+    """
+
+    ECHO_REPLY = 0
+    ECHO_REQUEST = 8
+
+    _HEADER = struct.Struct('!BBHHH')
+    _PAYLOAD = b'vanish-icmp-probe'
+
+    def __init__(self, timeout=1, concurrency=32, interval=0.2):
+        super(IcmpProber, self).__init__(timeout, concurrency, interval)
+        self._identifier = os.getpid() & 0xffff
+        self._sequence = 0
+
+    def iprobe(self, addresses, count=1):
+        addresses = self._unique(addresses)
+
+        if not addresses:
+            return
+
+        try:
+            sock, raw = self._socket()
+        except OSError:
+            fallback = SubprocessProber(
+                self._timeout, self._concurrency, self._interval)
+            yield from fallback.iprobe(addresses, count)
+            return
+
+        selector = selectors.DefaultSelector()
+        selector.register(sock, selectors.EVENT_READ)
+
+        try:
+            yield from self._run(
+                sock, raw, selector, deque(addresses), count)
+        finally:
+            selector.close()
+            sock.close()
+
+    def _run(self, sock, raw, selector, queue, count):
+        jobs = {}
+        pending = {}
+
+        while queue or jobs:
+            while queue and len(jobs) < self._concurrency:
+                address = queue.popleft()
+                jobs[address] = _Job(address, count)
+
+            now = time.monotonic()
+
+            for job in jobs.values():
+                if job.sent < count and job.due <= now:
+                    sequence = self._nextSequence()
+
+                    try:
+                        sock.sendto(self._packet(sequence), (job.address, 0))
+                    except OSError:
+                        job.sent = count
+                        continue
+
+                    pending[sequence] = (job, job.sent, now)
+                    job.sent += 1
+                    job.outstanding += 1
+                    job.due = now + self._interval
+
+            for sequence, (job, _, sent) in list(pending.items()):
+                if now - sent >= self._timeout:
+                    del pending[sequence]
+                    job.outstanding -= 1
+
+            for job in list(jobs.values()):
+                if job.sent == count and not job.outstanding:
+                    del jobs[job.address]
+                    yield job.address, LatencyStats(job.samples)
+
+            deadlines = [sent + self._timeout for _, _, sent in
+                         pending.values()]
+            deadlines.extend(j.due for j in jobs.values() if j.sent < count)
+
+            if not deadlines:
+                continue
+
+            if not selector.select(max(0, min(deadlines) - now)):
+                continue
+
+            while True:
+                try:
+                    data, source = sock.recvfrom(2048)
+                except (BlockingIOError, InterruptedError):
+                    break
+
+                received = time.monotonic()
+                sequence = self._parse(data, raw)
+
+                if (sequence in pending
+                        and pending[sequence][0].address == source[0]):
+                    job, index, sent = pending.pop(sequence)
+                    job.samples[index] = round((received - sent) * 1000, 3)
+                    job.outstanding -= 1
+
+    def _socket(self):
+        try:
+            sock = socket.socket(
+                socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+            raw = False
+        except OSError:
+            sock = socket.socket(
+                socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+            raw = True
+
+        sock.setblocking(False)
+
+        return sock, raw
+
+    def _nextSequence(self):
+        self._sequence = (self._sequence + 1) & 0xffff
+        return self._sequence
+
+    def _packet(self, sequence):
+        header = self._HEADER.pack(
+            self.ECHO_REQUEST, 0, 0, self._identifier, sequence)
+        checksum = self._checksum(header + self._PAYLOAD)
+        header = self._HEADER.pack(
+            self.ECHO_REQUEST, 0, checksum, self._identifier, sequence)
+
+        return header + self._PAYLOAD
+
+    def _parse(self, data, raw):
+        """Extract the sequence number from an echo reply.
+
+        :param data: The received datagram.
+        :param raw: Whether data was received on a raw socket and therefore
+            includes the IP header.
+        :return: The sequence number or None if data isn't a reply to us.
+        """
+        if raw:
+            data = data[(data[0] & 0x0f) * 4:]
+
+        if len(data) < self._HEADER.size:
+            return None
+
+        type, _, _, identifier, sequence = self._HEADER.unpack_from(data)
+
+        if type != self.ECHO_REPLY:
+            return None
+
+        # Datagram sockets have their identifier rewritten by the kernel
+        # which also ensures we only receive replies to our own requests.
+        if raw and identifier != self._identifier:
+            return None
+
+        return sequence
+
+    @staticmethod
+    def _checksum(data):
+        if len(data) % 2:
+            data += b'\x00'
+
+        total = sum(struct.unpack('!{}H'.format(len(data) // 2), data))
+        total = (total >> 16) + (total & 0xffff)
+        total += total >> 16
+
+        return ~total & 0xffff
+
+
+class _Job(object):
+    __slots__ = ('address', 'samples', 'sent', 'outstanding', 'due')
+
+    def __init__(self, address, count):
+        self.address = address
+        self.samples = [None] * count
+        self.sent = 0
+        self.outstanding = 0
+        self.due = 0
+
+
+"""
+Probe backends selectable with the ping.backend configuration key.
+"""
+PROBERS = {
+    'icmp': IcmpProber,
+    'subprocess': SubprocessProber
+}
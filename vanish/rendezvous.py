@@ -0,0 +1,83 @@
+import hashlib
+import math
+import socket
+"""
+This module spreads many clients over servers without them coordinating.
+
+Each client ranks the servers by weighted rendezvous (highest random weight)
+hashing of its node id and the server's hostname, and connects to the first
+server that responds. Clients with different ids get different, effectively
+random, orders so they land on different servers, in proportion to each
+server's weight. The order only depends on the id and the server so a client
+keeps picking the same server, and when servers come or go only the clients
+whose server went away, or that now prefer a new one, move.
+
+The weight of a server is its remaining capacity so lightly loaded servers
+are given more clients.
+"""
+
+"""
+Files holding a stable id for the machine, tried in order before falling
+back to the hostname.
+"""
+MACHINE_ID_PATHS = ('/etc/machine-id', '/var/lib/dbus/machine-id')
+
+
+def nodeId(configured=None):
+    """The id this client hashes servers with.
+
+    :param configured: An id to use instead of the machine's.
+    :return: configured if given, else the machine id or the hostname.
+    """
+    if configured:
+        return str(configured)
+
+    for path in MACHINE_ID_PATHS:
+        try:
+            with open(path) as h:
+                machine_id = h.read().strip()
+        except OSError:
+            continue
+
+        if machine_id:
+            return machine_id
+
+    return socket.gethostname()
+
+
+def capacity(server):
+    """The weight of server: its remaining capacity, at least 1.
+
+    Full servers keep a token weight so there's always a server to pick.
+    """
+    return max(100 - (server.capacity or 0), 1)
+
+
+def score(node, key, weight):
+    """The weighted rendezvous score of key for node, higher is better.
+
+    Uses the logarithmic method so each key's chance of scoring highest is
+    proportional to its weight.
+
+    :param node: The node id.
+    :param key: Identifies what's being scored, e.g. a hostname.
+    :param weight: A positive weight.
+    """
+    digest = hashlib.blake2b(
+        "{}\0{}".format(node, key).encode('utf-8'), digest_size=8).digest()
+    # A uniform sample from the open interval (0, 1).
+    sample = (int.from_bytes(digest, 'big') + 0.5) / 2 ** 64
+
+    return weight / -math.log(sample)
+
+
+def rank(node, servers, weight=capacity):
+    """Order servers by their rendezvous score for node, best first.
+
+    :param node: The node id.
+    :param servers: A list of servers.
+    :param weight: Gives the weight of a server.
+    :return: A new list of the servers.
+    """
+    return sorted(servers, key=lambda s: score(node, s.hostname, weight(s)),
+                  reverse=True)
@@ -0,0 +1,189 @@
+import heapq
+"""
+This module ranks servers on several factors at once.
+
+Each server's score is a weighted sum of its factors, each divided by a scale
+so they're comparable: a server at SCALES[factor] counts one point per unit of
+weight. Lower scores are better.
+
+    capacity  the server's load in percent
+    rtt       round trip time in ms
+    jitter    variation in round trip time in ms
+    loss      the ratio of probes lost
+    distance  km from an origin, when one is known
+
+The whole candidate set is scored in one pass, with NumPy if it's installed
+and in pure Python if not.
+"""
+
+FACTORS = ('capacity', 'rtt', 'jitter', 'loss', 'distance')
+
+"""
+The value of each factor that scores one point per unit of weight.
+"""
+SCALES = {
+    'capacity': 100.0,
+    'rtt': 100.0,
+    'jitter': 100.0,
+    'loss': 0.1,
+    'distance': 1000.0
+}
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        return None
+
+    return numpy
+
+
+class Scorer(object):
+    def __init__(self, weights, backend='auto'):
+        """Score servers on a weighted sum of their factors.
+
+        :param weights: A dictionary of {factor: weight}. Factors left out
+            are ignored.
+        :param backend: 'numpy', 'python' or 'auto' to use NumPy if it's
+            installed.
+        :raises ValueError: If a factor or the backend is unknown.
+        """
+        unknown = set(weights) - set(FACTORS)
+
+        if unknown:
+            raise ValueError("Unknown scoring factors: {}".format(
+                ", ".join(sorted(unknown))))
+
+        if backend not in ('auto', 'numpy', 'python'):
+            raise ValueError("Unknown scoring backend {}".format(backend))
+
+        self.weights = {f: float(w) for f, w in weights.items() if w}
+        self._numpy = None
+
+        if backend != 'python':
+            self._numpy = _numpy()
+
+            if self._numpy is None and backend == 'numpy':
+                raise ValueError("The numpy scoring backend needs NumPy")
+
+    @property
+    def backend(self):
+        return 'python' if self._numpy is None else 'numpy'
+
+    def score(self, servers, latency=None, distances=None):
+        """Score servers.
+
+        Servers missing a factor, e.g. those never probed, are given the mean
+        of the others so they're neither favoured nor penalised for it.
+
+        :param servers: A list of servers.
+        :param latency: A dictionary of {hostname: history.Score} giving the
+            rtt, jitter and loss of servers.
+        :param distances: Distance in km of each server, in the same order as
+            servers. The distance factor is ignored without them.
+        :return: A list of scores in the same order as servers.
+        """
+        servers = list(servers)
+        columns = self._columns(servers, latency or {}, distances)
+
+        if self._numpy is not None:
+            return self._scoreNumpy(columns, len(servers)).tolist()
+
+        return self._scorePython(columns, len(servers))
+
+    def rank(self, servers, latency=None, distances=None, k=None):
+        """The k best servers, see score().
+
+        :param k: How many servers to return; all of them if None.
+        :return: A list of (server, score) tuples, best first. Servers with
+            equal scores keep their order.
+        """
+        servers = list(servers)
+        k = len(servers) if k is None else min(k, len(servers))
+
+        if k <= 0:
+            return []
+
+        columns = self._columns(servers, latency or {}, distances)
+
+        if self._numpy is not None:
+            totals = self._scoreNumpy(columns, len(servers))
+            best = self._topNumpy(totals, k)
+            return [(servers[i], float(totals[i])) for i in best]
+
+        totals = self._scorePython(columns, len(servers))
+        best = heapq.nsmallest(k, range(len(servers)), key=totals.__getitem__)
+
+        return [(servers[i], totals[i]) for i in best]
+
+    def _columns(self, servers, latency, distances):
+        """The values of each weighted factor, None where unknown.
+
+        :return: A list of (coefficient, values) tuples.
+        """
+        columns = []
+        records = None
+
+        for factor, weight in self.weights.items():
+            if factor == 'capacity':
+                values = [s.capacity for s in servers]
+            elif factor == 'distance':
+                if distances is None:
+                    continue
+
+                values = list(distances)
+            else:
+                if records is None:
+                    records = [latency.get(s.hostname) for s in servers]
+
+                values = [getattr(r, factor, None) for r in records]
+
+            columns.append((weight / SCALES[factor], values))
+
+        return columns
+
+    @staticmethod
+    def _scorePython(columns, count):
+        totals = [0.0] * count
+
+        for coefficient, values in columns:
+            known = [v for v in values if v is not None]
+            mean = sum(known) / len(known) if known else 0.0
+
+            totals = [t + coefficient * (mean if v is None else v)
+                      for t, v in zip(totals, values)]
+
+        return totals
+
+    def _scoreNumpy(self, columns, count):
+        np = self._numpy
+
+        if not columns:
+            return np.zeros(count)
+
+        matrix = np.array([[np.nan if v is None else v for v in values]
+                           for _, values in columns], dtype=float)
+        coefficients = np.array([c for c, _ in columns])
+
+        known = ~np.isnan(matrix)
+        counts = known.sum(axis=1)
+        sums = np.where(known, matrix, 0.0).sum(axis=1)
+        means = np.divide(sums, counts, out=np.zeros_like(sums),
+                          where=counts > 0)
+
+        return coefficients @ np.where(known, matrix, means[:, None])
+
+    def _topNumpy(self, totals, k):
+        """Indexes of the k smallest totals in order, ties in index order."""
+        np = self._numpy
+
+        if k < len(totals):
+            threshold = np.partition(totals, k - 1)[k - 1]
+            indexes = np.flatnonzero(totals <= threshold)
+        else:
+            indexes = np.arange(len(totals))
+
+        order = np.argsort(totals[indexes], kind='stable')
+
+        return indexes[order[:k]].tolist()
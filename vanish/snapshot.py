@@ -0,0 +1,183 @@
+import math
+import mmap
+import os
+import struct
+import sys
+from array import array
+from . import model
+"""
+This module reads and writes a compact binary snapshot of the server list so
+it can be loaded without parsing JSON.
+
+The snapshot is columnar. Every distinct string is stored once in a string
+table and each string field is a column of indexes into that table. Numeric
+fields are stored as plain integer or double columns, unknown coordinates as
+NaN. Each column is padded to a multiple of its item size.
+
+    header   magic, version, byte order, server count, string count
+    strings  string count + 1 offsets followed by the UTF-8 string data
+    columns  one array of server count entries per field in SCHEMA
+"""
+
+MAGIC = b'VNSH'
+
+"""
+Bump VERSION whenever SCHEMA or the layout changes so old snapshots are
+ignored rather than misread.
+"""
+VERSION = 2
+
+SCHEMA = (
+    ('continent', 'I'),
+    ('continentCode', 'I'),
+    ('country', 'I'),
+    ('countryCode', 'I'),
+    ('region', 'I'),
+    ('regionCode', 'I'),
+    ('regionAbbr', 'I'),
+    ('city', 'I'),
+    ('title', 'I'),
+    ('hostname', 'I'),
+    ('ip', 'I'),
+    ('capacity', 'i'),
+    ('latitude', 'd'),
+    ('longitude', 'd'),
+)
+
+_HEADER = struct.Struct('<4sIBxxxII')
+_BYTEORDER = {'little': 0, 'big': 1}[sys.byteorder]
+_NAN = float('nan')
+
+
+class SnapshotError(RuntimeError):
+    pass
+
+
+def dump(servers, path):
+    """Write a snapshot of servers to path.
+
+    The snapshot is written to a temporary file first and renamed into place
+    so readers never see a partial snapshot.
+
+    :param servers: A list of model.Server instances.
+    :param path: Path to write the snapshot to.
+    """
+    strings = {}
+    columns = []
+
+    for field, typecode in SCHEMA:
+        values = (getattr(s, field) for s in servers)
+
+        if typecode == 'I':
+            values = (strings.setdefault(v, len(strings)) for v in values)
+        elif typecode == 'd':
+            values = (_NAN if v is None else v for v in values)
+
+        columns.append(array(typecode, values))
+
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = array('I', [0])
+
+    for s in encoded:
+        offsets.append(offsets[-1] + len(s))
+
+    data = b''.join(encoded)
+    data += b'\x00' * (-len(data) % 4)
+
+    temp_path = path + '.tmp'
+
+    with open(temp_path, 'wb') as h:
+        h.write(_HEADER.pack(
+            MAGIC, VERSION, _BYTEORDER, len(servers), len(strings)))
+        offsets.tofile(h)
+        h.write(data)
+
+        for column in columns:
+            h.write(b'\x00' * (-h.tell() % column.itemsize))
+            column.tofile(h)
+
+    os.replace(temp_path, path)
+
+
+def load(path, use_mmap=True):
+    """Load servers from a snapshot.
+
+    :param path: Path to the snapshot.
+    :param use_mmap: Memory map the snapshot rather than reading it.
+    :raises SnapshotError: If the snapshot is invalid or another version.
+    :return: A list of model.Server instances.
+    """
+    try:
+        with open(path, 'rb') as h:
+            if use_mmap:
+                buffer = mmap.mmap(h.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                buffer = h.read()
+    except ValueError as e:
+        raise SnapshotError("Invalid snapshot {}: {}".format(path, e))
+
+    try:
+        with memoryview(buffer) as view:
+            return _read(view)
+    except (UnicodeDecodeError, IndexError) as e:
+        raise SnapshotError("Invalid snapshot {}: {}".format(path, e))
+    finally:
+        if use_mmap:
+            buffer.close()
+
+
+def _read(view):
+    if len(view) < _HEADER.size:
+        raise SnapshotError("Truncated snapshot")
+
+    magic, version, byteorder, count, nstrings = _HEADER.unpack_from(view)
+
+    if magic != MAGIC or version != VERSION or byteorder != _BYTEORDER:
+        raise SnapshotError("Unsupported snapshot version")
+
+    # Views into the buffer are released by the with statements even when
+    # reading fails so the underlying mmap can always be closed.
+    position = _HEADER.size + (nstrings + 1) * 4
+    _checkSize(view, position)
+
+    with view[_HEADER.size:position].cast('I') as offsets:
+        size = offsets[nstrings]
+        _checkSize(view, position + size)
+
+        with view[position:position + size] as blob:
+            strings = [
+                str(blob[offsets[i]:offsets[i + 1]], 'utf-8')
+                for i in range(nstrings)
+            ]
+
+    position += size + (-size % 4)
+    columns = []
+
+    for field, typecode in SCHEMA:
+        itemsize = array(typecode).itemsize
+        position += -position % itemsize
+        end = position + count * itemsize
+        _checkSize(view, end)
+
+        with view[position:end].cast(typecode) as column:
+            if typecode == 'I':
+                columns.append([strings[i] for i in column])
+            elif typecode == 'd':
+                columns.append(
+                    [None if math.isnan(v) else v for v in column])
+            else:
+                columns.append(column.tolist())
+
+        position = end
+
+    if position != len(view):
+        raise SnapshotError("Unexpected snapshot size")
+
+    fields = [field for field, _ in SCHEMA]
+
+    return [model.Server(**dict(zip(fields, row))) for row in zip(*columns)]
+
+
+def _checkSize(view, size):
+    if len(view) < size:
+        raise SnapshotError("Truncated snapshot")
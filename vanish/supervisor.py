@@ -0,0 +1,419 @@
+import contextlib
+import os
+import select
+import socket
+import subprocess
+import time
+from . import trace
+"""
+This module runs openvpn under supervision through its management interface.
+
+openvpn is started with --management-hold so it waits for us to attach to
+its management socket before connecting. Real time state notifications and
+byte counts are then streamed to us, see
+https://openvpn.net/community-resources/management-interface/
+"""
+
+
+class TunnelError(RuntimeError):
+    pass
+
+
+class Tunnel(object):
+    CONNECTED = 'CONNECTED'
+
+    """
+    States openvpn reports once a connected tunnel has gone down.
+    """
+    DOWN = ('RECONNECTING', 'EXITING')
+
+    def __init__(self, name, config_file, ca_file, management_path,
+                 args=(), openvpn='openvpn', bytecount=5):
+        """An openvpn process and its management connection.
+
+        :param name: A name for the tunnel used in messages.
+        :param config_file: The ovpn configuration file.
+        :param ca_file: The certificate file for IPVanishs servers.
+        :param management_path: Path for openvpn's management socket.
+        :param args: Additional arguments to pass to openvpn.
+        :param openvpn: The openvpn executable.
+        :param bytecount: Seconds between byte count notifications.
+        """
+        self.name = name
+        self.state = None
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.started = None
+        self.changed = None
+        self.active = None
+
+        self._command = [
+            openvpn,
+            '--config', config_file,
+            '--ca', ca_file,
+            '--management', management_path, 'unix',
+            '--management-hold'
+        ] + list(args)
+        self._management_path = management_path
+        self._bytecount = bytecount
+        self._process = None
+        self._socket = None
+        self._buffer = b''
+
+    def start(self, timeout=10):
+        """Start openvpn and attach to its management interface.
+
+        :param timeout: Seconds to wait for the management socket.
+        :raises TunnelError: If openvpn can't be started or attached to.
+        """
+        with trace.span('tunnel.start', server=self.name):
+            self._start(timeout)
+
+    def _start(self, timeout):
+        if os.path.exists(self._management_path):
+            os.unlink(self._management_path)
+
+        try:
+            self._process = subprocess.Popen(
+                self._command,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL
+            )
+        except OSError as e:
+            raise TunnelError("Failed to run openvpn: {}".format(e))
+
+        self.started = self.changed = self.active = time.monotonic()
+        deadline = self.started + timeout
+
+        while self._socket is None:
+            if self._process.poll() is not None:
+                raise TunnelError("openvpn exited with code {}".format(
+                    self._process.returncode))
+
+            if time.monotonic() > deadline:
+                raise TunnelError("openvpn management interface didn't "
+                                  "start")
+
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+            try:
+                sock.connect(self._management_path)
+            except OSError:
+                sock.close()
+                time.sleep(0.05)
+                continue
+
+            sock.setblocking(False)
+            self._socket = sock
+
+        self._send('state on')
+        self._send('bytecount {}'.format(self._bytecount))
+        self._send('hold release')
+
+    def fileno(self):
+        return self._socket.fileno()
+
+    @property
+    def returncode(self):
+        """openvpn's exit code or None if it's still running."""
+        return self._process.poll() if self._process else None
+
+    @property
+    def open(self):
+        """Whether the management connection is open."""
+        return self._socket is not None
+
+    @property
+    def connected(self):
+        return self.state == self.CONNECTED
+
+    def poll(self):
+        """Process any pending management notifications without blocking.
+
+        :return: A list of (type, fields) notifications received, e.g.
+            ('STATE', ['1567...', 'CONNECTED', 'SUCCESS', ...]).
+        """
+        if self._socket is None:
+            return []
+
+        try:
+            data = self._socket.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return []
+        except OSError:
+            data = b''
+
+        if not data:
+            self._close()
+
+        self._buffer += data
+        *lines, self._buffer = self._buffer.split(b'\n')
+        notifications = []
+
+        for line in lines:
+            line = line.decode('utf-8', 'replace').rstrip('\r')
+
+            if not line.startswith('>') or ':' not in line:
+                continue
+
+            type, _, payload = line[1:].partition(':')
+            fields = payload.split(',')
+            notifications.append((type, fields))
+            self._notify(type, fields)
+
+        return notifications
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds for a notification and process it."""
+        if self._socket is not None:
+            select.select([self._socket], [], [], timeout)
+        else:
+            time.sleep(timeout)
+
+        return self.poll()
+
+    def stop(self, timeout=5):
+        """Ask openvpn to exit, killing it if it doesn't within timeout."""
+        if self._process is None:
+            return
+
+        if self._socket is not None:
+            try:
+                self._send('signal SIGTERM')
+            except OSError:
+                pass
+
+        try:
+            self._process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self._process.kill()
+            self._process.wait()
+
+        self._close()
+
+        if os.path.exists(self._management_path):
+            os.unlink(self._management_path)
+
+    def _notify(self, type, fields):
+        now = time.monotonic()
+
+        if type == 'STATE' and len(fields) > 1:
+            if fields[1] != self.state:
+                self.state = fields[1]
+                self.changed = now
+
+                if self.state == self.CONNECTED:
+                    self.active = now
+        elif type == 'BYTECOUNT' and len(fields) == 2:
+            bytesIn, bytesOut = int(fields[0]), int(fields[1])
+
+            if bytesIn > self.bytesIn:
+                self.active = now
+
+            self.bytesIn, self.bytesOut = bytesIn, bytesOut
+
+    def _send(self, command):
+        self._socket.setblocking(True)
+
+        try:
+            self._socket.sendall(command.encode('utf-8') + b'\n')
+        finally:
+            self._socket.setblocking(False)
+
+    def _close(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+
+class Supervisor(object):
+    def __init__(self, servers, launch, connect_timeout=30,
+                 stall_timeout=60, race=1, stagger=0.5, failover=True):
+        """Keep a tunnel up, failing over through a list of servers.
+
+        Tunnels to the first race servers are started stagger seconds apart
+        and the first to connect is kept while the rest are torn down, so
+        the time to connect is that of the fastest server rather than the
+        first choice. A server that fails to connect is replaced straight
+        away by the next in the list.
+
+        When the tunnel drops or stops receiving traffic the next servers in
+        the list are raced straight away rather than selecting servers again.
+
+        :param servers: Servers in order of preference.
+        :param launch: A callable taking a server and returning a context
+            manager that yields a started Tunnel and stops it on exit.
+        :param connect_timeout: Seconds a tunnel has to connect.
+        :param stall_timeout: Seconds a connected tunnel may go without
+            receiving any traffic; 0 disables the check.
+        :param race: The number of servers to race.
+        :param stagger: Seconds between starting each tunnel in a race.
+        :param failover: Whether to connect again once the tunnel fails.
+        """
+        self._servers = list(servers)
+        self._launch = launch
+        self._connect_timeout = connect_timeout
+        self._stall_timeout = stall_timeout
+        self._race = max(1, race)
+        self._stagger = stagger
+        self._failover = failover
+        self._stopping = False
+        self.tunnel = None
+
+    def run(self):
+        """Supervise tunnels until stopped.
+
+        :raises TunnelError: If every server failed.
+        """
+        remaining = list(self._servers)
+
+        while remaining and not self._stopping:
+            with contextlib.ExitStack() as stack:
+                server, tunnel = self._raceNext(remaining, stack)
+
+                if tunnel is None:
+                    continue
+
+                remaining.remove(server)
+                self.tunnel = tunnel
+
+                try:
+                    reason = self._watch(tunnel)
+                finally:
+                    self.tunnel = None
+
+            if reason is None:
+                return
+
+            print("{}: {}".format(server.hostname, reason))
+
+            if not self._failover:
+                return
+
+        if not self._stopping:
+            raise TunnelError("No servers left to fail over to")
+
+    def stop(self):
+        """Stop supervising and disconnect, safe to call from any thread."""
+        self._stopping = True
+
+    def _raceNext(self, remaining, stack):
+        """Race tunnels to the next servers in remaining.
+
+        Servers that fail are removed from remaining. The winning tunnel is
+        pushed on to stack and the others are stopped.
+
+        :return: The winning server and tunnel or (None, None) if they all
+            failed or we were stopped.
+        """
+        pending = remaining[:self._race]
+        running = []
+        due = time.monotonic()
+
+        if len(pending) > 1:
+            print("Racing {}".format(", ".join(s.hostname for s in pending)))
+
+        try:
+            while (pending or running) and not self._stopping:
+                now = time.monotonic()
+
+                if pending and now >= due:
+                    server = pending.pop(0)
+                    exit = contextlib.ExitStack()
+
+                    try:
+                        tunnel = exit.enter_context(self._launch(server))
+                    except TunnelError as e:
+                        exit.close()
+                        self._failed(server, str(e), remaining)
+                        self._refill(pending, running, remaining)
+                        continue
+
+                    running.append((server, tunnel, exit))
+                    due = time.monotonic() + self._stagger
+                    continue
+
+                timeout = max(0, min(0.5, due - now)) if pending else 0.5
+                sockets = [t for _, t, _ in running if t.open]
+
+                if sockets:
+                    select.select(sockets, [], [], timeout)
+                else:
+                    time.sleep(timeout)
+
+                now = time.monotonic()
+
+                for entry in list(running):
+                    server, tunnel, exit = entry
+                    tunnel.poll()
+
+                    if tunnel.connected:
+                        running.remove(entry)
+                        stack.enter_context(exit)
+                        print("Connected to {} in {:.1f}s".format(
+                            tunnel.name, now - tunnel.started))
+                        return server, tunnel
+
+                    if tunnel.returncode is not None:
+                        reason = "openvpn exited with code {}".format(
+                            tunnel.returncode)
+                    elif now - tunnel.started > self._connect_timeout:
+                        reason = "timed out connecting"
+                    else:
+                        continue
+
+                    running.remove(entry)
+                    exit.close()
+                    self._failed(server, reason, remaining)
+                    # Start the next server now rather than waiting out the
+                    # stagger.
+                    self._refill(pending, running, remaining)
+                    due = now
+
+            return None, None
+        finally:
+            for _, _, exit in running:
+                exit.close()
+
+    def _refill(self, pending, running, remaining):
+        """Top pending up from remaining so race servers are in the race.
+
+        Servers that failed have already left remaining; those pending or
+        running are skipped.
+        """
+        racing = pending + [s for s, _, _ in running]
+
+        for server in remaining:
+            if len(racing) >= self._race:
+                break
+
+            if server not in racing:
+                pending.append(server)
+                racing.append(server)
+
+    def _failed(self, server, reason, remaining):
+        print("{}: {}".format(server.hostname, reason))
+        remaining.remove(server)
+
+    def _watch(self, tunnel):
+        """Watch a connected tunnel until it fails.
+
+        :return: Why the tunnel failed or None if stopped.
+        """
+        while not self._stopping:
+            tunnel.wait(0.5)
+            now = time.monotonic()
+
+            if tunnel.returncode is not None:
+                return "openvpn exited with code {}".format(
+                    tunnel.returncode)
+
+            if tunnel.state in Tunnel.DOWN:
+                return "connection dropped ({})".format(tunnel.state)
+
+            if (self._stall_timeout
+                    and now - tunnel.active > self._stall_timeout):
+                return "no traffic for {}s".format(self._stall_timeout)
+
+        return None
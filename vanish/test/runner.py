@@ -2,6 +2,18 @@ import sys
 import unittest
 from . import test_model
 from . import test_application
+from . import test_probe
+from . import test_utils
+from . import test_history
+from . import test_daemon
+from . import test_supervisor
+from . import test_trace
+from . import test_scoring
+from . import test_geo
+from . import test_completion
+from . import test_output
+from . import test_mirror
+from . import test_rendezvous
 
 
 if __name__ == "__main__":
@@ -9,7 +21,19 @@ if __name__ == "__main__":
 
     suites = [
         loader.loadTestsFromModule(test_model),
-        loader.loadTestsFromModule(test_application)
+        loader.loadTestsFromModule(test_application),
+        loader.loadTestsFromModule(test_probe),
+        loader.loadTestsFromModule(test_utils),
+        loader.loadTestsFromModule(test_history),
+        loader.loadTestsFromModule(test_daemon),
+        loader.loadTestsFromModule(test_supervisor),
+        loader.loadTestsFromModule(test_trace),
+        loader.loadTestsFromModule(test_scoring),
+        loader.loadTestsFromModule(test_geo),
+        loader.loadTestsFromModule(test_completion),
+        loader.loadTestsFromModule(test_output),
+        loader.loadTestsFromModule(test_mirror),
+        loader.loadTestsFromModule(test_rendezvous)
     ]
 
     all_tests = unittest.TestSuite(suites)
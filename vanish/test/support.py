@@ -0,0 +1,409 @@
+import gzip
+import hashlib
+import io
+import json
+import os
+import random
+import stat
+import sys
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from zipfile import ZipFile, ZIP_DEFLATED
+"""
+Local stand-ins used by the tests so they don't depend on IPVanish or on
+system binaries.
+"""
+
+
+def fake_executable(directory, name, source):
+    """Write a python script to directory that can be executed as name.
+
+    :param directory: Directory to write the executable to.
+    :param name: The executable name.
+    :param source: Python source code for the executable.
+    :return: The path to the executable.
+    """
+    path = os.path.join(directory, name)
+
+    with open(path, 'w') as h:
+        h.write("#!{}\n".format(sys.executable))
+        h.write(source)
+
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+
+    return path
+
+
+class prepend_path(object):
+    def __init__(self, directory):
+        """Context manager placing directory at the front of PATH.
+
+        :param directory: The directory to search first for executables.
+        """
+        self._directory = directory
+        self._path = None
+
+    def __enter__(self):
+        self._path = os.environ.get('PATH', '')
+        os.environ['PATH'] = os.pathsep.join([self._directory, self._path])
+        return self
+
+    def __exit__(self, *args):
+        os.environ['PATH'] = self._path
+
+
+FAKE_PING = """
+import sys
+import time
+
+address = sys.argv[-1]
+count = int(sys.argv[sys.argv.index('-c') + 1])
+
+time.sleep(0.2)
+
+if address.startswith('192.0.2.'):
+    sys.exit(1)
+
+# Addresses in 198.51.100.0/24 lose every other reply.
+for sequence in range(1, count + 1):
+    if address.startswith('198.51.100.') and sequence % 2 == 0:
+        continue
+
+    print("64 bytes from {}: icmp_seq={} ttl=64 time={} ms".format(
+        address, sequence, 10 + sequence))
+"""
+
+
+FAKE_OPENVPN = """
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+args = sys.argv[1:]
+
+# Unsupervised connections just run until openvpn exits.
+if '--management' not in args:
+    sys.exit(0)
+
+management = args[args.index('--management') + 1]
+
+with open(args[args.index('--config') + 1]) as h:
+    hostname = [l.split()[1] for l in h if l.startswith('remote ')][0]
+
+# FAKE_OPENVPN maps hostnames to how their tunnel behaves:
+#   connect, delay:<seconds>, fail, hang, drop:<seconds>, stall
+behaviour = json.loads(os.environ.get('FAKE_OPENVPN', '{}')).get(
+    hostname, 'connect')
+behaviour, _, argument = behaviour.partition(':')
+argument = float(argument or 0)
+
+
+def log(event):
+    if 'FAKE_OPENVPN_LOG' in os.environ:
+        with open(os.environ['FAKE_OPENVPN_LOG'], 'a') as h:
+            h.write("{} {}\\n".format(hostname, event))
+
+
+server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+server.bind(management)
+server.listen(1)
+connection, _ = server.accept()
+lock = threading.Lock()
+released = threading.Event()
+interval = [0]
+
+
+def send(line):
+    with lock:
+        connection.sendall(line.encode('utf-8') + b'\\n')
+
+
+def state(name):
+    send(">STATE:{},{},,,".format(int(time.time()), name))
+
+
+def commands():
+    for line in connection.makefile('r'):
+        command = line.split()
+        send("SUCCESS: {}".format(line.strip()))
+
+        if command[:2] == ['hold', 'release']:
+            released.set()
+        elif command[:1] == ['bytecount']:
+            interval[0] = float(command[1])
+        elif command[:2] == ['signal', 'SIGTERM']:
+            state('EXITING')
+            log('stopped')
+            os._exit(0)
+
+    os._exit(0)
+
+
+threading.Thread(target=commands, daemon=True).start()
+send(">INFO:OpenVPN Management Interface Version 3 -- type 'help'")
+send(">HOLD:Waiting for hold release:0")
+released.wait()
+log('started')
+
+if behaviour == 'fail':
+    log('failed')
+    os._exit(1)
+
+for name in ('RESOLVE', 'WAIT', 'AUTH'):
+    state(name)
+
+if behaviour == 'hang':
+    time.sleep(3600)
+
+time.sleep(argument if behaviour == 'delay' else 0.05)
+state('GET_CONFIG')
+state('ASSIGN_IP')
+state('CONNECTED')
+log('connected')
+received = 0
+connected = time.monotonic()
+
+while True:
+    time.sleep(interval[0] or 0.1)
+
+    if behaviour == 'drop' and time.monotonic() - connected > argument:
+        state('RECONNECTING')
+        log('dropped')
+        time.sleep(3600)
+
+    if behaviour != 'stall':
+        received += 1024
+
+    if interval[0]:
+        send(">BYTECOUNT:{},{}".format(received, received // 2))
+"""
+
+
+CITIES = [
+    ('Europe', 'EU', 'United Kingdom', 'GB', 'England', 'ENG', 'London',
+     'lon', 51.5, -0.1),
+    ('Europe', 'EU', 'United Kingdom', 'GB', 'England', 'ENG', 'Manchester',
+     'man', 53.5, -2.2),
+    ('Europe', 'EU', 'Germany', 'DE', 'Hesse', 'HE', 'Frankfurt',
+     'fra', 50.1, 8.7),
+    ('Europe', 'EU', 'France', 'FR', '', '', 'Paris', 'par', 48.9, 2.4),
+    ('North America', 'NA', 'United States', 'US', 'New York', 'NY',
+     'New York', 'nyc', 40.7, -74.0),
+    ('North America', 'NA', 'United States', 'US', 'California', 'CA',
+     'Los Angeles', 'lax', 34.1, -118.2),
+    ('North America', 'NA', 'Canada', 'CA', 'Ontario', 'ON', 'Toronto',
+     'tor', 43.7, -79.4),
+    ('Asia', 'AS', 'Japan', 'JP', 'Tokyo', '13', 'Tokyo', 'tyo', 35.7, 139.7),
+    ('Oceania', 'OC', 'Australia', 'AU', 'New South Wales', 'NSW', 'Sydney',
+     'syd', -33.9, 151.2),
+    ('South America', 'SA', 'Brazil', 'BR', 'Sao Paulo', 'SP', 'Sao Paulo',
+     'gru', -23.6, -46.6),
+]
+
+
+def synthetic_features(count, seed=0):
+    """Generate features shaped like the IPVanish servers.geojson.
+
+    :param count: The number of servers to generate.
+    :param seed: Seed for the pseudo random capacities.
+    :return: A list of geojson features.
+    """
+    rand = random.Random(seed)
+    features = []
+
+    for i in range(count):
+        (continent, continentCode, country, countryCode, region, regionCode,
+         city, code, lat, lon) = CITIES[i % len(CITIES)]
+        letter = 'abc'[(i // len(CITIES)) % 3]
+        number = i // (len(CITIES) * 3) + 1
+        prefix = "{}-{}{:02d}".format(code, letter, number)
+
+        features.append({
+            "type": "Feature",
+            "geometry": {
+                "type": "Point",
+                "coordinates": [lon + rand.uniform(-0.1, 0.1),
+                                lat + rand.uniform(-0.1, 0.1)]
+            },
+            "properties": {
+                "continent": continent,
+                "continentCode": continentCode,
+                "country": country,
+                "countryCode": countryCode,
+                "region": region,
+                "regionCode": regionCode,
+                "regionAbbr": regionCode,
+                "city": city,
+                "title": "{}, {}".format(city, country),
+                "hostname": "{}.ipvanish.com".format(prefix),
+                "ip": "10.{}.{}.{}".format(i >> 16 & 255, i >> 8 & 255,
+                                           i & 255),
+                "capacity": rand.randint(0, 100),
+                "online": True,
+                "visible": True,
+                "marker-color": "#70bb44",
+                "marker-cluster-small": "#70bb44"
+            }
+        })
+
+    return features
+
+
+def synthetic_geojson(count, seed=0):
+    """Serialise synthetic_features as the servers.geojson download.
+
+    :return: The document as bytes.
+    """
+    return json.dumps(synthetic_features(count, seed)).encode('utf-8')
+
+
+OVPN_TEMPLATE = """client
+dev tun
+proto udp
+remote {hostname} 443
+resolv-retry infinite
+nobind
+persist-key
+persist-tun
+ca ca.ipvanish.com.crt
+verify-x509-name {hostname} name
+auth-user-pass
+comp-lzo
+verb 3
+auth SHA256
+cipher AES-256-CBC
+keysize 256
+tls-cipher TLS-DHE-RSA-WITH-AES-256-CBC-SHA:TLS-DHE-DSS-WITH-AES-256-CBC-SHA
+"""
+
+
+def synthetic_configs(features):
+    """Generate the ovpn configs IPVanish publishes for features.
+
+    :param features: Features from synthetic_features.
+    :return: A dictionary of {archive member name: bytes}.
+    """
+    files = {'ca.ipvanish.com.crt': b'-----BEGIN CERTIFICATE-----\n'}
+
+    for feature in features:
+        properties = feature['properties']
+        countryCode = properties['countryCode'].replace('GB', 'UK')
+        hostname = properties['hostname']
+        name = "ipvanish-{}-{}-{}.ovpn".format(
+            countryCode,
+            properties['city'].replace(' ', '-'),
+            hostname.split('.')[0])
+
+        files[name] = OVPN_TEMPLATE.format(hostname=hostname).encode('utf-8')
+
+    return files
+
+
+def synthetic_zip(files):
+    """Zip files in memory.
+
+    :param files: A dictionary of {member name: bytes}.
+    :return: The archive as bytes.
+    """
+    buffer = io.BytesIO()
+
+    with ZipFile(buffer, 'w', ZIP_DEFLATED) as zip:
+        for name in sorted(files):
+            zip.writestr(name, files[name])
+
+    return buffer.getvalue()
+
+
+class LocalServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, files):
+        """A local HTTP stand-in for IPVanish serving content from memory.
+
+        Responses carry an ETag and honour If-None-Match, and Range with
+        If-Range. Bodies are gzip encoded when the client accepts it. Every
+        request's path and headers are recorded in requests.
+
+        Set truncate[path] to a number of bytes to drop the connection after
+        sending that much of the next response for path.
+
+        :param files: A dictionary of {path: bytes} to serve.
+        """
+        super(LocalServer, self).__init__(('127.0.0.1', 0), _Handler)
+        self.files = files
+        self.requests = []
+        self.truncate = {}
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+
+    def url(self, path):
+        return "http://127.0.0.1:{}{}".format(self.server_address[1], path)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+
+        if self.path not in self.server.files:
+            self.send_error(404)
+            return
+
+        body = self.server.files[self.path]
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        range = self.headers.get('Range', '')
+        start = 0
+
+        if (range.startswith('bytes=')
+                and self.headers.get('If-Range', etag) == etag):
+            start = int(range[len('bytes='):].split('-')[0])
+
+        if start >= len(body) > 0:
+            self.send_response(416)
+            self.end_headers()
+            return
+
+        self.send_response(206 if start else 200)
+        self.send_header('ETag', etag)
+
+        if start:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                start, len(body) - 1, len(body)))
+            body = body[start:]
+        elif 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        truncate = self.server.truncate.pop(self.path, None)
+
+        if truncate is not None:
+            self.wfile.write(body[:truncate])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
@@ -1,4 +1,5 @@
 import unittest
+import subprocess
 import sys
 from .. import application
 from io import StringIO
@@ -44,3 +45,25 @@ class TestCommands(unittest.TestCase):
     @unittest.skip("Takes too long")
     def test_ping(self):
         self.app.run(['ping'])
+
+
+class TestStartup(unittest.TestCase):
+    """Guard against commands that don't need them importing slow modules."""
+
+    HEAVY = ['requests', 'tabulate', 'numpy', 'vanish.probe']
+
+    CHILD = """
+import sys
+from vanish.application import Vanish
+Vanish().run(['version'])
+print(' '.join(sys.modules))
+"""
+
+    def test_version_imports(self):
+        output = subprocess.check_output(
+            [sys.executable, '-c', self.CHILD], universal_newlines=True)
+        modules = output.splitlines()[-1].split()
+
+        for module in self.HEAVY:
+            self.assertNotIn(module, modules,
+                             "{} imported by vanish version".format(module))
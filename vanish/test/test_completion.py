@@ -0,0 +1,169 @@
+import unittest
+import tempfile
+import shutil
+import os
+import subprocess
+import sys
+from .. import completion, model
+from ..application import Vanish
+from .support import LocalServer, synthetic_features, synthetic_geojson
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+
+class TestCompletionIndex(unittest.TestCase):
+    def setUp(self):
+        self.working_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.working_dir, 'servers.completion')
+        servers = [model.Server.fromFeature(f)
+                   for f in synthetic_features(40)]
+        completion.dump(servers, self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.working_dir)
+
+    def test_lookup(self):
+        self.assertEqual(completion.lookup(self.path, 'cities', 'lo'),
+                         ['London', 'Los Angeles'])
+        self.assertEqual(completion.lookup(self.path, 'countries', 'GER'),
+                         ['Germany'])
+        self.assertEqual(completion.lookup(self.path, 'countries', 'u'),
+                         ['United Kingdom', 'United States', 'US'])
+        self.assertEqual(completion.lookup(self.path, 'regions', 'zz'), [])
+        self.assertEqual(len(completion.lookup(self.path, 'continents')), 10)
+
+    def test_invalid(self):
+        with open(self.path, 'w') as h:
+            h.write('something else\n')
+
+        with self.assertRaises(ValueError):
+            completion.lookup(self.path, 'cities', 'lo')
+
+        with open(self.path, 'wb') as h:
+            h.write(b'VNCI 1\ncities\tlo\t\xffLondon\n')
+
+        with self.assertRaises(ValueError):
+            completion.lookup(self.path, 'cities', 'lo')
+
+    def test_every_prefix(self):
+        """Bisecting the file finds what scanning all its lines does."""
+        with open(self.path, encoding='utf-8') as h:
+            lines = h.read().split('\n')[1:-1]
+
+        for line in lines:
+            kind, folded, _ = line.split('\t')
+
+            for end in range(len(folded) + 1):
+                key = "{}\t{}".format(kind, folded[:end])
+                expected = []
+
+                for value in [other.split('\t')[2] for other in lines
+                              if other.startswith(key)]:
+                    if value not in expected:
+                        expected.append(value)
+
+                self.assertEqual(
+                    completion.lookup(self.path, kind, folded[:end]),
+                    expected)
+
+    def test_written_on_update(self):
+        cache = os.path.join(self.working_dir, 'geojson')
+        index = os.path.join(self.working_dir, 'index')
+
+        with LocalServer({'/servers.geojson': synthetic_geojson(20)}) as s:
+            model.GeoJson(s.url('/servers.geojson'), cache,
+                          index_path=index).update()
+
+        self.assertEqual(completion.lookup(index, 'cities', 'tok'),
+                         ['Tokyo'])
+
+
+class TestCompletionScripts(unittest.TestCase):
+    def setUp(self):
+        self.home = tempfile.mkdtemp()
+        directory = os.path.join(self.home, '.config', 'vanish')
+        os.makedirs(directory)
+        servers = [model.Server.fromFeature(f)
+                   for f in synthetic_features(40)]
+        completion.dump(servers, os.path.join(directory,
+                                              'servers.completion'))
+
+        self.env = dict(os.environ, HOME=self.home)
+        self.env['PATH'] = os.pathsep.join(
+            [os.path.join(_ROOT, 'bin'), self.env.get('PATH', '')])
+
+    def tearDown(self):
+        shutil.rmtree(self.home)
+
+    def test_fast_path(self):
+        """__complete answers without loading the application."""
+        output = subprocess.check_output(
+            [sys.executable, '-c',
+             "import sys, runpy; sys.argv = ['vanish'] + sys.argv[1:];"
+             "runpy.run_path({!r}, run_name='__main__')".format(
+                 os.path.join(_ROOT, 'bin', 'vanish')),
+             '__complete', 'cities', 'new'],
+            env=self.env, universal_newlines=True)
+
+        self.assertEqual(output, "New York\n")
+
+        modules = subprocess.check_output(
+            [sys.executable, '-c',
+             "import sys; from vanish import completion;"
+             "completion.main(['cities', 'new']);"
+             "print(' '.join(sys.modules))"],
+            cwd=_ROOT, env=self.env, universal_newlines=True)
+
+        for module in ('vanish.application', 'vanish.model', 'requests',
+                       'tabulate'):
+            self.assertNotIn(module, modules.split())
+
+    def test_invalid_cache(self):
+        """Nothing is completed if the index can't be rebuilt."""
+        directory = os.path.join(self.home, '.config', 'vanish')
+
+        for name in ('servers.completion', 'servers.geojson'):
+            with open(os.path.join(directory, name), 'w') as h:
+                h.write('invalid\n')
+
+        process = subprocess.run(
+            [sys.executable, '-c',
+             "import sys; from vanish import completion;"
+             "sys.exit(completion.main(['cities', 'new']))"],
+            cwd=_ROOT, env=self.env, universal_newlines=True,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        self.assertEqual(process.returncode, 1)
+        self.assertEqual(process.stdout, '')
+        self.assertEqual(process.stderr, '')
+
+    def _bash(self, line):
+        script = completion.script('bash', Vanish()._parser)
+        words = line.split(' ')
+        program = script + """
+COMP_WORDS=({words})
+COMP_CWORD={cword}
+_vanish
+printf '%s\\n' "${{COMPREPLY[@]}}"
+""".format(words=" ".join("'{}'".format(w) for w in words),
+           cword=len(words) - 1)
+
+        return subprocess.check_output(
+            ['bash', '-c', program], env=self.env,
+            universal_newlines=True).splitlines()
+
+    @unittest.skipIf(shutil.which('bash') is None, "bash is not installed")
+    def test_bash(self):
+        self.assertEqual(self._bash('vanish co'), ['completion', 'connect'])
+        self.assertIn('--nearest', self._bash('vanish connect --ne'))
+        self.assertEqual(self._bash('vanish ls co'),
+                         ['continents', 'countries'])
+        self.assertEqual(self._bash('vanish ping --city new'),
+                         ['New\\ York'])
+
+    def test_zsh(self):
+        script = completion.script('zsh', Vanish()._parser)
+
+        self.assertTrue(script.startswith('#compdef vanish'))
+        self.assertIn('--country) kind=countries ;;', script)
@@ -0,0 +1,148 @@
+import unittest
+import tempfile
+import shutil
+import os
+import sys
+import threading
+from io import StringIO
+from .. import application, daemon
+from ..config import config
+from .support import (FAKE_PING, LocalServer, fake_executable, prepend_path,
+                      synthetic_geojson)
+
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        self.working_dir = tempfile.mkdtemp()
+        self.socket = os.path.join(self.working_dir, 'daemon.sock')
+        self.server = LocalServer({'/servers.geojson': synthetic_geojson(40)})
+        self.server.__enter__()
+        self.path = prepend_path(self.working_dir).__enter__()
+        fake_executable(self.working_dir, 'ping', FAKE_PING)
+
+        self.config = dict(config)
+        self.config.update({
+            'geojson.url': self.server.url('/servers.geojson'),
+            'geojson.cache.path': os.path.join(self.working_dir, 'geojson'),
+            'geojson.snapshot.path': None,
+            'completion.index.path': os.path.join(
+                self.working_dir, 'completion'),
+            'geojson.cache.timeout': 60,
+            'history.path': os.path.join(self.working_dir, 'history'),
+            'daemon.socket': self.socket,
+            'daemon.ping.interval': 60,
+            'ping.backend': 'subprocess',
+            'ping.count': 1,
+            'ping.timeout': 5
+        })
+
+        self.daemon = daemon.Daemon(self._app()._services, self.socket)
+        self.thread = threading.Thread(target=self.daemon.serve)
+        self.thread.start()
+        self.assertTrue(self.daemon.ready.wait(10), "Daemon didn't start")
+
+        self.client = daemon.DaemonClient(self.socket)
+
+    def tearDown(self):
+        sys.stdout = sys.__stdout__
+        self.client.close()
+        self.daemon.shutdown()
+        self.thread.join()
+        self.path.__exit__()
+        self.server.__exit__()
+        shutil.rmtree(self.working_dir)
+
+    def _app(self):
+        app = application.Vanish()
+        app._services['config'] = lambda p: self.config
+        return app
+
+    def _run(self, args):
+        sys.stdout = out = StringIO()
+
+        try:
+            app = self._app()
+            app.run(args)
+        finally:
+            sys.stdout = sys.__stdout__
+
+        return app, out.getvalue()
+
+    def test_queries(self):
+        self.assertEqual(self.client.call('status')['servers'], 40)
+        self.assertEqual(len(self.client.call('servers', countries=['de'])),
+                         4)
+        self.assertIn(['Europe', 'EU'], self.client.call('continents'))
+
+    def test_nearest(self):
+        remote = daemon.RemoteServerContainer(self.client)
+        servers = remote.getNearest(50.1, 8.7, 2, continents=['eu'])
+
+        self.assertEqual([s.city for s in servers], ['Frankfurt'] * 2)
+        self.assertIsNotNone(servers[0].latitude)
+
+    def test_unknown_method(self):
+        with self.assertRaises(daemon.DaemonError):
+            self.client.call('nope')
+
+        self.assertEqual(self.client.call('status')['servers'], 40,
+                         "Connection unusable after an error")
+
+    def test_ping(self):
+        results = self.client.call('ping', addresses=['10.0.0.2'], count=1)
+
+        self.assertEqual(results, {'10.0.0.2': [11.0]})
+
+        scores = self.client.call('scores', hostnames=['fra-a01.ipvanish.com'])
+
+        self.assertEqual(scores['fra-a01.ipvanish.com'][0], 11.0)
+
+    def test_measure_leaves_servers(self):
+        """Servers shared between threads aren't given a latency."""
+        self.client.call('ping', addresses=['10.0.0.2'], count=1)
+
+        servers = self.daemon._services['local.servers'].getServers()
+
+        self.assertTrue(all(s.latency is None for s in servers))
+
+    def test_transparent_list(self):
+        app, output = self._run(['list', 'countries'])
+
+        self.assertIsInstance(app._services['servers'],
+                              daemon.RemoteServerContainer)
+        self.assertIn('Germany', output)
+        self.assertFalse(os.path.exists(self.config['geojson.cache.path']
+                                        + '.tmp'))
+        self.assertEqual(len(self.server.requests), 1,
+                         "The CLI downloaded the servers itself")
+
+    def test_transparent_ping(self):
+        app, output = self._run(['ping', '--country', 'fr'])
+
+        self.assertIn('par-a01', output)
+        self.assertIn('11.0 ms', output)
+
+    def test_already_running(self):
+        second = daemon.Daemon(self._app()._services, self.socket)
+
+        with self.assertRaises(daemon.DaemonError):
+            second.serve()
+
+    def test_stale_socket(self):
+        self.daemon.shutdown()
+        self.thread.join()
+
+        with open(self.socket, 'w'):
+            pass
+
+        app, output = self._run(['list', 'countries'])
+
+        self.assertNotIsInstance(app._services['servers'],
+                                 daemon.RemoteServerContainer)
+        self.assertIn('Germany', output)
+
+        self.daemon = daemon.Daemon(self._app()._services, self.socket)
+        self.thread = threading.Thread(target=self.daemon.serve)
+        self.thread.start()
+
+        self.assertTrue(self.daemon.ready.wait(10))
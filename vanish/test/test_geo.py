@@ -0,0 +1,54 @@
+import random
+import unittest
+from .. import geo
+
+
+class TestGeo(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(geo.parse('51.5,-0.13'), (51.5, -0.13))
+
+        for value in ('51.5', 'north,west', '91,0', '0,181'):
+            with self.assertRaises(ValueError):
+                geo.parse(value)
+
+    def test_distance(self):
+        london, new_york = (51.5074, -0.1278), (40.7128, -74.0060)
+
+        self.assertAlmostEqual(geo.distance(london, *new_york), 5570, delta=5)
+        self.assertAlmostEqual(geo.distance((0, 179.5), 0, -179.5), 111,
+                               delta=1)
+        self.assertIsNone(geo.distance(london, None, None))
+
+
+class TestKdTree(unittest.TestCase):
+    def setUp(self):
+        generator = random.Random(0)
+        self.points = [(generator.uniform(-90, 90),
+                        generator.uniform(-180, 180)) for _ in range(2000)]
+        self.points[7] = (None, None)
+        self.tree = geo.KdTree(self.points)
+        self.origins = [(generator.uniform(-90, 90),
+                         generator.uniform(-180, 180)) for _ in range(20)]
+        self.origins += [(90, 0), (-90, 0), (0, 180), (0, -180)]
+
+    def brute(self, origin, count):
+        distances = [(geo.distance(origin, *p), i)
+                     for i, p in enumerate(self.points) if p[0] is not None]
+
+        return sorted(distances)[:count]
+
+    def test_nearest(self):
+        self.assertEqual(len(self.tree), 1999)
+
+        for origin in self.origins:
+            nearest = self.tree.nearest(origin, 10)
+
+            self.assertEqual([i for _, i in nearest],
+                             [i for _, i in self.brute(origin, 10)])
+
+    def test_fewer_points_than_count(self):
+        tree = geo.KdTree([(0, 0), (10, 10), (None, 5)])
+
+        self.assertEqual([i for _, i in tree.nearest((9, 9), 5)], [1, 0])
+        self.assertEqual(tree.nearest((9, 9), 0), [])
+        self.assertEqual(geo.KdTree([]).nearest((0, 0), 3), [])
@@ -0,0 +1,97 @@
+import unittest
+import tempfile
+import shutil
+import os
+from .. import history
+from ..probe import LatencyStats
+
+
+class _Server(object):
+    def __init__(self, hostname, samples):
+        self.hostname = hostname
+        self.latency = LatencyStats(samples) if samples is not None else None
+
+
+class TestLatencyHistory(unittest.TestCase):
+    def setUp(self):
+        self.working_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.working_dir, 'history', 'db.sqlite3')
+        self.history = history.LatencyHistory(self.path, alpha=0.5,
+                                              retention=100)
+
+    def tearDown(self):
+        self.history.close()
+        shutil.rmtree(self.working_dir)
+
+    def test_first_probe(self):
+        self.history.record([_Server('a', [10, 12, 14])], now=1000)
+
+        score = self.history.scores(['a', 'b'])['a']
+
+        self.assertEqual(score.rtt, 12)
+        self.assertEqual(score.jitter, 2)
+        self.assertEqual(score.loss, 0)
+        self.assertEqual(score.updated, 1000)
+        self.assertEqual(score.value, 14)
+        self.assertEqual(self.history.scores(['b']), {})
+
+    def test_ewma(self):
+        self.history.record([_Server('a', [10, 10])], now=1000)
+        self.history.record([_Server('a', [20, None])], now=1001)
+
+        score = self.history.scores(['a'])['a']
+
+        self.assertEqual(score.rtt, 15)
+        self.assertEqual(score.loss, 0.25)
+        self.assertEqual(score.probes, 2)
+
+        self.history.record([_Server('a', [None, None])], now=1002)
+        score = self.history.scores(['a'])['a']
+
+        self.assertEqual(score.rtt, 15, "Lost probes changed the rtt")
+        self.assertEqual(score.loss, 0.625)
+
+    def test_unreachable(self):
+        self.history.record([_Server('a', [None])], now=1000)
+
+        self.assertEqual(self.history.scores(['a'])['a'].value, float('inf'))
+
+    def test_unprobed_ignored(self):
+        self.history.record([_Server('a', None)])
+
+        self.assertEqual(self.history.scores(['a']), {})
+
+    def test_persistent(self):
+        self.history.record([_Server('a', [10])], now=1000)
+        self.history.close()
+
+        reopened = history.LatencyHistory(self.path)
+
+        self.assertEqual(reopened.scores(['a'])['a'].rtt, 10)
+        reopened.close()
+
+    def test_retention(self):
+        self.history.record([_Server('a', [10])], now=1000)
+        self.history.record([_Server('a', [20])], now=1050)
+
+        self.assertEqual(len(self.history.samples('a')), 2)
+
+        self.history.record([_Server('a', [30])], now=1120)
+
+        samples = self.history.samples('a')
+
+        self.assertEqual([s[0] for s in samples], [1050, 1120])
+        self.assertEqual(self.history.scores(['a'])['a'].probes, 3)
+
+    def test_many_hostnames(self):
+        servers = [_Server('s{}'.format(i), [i + 1]) for i in range(1200)]
+        self.history.record(servers)
+
+        scores = self.history.scores(s.hostname for s in servers)
+
+        self.assertEqual(len(scores), 1200)
+
+    def test_record_latency(self):
+        self.history.recordLatency({'a': LatencyStats([10, 12])}, now=1000)
+
+        self.assertEqual(self.history.scores(['a'])['a'].rtt, 11)
@@ -0,0 +1,178 @@
+import unittest
+import tempfile
+import shutil
+import os
+import threading
+import time
+import requests
+from .. import mirror, model
+from ..mirror import Mirror, MirrorError, MirrorServer
+from .support import (LocalServer, synthetic_configs, synthetic_features,
+                      synthetic_geojson, synthetic_zip)
+
+
+class _GatedMirror(Mirror):
+    """Holds refreshes until gate is set."""
+
+    def __init__(self, *args):
+        super(_GatedMirror, self).__init__(*args)
+        self.gate = threading.Event()
+
+    def _refresh(self, name, force):
+        self.gate.wait(5)
+        return super(_GatedMirror, self)._refresh(name, force)
+
+
+class TestMirror(unittest.TestCase):
+    def setUp(self):
+        self.working_dir = tempfile.mkdtemp()
+        self.files = synthetic_configs(synthetic_features(20))
+        self.upstream = LocalServer({
+            '/servers.geojson': synthetic_geojson(20),
+            '/configs.zip': synthetic_zip(self.files)})
+        self.upstream.__enter__()
+        self.mirror = self._mirror(timeout=60)
+        self.server = MirrorServer(self.mirror, ('127.0.0.1', 0))
+        self.thread = threading.Thread(target=self.server.serve)
+        self.thread.start()
+        self.server.ready.wait()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.upstream.__exit__()
+        shutil.rmtree(self.working_dir)
+
+    def _mirror(self, timeout):
+        return Mirror(
+            {'servers.geojson': self.upstream.url('/servers.geojson'),
+             'configs.zip': self.upstream.url('/configs.zip')},
+            os.path.join(self.working_dir, 'mirror'), timeout)
+
+    def _upstreamRequests(self, path):
+        return [h for p, h in self.upstream.requests if p == path]
+
+    def test_etag(self):
+        response = requests.get(self.server.url('configs.zip'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, self.upstream.files['/configs.zip'])
+
+        response = requests.get(
+            self.server.url('configs.zip'),
+            headers={'If-None-Match': response.headers['ETag']})
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(requests.get(self.server.url('other')).status_code,
+                         404)
+
+    def test_gzip(self):
+        response = requests.get(self.server.url('servers.geojson'),
+                                headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.content,
+                         self.upstream.files['/servers.geojson'])
+
+    def test_range(self):
+        body = self.upstream.files['/configs.zip']
+        etag = requests.head(self.server.url('configs.zip')).headers['ETag']
+
+        response = requests.get(
+            self.server.url('configs.zip'),
+            headers={'Range': 'bytes=100-', 'If-Range': etag})
+
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.content, body[100:])
+
+        response = requests.get(
+            self.server.url('configs.zip'),
+            headers={'Range': 'bytes=100-', 'If-Range': '"stale"'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, body)
+
+    def test_reversed_range(self):
+        body = self.upstream.files['/configs.zip']
+        response = requests.get(self.server.url('configs.zip'),
+                                headers={'Range': 'bytes=100-50'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Content-Range', response.headers)
+        self.assertEqual(response.content, body)
+
+    def test_coalesced(self):
+        """Requests made while upstream is being asked wait for it."""
+        self.server.mirror = _GatedMirror(
+            {'configs.zip': self.upstream.url('/configs.zip')},
+            os.path.join(self.working_dir, 'gated'))
+        del self.upstream.requests[:]
+        responses = []
+        threads = [threading.Thread(target=lambda: responses.append(
+            requests.get(self.server.url('configs.zip'))))
+            for _ in range(10)]
+
+        for thread in threads:
+            thread.start()
+
+        time.sleep(0.2)
+        self.server.mirror.gate.set()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(self._upstreamRequests('/configs.zip')), 1)
+        self.assertEqual([r.status_code for r in responses], [200] * 10)
+
+    def test_revalidates(self):
+        self.mirror = self._mirror(timeout=0)
+        self.server.mirror = self.mirror
+        first = requests.get(self.server.url('configs.zip'))
+        second = requests.get(self.server.url('configs.zip'))
+
+        self.assertEqual(first.headers['ETag'], second.headers['ETag'])
+        self.assertIn('If-None-Match',
+                      self._upstreamRequests('/configs.zip')[-1])
+
+        self.upstream.files['/configs.zip'] = synthetic_zip(
+            dict(list(self.files.items())[:5]))
+        third = requests.get(self.server.url('configs.zip'))
+
+        self.assertNotEqual(third.headers['ETag'], first.headers['ETag'])
+        self.assertEqual(third.content, self.upstream.files['/configs.zip'])
+
+    def test_upstream_down(self):
+        """The last copy is served while upstream can't be reached."""
+        body = requests.get(self.server.url('configs.zip')).content
+        self.upstream.files.clear()
+        self.mirror.refresh('configs.zip', force=True)
+
+        self.assertEqual(requests.get(self.server.url('configs.zip')).content,
+                         body)
+
+        empty = Mirror({'configs.zip': self.upstream.url('/configs.zip')},
+                       os.path.join(self.working_dir, 'empty'))
+
+        with self.assertRaises(MirrorError):
+            empty.refresh('configs.zip')
+
+    def test_clients(self):
+        """GeoJson and OvpnConfigs download from and revalidate with it."""
+        config = {'mirror.url': self.server.url(),
+                  'geojson.url': 'http://ipvanish.invalid/servers.geojson'}
+        url = mirror.url(config, 'geojson.url')
+        geojson = model.GeoJson(
+            url, os.path.join(self.working_dir, 'servers.geojson'))
+
+        self.assertEqual(url, self.server.url('servers.geojson'))
+        self.assertEqual(len(geojson.servers), 20)
+
+        geojson.update(force=True)
+        configs = model.OvpnConfigs(
+            self.server.url('configs.zip'),
+            os.path.join(self.working_dir, 'configs'))
+
+        self.assertEqual(configs.update()['added'], len(self.files))
+        self.assertEqual(
+            len(self._upstreamRequests('/servers.geojson')), 1)
+        self.assertEqual(len(self._upstreamRequests('/configs.zip')), 1)
@@ -1,11 +1,15 @@
 import unittest
+import json
 import tempfile
 import shutil
 import os
 import sys
+import threading
 import time
 from io import StringIO
-from .. import model, utils
+from .. import model, snapshot, utils
+from .support import (LocalServer, synthetic_configs, synthetic_features,
+                      synthetic_geojson, synthetic_zip)
 
 
 class TestGeoJson(unittest.TestCase):
@@ -43,6 +47,189 @@ class TestGeoJson(unittest.TestCase):
             )
 
 
+class TestGeoJsonCache(unittest.TestCase):
+    def setUp(self):
+        self.working_dir = tempfile.mkdtemp()
+        self.geojson_file = os.path.join(self.working_dir, 'geojson')
+        self.server = LocalServer({'/servers.geojson': synthetic_geojson(30)})
+        self.server.__enter__()
+
+    def tearDown(self):
+        self.server.__exit__()
+        shutil.rmtree(self.working_dir)
+
+    def _geojson(self, timeout):
+        return model.GeoJson(
+            self.server.url('/servers.geojson'), self.geojson_file, timeout)
+
+    def test_download(self):
+        geojson = self._geojson(0)
+
+        self.assertEqual(len(geojson.servers), 30)
+        self.assertEqual(geojson.servers[0].countryCode, 'UK')
+        self.assertEqual(geojson.servers[0].handle, 'uk-lon-a01')
+        self.assertIn('gzip', self.server.requests[0][1]['Accept-Encoding'])
+
+    def test_fresh_cache(self):
+        geojson = self._geojson(60)
+        geojson.update()
+        self._geojson(60).update()
+
+        self.assertEqual(len(self.server.requests), 1,
+                         "Fresh cache was downloaded again")
+
+        geojson.update(force=True)
+
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_revalidate(self):
+        geojson = self._geojson(0)
+        geojson.servers
+        os.utime(self.geojson_file, (0, 0))
+
+        geojson.update()
+
+        path, headers = self.server.requests[-1]
+        self.assertIn('If-None-Match', headers)
+        self.assertGreater(os.path.getmtime(self.geojson_file), 0,
+                           "Cache wasn't marked fresh after 304")
+        self.assertEqual(len(geojson.servers), 30)
+
+        self.server.files['/servers.geojson'] = synthetic_geojson(40)
+        geojson.update()
+
+        self.assertEqual(len(geojson.servers), 40)
+        self.assertEqual(len(self._geojson(60).servers), 40)
+
+    def test_lazy(self):
+        geojson = self._geojson(0)
+
+        self.assertEqual(self.server.requests, [])
+        self.assertEqual(len(geojson.servers), 30)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_single_flight(self):
+        geojson = self._geojson(0)
+        threads = [threading.Thread(target=lambda: geojson.servers)
+                   for _ in range(8)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(self.server.requests), 1,
+                         "Concurrent loads downloaded more than once")
+
+    def test_subscribe(self):
+        geojson = self._geojson(0)
+        container = model.ServerContainer(geojson)
+
+        self.server.files['/servers.geojson'] = synthetic_geojson(40)
+        geojson.update()
+
+        self.assertEqual(len(container.getServers()), 40)
+
+    def test_indexed_once(self):
+        indexed = []
+
+        class Container(model.ServerContainer):
+            def _index(self, servers):
+                indexed.append(len(servers))
+                super(Container, self)._index(servers)
+
+        Container(self._geojson(0))
+        Container(self._geojson(0))
+
+        self.assertEqual(indexed, [30, 30])
+
+    def test_forced_update_not_coalesced(self):
+        # Seed the cache first so only the unforced update is held.
+        self._geojson(60).servers
+        entered = threading.Event()
+        gate = threading.Event()
+
+        class GeoJson(model.GeoJson):
+            def _update(self, force):
+                if not force:
+                    entered.set()
+                    gate.wait(5)
+
+                return super(GeoJson, self)._update(force)
+
+        geojson = GeoJson(
+            self.server.url('/servers.geojson'), self.geojson_file, 60)
+        background = threading.Thread(target=geojson.update)
+        background.start()
+
+        try:
+            self.assertTrue(entered.wait(5))
+            geojson.update(force=True)
+
+            self.assertEqual(len(self.server.requests), 2,
+                             "Forced update joined an unforced one")
+        finally:
+            gate.set()
+            background.join()
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.working_dir = tempfile.mkdtemp()
+        self.snapshot_file = os.path.join(self.working_dir, 'snapshot')
+        self.servers = [model.Server.fromFeature(f)
+                        for f in synthetic_features(100)]
+        self.servers[0].latitude = self.servers[0].longitude = None
+
+    def tearDown(self):
+        shutil.rmtree(self.working_dir)
+
+    def test_round_trip(self):
+        snapshot.dump(self.servers, self.snapshot_file)
+
+        for use_mmap in (True, False):
+            servers = snapshot.load(self.snapshot_file, use_mmap)
+
+            self.assertEqual([s.toDict() for s in servers],
+                             [s.toDict() for s in self.servers])
+
+    def test_invalid(self):
+        snapshot.dump(self.servers, self.snapshot_file)
+
+        with open(self.snapshot_file, 'r+b') as h:
+            h.seek(4)
+            h.write(b'\xff')
+
+        with self.assertRaises(snapshot.SnapshotError):
+            snapshot.load(self.snapshot_file)
+
+        with open(self.snapshot_file, 'wb') as h:
+            h.write(b'VNSH')
+
+        with self.assertRaises(snapshot.SnapshotError):
+            snapshot.load(self.snapshot_file)
+
+    def test_geojson_fallback(self):
+        geojson_file = os.path.join(self.working_dir, 'geojson')
+
+        with LocalServer({'/g': synthetic_geojson(20)}) as server:
+            model.GeoJson(server.url('/g'), geojson_file, 0,
+                          self.snapshot_file).update()
+
+        self.assertTrue(os.path.exists(self.snapshot_file))
+
+        with open(self.snapshot_file, 'wb') as h:
+            h.write(b'not a snapshot')
+
+        os.utime(geojson_file, (0, 0))
+        geojson = model.GeoJson(None, geojson_file, 60, self.snapshot_file)
+
+        self.assertEqual(len(geojson.servers), 20)
+        self.assertEqual(len(snapshot.load(self.snapshot_file)), 20,
+                         "Snapshot wasn't rewritten from the cache")
+
+
 class TestOvpnConfig(unittest.TestCase):
     def setUp(self):
         self.working_dir = tempfile.mkdtemp()
@@ -64,6 +251,286 @@ class TestOvpnConfig(unittest.TestCase):
         self.assertGreater(len(os.listdir(self.config_path)),
                            0, "No files unzipped")
 
-# TODO: Write tests for ServerContainer onece it's refactored.
-# Intention is to rework it so it does have to worry about exact geojson format
-# and instead has it's own expected format.
+
+class TestOvpnConfigSync(unittest.TestCase):
+    def setUp(self):
+        self.working_dir = tempfile.mkdtemp()
+        self.config_path = os.path.join(self.working_dir, 'ovpn')
+        self.files = synthetic_configs(synthetic_features(12))
+        self.server = LocalServer({'/configs.zip': synthetic_zip(self.files)})
+        self.server.__enter__()
+        self.ovpn = model.OvpnConfigs(
+            self.server.url('/configs.zip'), self.config_path)
+
+    def tearDown(self):
+        self.server.__exit__()
+        shutil.rmtree(self.working_dir)
+
+    def _path(self, name):
+        return os.path.join(self.config_path, name)
+
+    def test_initial_sync(self):
+        stats = self.ovpn.update()
+
+        self.assertEqual(stats['added'], 13)
+        self.assertTrue(os.path.exists(self._path('uk-lon-a01.ovpn')))
+        self.assertTrue(os.path.exists(self._path('ca.ipvanish.com.crt')))
+
+    def test_incremental_sync(self):
+        self.ovpn.update()
+
+        del self.files['ipvanish-UK-London-lon-a01.ovpn']
+        self.files['ipvanish-DE-Frankfurt-fra-a01.ovpn'] += b'# changed\n'
+        self.files['ipvanish-FR-Paris-par-a09.ovpn'] = b'remote par-a09\n'
+        self.server.files['/configs.zip'] = synthetic_zip(self.files)
+
+        inode = os.stat(self._path('uk-man-a01.ovpn')).st_ino
+        stats = self.ovpn.update()
+
+        self.assertEqual(stats, {'added': 1, 'changed': 1, 'removed': 1,
+                                 'unchanged': 11})
+        self.assertFalse(os.path.exists(self._path('uk-lon-a01.ovpn')))
+        self.assertTrue(os.path.exists(self._path('fr-par-a09.ovpn')))
+        self.assertEqual(os.stat(self._path('uk-man-a01.ovpn')).st_ino,
+                         inode, "Unchanged config was rewritten")
+
+        with open(self._path('de-fra-a01.ovpn'), 'rb') as h:
+            self.assertTrue(h.read().endswith(b'# changed\n'))
+
+    def test_legacy_configs(self):
+        self.ovpn.update()
+        os.remove(self._path(model.OvpnConfigs.MANIFEST))
+
+        stats = self.ovpn.update()
+
+        self.assertEqual(stats['unchanged'], 13)
+
+    def _largeArchive(self):
+        # Responses are written to disk in chunks so make sure some complete
+        # chunks arrive before the connection drops.
+        chunk = model.OvpnConfigs.CHUNK_SIZE
+        self.files['padding.bin'] = os.urandom(4 * chunk)
+        archive = synthetic_zip(self.files)
+        self.server.files['/configs.zip'] = archive
+
+        return archive
+
+    def _resumedFrom(self):
+        range = self.server.requests[-1][1]['Range']
+        return int(range[len('bytes='):-1])
+
+    def test_resume(self):
+        archive = self._largeArchive()
+        self.server.truncate['/configs.zip'] = len(archive) // 2
+        ovpn = model.OvpnConfigs(
+            self.server.url('/configs.zip'), self.config_path, retries=1)
+        progress = []
+
+        stats = ovpn.update(lambda done, total: progress.append(done))
+
+        self.assertEqual(stats['added'], 14)
+        self.assertGreater(self._resumedFrom(), 0)
+        self.assertEqual(progress[-1], len(archive))
+        self.assertFalse(os.path.exists(self.config_path + '.zip.part'))
+
+    def test_resume_next_sync(self):
+        archive = self._largeArchive()
+        self.server.truncate['/configs.zip'] = len(archive) - 100
+
+        with self.assertRaises(Exception):
+            self.ovpn.update()
+
+        partial = os.path.getsize(self.config_path + '.zip.part')
+        self.assertGreater(partial, 0)
+
+        self.ovpn.update()
+
+        self.assertEqual(self._resumedFrom(), partial)
+        self.assertEqual(len(os.listdir(self.config_path)), 15)
+
+    def test_max_size(self):
+        ovpn = model.OvpnConfigs(
+            self.server.url('/configs.zip'), self.config_path, max_size=100)
+
+        with self.assertRaises(model.DownloadError):
+            ovpn.update()
+
+        self.assertFalse(os.path.exists(self.config_path))
+        self.assertFalse(os.path.exists(self.config_path + '.zip.part'))
+
+    def test_failed_download(self):
+        self.ovpn.update()
+        del self.server.files['/configs.zip']
+
+        with self.assertRaises(Exception):
+            self.ovpn.update()
+
+        self.assertEqual(len(os.listdir(self.config_path)), 14)
+        self.assertFalse(os.path.exists(self.config_path + '.staging'))
+
+
+class TestOvpnConfigTemplates(unittest.TestCase):
+    def setUp(self):
+        self.working_dir = tempfile.mkdtemp()
+        self.config_path = os.path.join(self.working_dir, 'ovpn')
+        self.files = synthetic_configs(synthetic_features(12))
+        self.server = LocalServer({'/configs.zip': synthetic_zip(self.files)})
+        self.server.__enter__()
+
+    def tearDown(self):
+        self.server.__exit__()
+        shutil.rmtree(self.working_dir)
+
+    def _configs(self, mode):
+        return model.OvpnConfigs(
+            self.server.url('/configs.zip'),
+            self.config_path,
+            mode=mode,
+            render_dir=self.working_dir)
+
+    def test_sync(self):
+        self._configs('templates').update()
+
+        self.assertEqual(
+            sorted(os.listdir(self.config_path)),
+            sorted([model.OvpnConfigs.MANIFEST, model.OvpnConfigs.TEMPLATES,
+                    'ca.ipvanish.com.crt']))
+
+        with open(os.path.join(self.config_path,
+                               model.OvpnConfigs.TEMPLATES)) as h:
+            self.assertEqual(len(json.load(h)['templates']), 1)
+
+    def test_render(self):
+        configs = self._configs('templates')
+        configs.update()
+
+        with configs.config('uk-lon-a01.ovpn') as path:
+            with open(path, 'rb') as h:
+                self.assertEqual(
+                    h.read(), self.files['ipvanish-UK-London-lon-a01.ovpn'])
+
+        self.assertFalse(os.path.exists(path), "Rendered config left behind")
+
+        with self.assertRaises(FileNotFoundError):
+            with configs.config('zz-nowhere-a01.ovpn'):
+                pass
+
+    def test_files(self):
+        configs = self._configs('files')
+        configs.update()
+
+        with configs.config('uk-lon-a01.ovpn') as path:
+            self.assertEqual(
+                path, os.path.join(self.config_path, 'uk-lon-a01.ovpn'))
+
+    def test_switch_mode(self):
+        self._configs('files').update()
+        stats = self._configs('templates').update()
+
+        self.assertEqual(stats['added'], 1)
+        self.assertEqual(stats['removed'], 12)
+        self.assertEqual(len(os.listdir(self.config_path)), 3)
+
+
+class TestServer(unittest.TestCase):
+    def test_derived_fields(self):
+        server = model.Server(
+            countryCode='UK', hostname='lon-a01.ipvanish.com')
+
+        self.assertEqual(server.name, 'lon-a01')
+        self.assertEqual(server.handle, 'uk-lon-a01')
+        self.assertEqual(server.ovpnFile, 'uk-lon-a01.ovpn')
+        self.assertIsNone(server.rtt)
+
+    def test_round_trip(self):
+        feature = synthetic_features(1)[0]
+        properties = dict(feature['properties'])
+        properties['longitude'], properties['latitude'] = \
+            feature['geometry']['coordinates']
+        server = model.Server.fromFeature(feature)
+
+        self.assertEqual(
+            server.toDict(),
+            {f: properties[f] for f in model.Server.FIELDS})
+        self.assertEqual(model.Server.fromDict(server.toDict()).toDict(),
+                         server.toDict())
+
+    def test_no_coordinates(self):
+        server = model.Server.fromFeature(
+            {'properties': {'hostname': 'lon-a01.ipvanish.com'}})
+
+        self.assertIsNone(server.latitude)
+        self.assertIsNone(server.longitude)
+
+    def test_interned(self):
+        a = model.Server(country=''.join(['Ger', 'many']))
+        b = model.Server(country=''.join(['Germ', 'any']))
+
+        self.assertIs(a.country, b.country)
+
+
+class TestServerContainer(unittest.TestCase):
+    class _GeoJson(object):
+        def __init__(self, servers):
+            self.servers = servers
+
+        def subscribe(self, callback):
+            pass
+
+    def setUp(self):
+        servers = [model.Server.fromFeature(f)
+                   for f in synthetic_features(60)]
+        self.container = model.ServerContainer(self._GeoJson(servers))
+
+    def test_all_servers(self):
+        self.assertEqual(len(self.container.getServers()), 60)
+
+    def test_filters(self):
+        servers = self.container.getServers(countries=['gb', 'Germany'])
+
+        self.assertEqual(len(servers), 18)
+        self.assertEqual({s.country for s in servers},
+                         {'United Kingdom', 'Germany'})
+
+        servers = self.container.getServers(
+            continents=['EUROPE'], cities=['manchester'])
+
+        self.assertEqual({s.city for s in servers}, {'Manchester'})
+
+        servers = self.container.getServers(regions=['ny'], countries=['DE'])
+
+        self.assertEqual(servers, [])
+
+    def test_listings(self):
+        self.assertEqual(len(self.container.getContinents()), 5)
+        self.assertEqual(
+            self.container.getCountries(continents=['na']),
+            [('North America', 'United States', 'US'),
+             ('North America', 'Canada', 'CA')])
+        self.assertNotIn(
+            ('France', '', ''), self.container.getRegions())
+        self.assertEqual(
+            self.container.getCities(regions=['England']),
+            [('Europe', 'United Kingdom', 'London'),
+             ('Europe', 'United Kingdom', 'Manchester')])
+
+    def test_nearest(self):
+        servers = self.container.getNearest(51.5, -0.1, 6)
+
+        self.assertEqual({s.city for s in servers}, {'London'})
+
+        servers = self.container.getNearest(51.5, -0.1, 30)
+
+        self.assertEqual([s.city for s in servers[::6]],
+                         ['London', 'Manchester', 'Paris', 'Frankfurt',
+                          'New York'])
+
+    def test_nearest_filtered(self):
+        servers = self.container.getNearest(51.5, -0.1, 3, countries=['us'])
+
+        self.assertEqual({s.city for s in servers}, {'New York'})
+
+        servers = self.container.getNearest(
+            -33.9, 151.2, 100, continents=['asia'])
+
+        self.assertEqual(len(servers), 6)
@@ -0,0 +1,102 @@
+import unittest
+import json
+from io import StringIO
+from .. import output, model
+from ..output import Column
+from ..probe import LatencyStats, Prober
+
+COLUMNS = [
+    Column('name', 'Name'),
+    Column('rtt', 'RTT', "{:.1f} ms".format),
+    Column('ip'),
+]
+
+
+class TestWriters(unittest.TestCase):
+    def _write(self, format, records):
+        stream = StringIO()
+
+        with output.writer(format, COLUMNS, stream) as out:
+            for record in records:
+                out.write(record)
+
+        return stream.getvalue()
+
+    def test_table(self):
+        table = self._write('table', [
+            {'name': 'b', 'rtt': None, 'ip': '10.0.0.2'},
+            {'name': 'a', 'rtt': 12.25, 'ip': '10.0.0.1'}])
+        lines = [line for line in table.splitlines()
+                 if line.startswith('│')]
+
+        self.assertEqual([[c.strip() for c in line.split('│')[1:-1]]
+                          for line in lines],
+                         [['Name', 'RTT'], ['a', '12.2 ms'], ['b', '-']])
+        self.assertNotIn('10.0.0.1', table)
+
+    def test_json(self):
+        records = [{'name': 'a', 'rtt': 12.25, 'ip': '10.0.0.1'},
+                   {'name': 'b', 'rtt': None, 'ip': '10.0.0.2'}]
+
+        self.assertEqual(json.loads(self._write('json', records)), records)
+        self.assertEqual(json.loads(self._write('json', [])), [])
+        self.assertEqual(
+            [json.loads(line)
+             for line in self._write('jsonl', records).split('\n')
+             if line],
+            records)
+
+    def test_delimited(self):
+        records = [{'name': 'a, b', 'rtt': 12.25, 'ip': '10.0.0.1'},
+                   {'name': 'c', 'rtt': None}]
+
+        self.assertEqual(self._write('csv', records),
+                         'name,rtt,ip\n"a, b",12.25,10.0.0.1\nc,,\n')
+        self.assertEqual(self._write('tsv', records),
+                         'name\trtt\tip\na, b\t12.25\t10.0.0.1\nc\t\t\n')
+
+    def test_interrupted(self):
+        """Machine readable output is still well formed if cut short."""
+        stream = StringIO()
+
+        with self.assertRaises(KeyboardInterrupt):
+            with output.writer('json', COLUMNS, stream) as out:
+                out.write({'name': 'a'})
+                raise KeyboardInterrupt()
+
+        self.assertEqual(json.loads(stream.getvalue()),
+                         [{'name': 'a', 'rtt': None, 'ip': None}])
+
+
+class _StepProber(Prober):
+    """Records when each address is probed."""
+
+    def __init__(self, steps):
+        super(_StepProber, self).__init__()
+        self.steps = steps
+
+    def iprobe(self, addresses, count=1):
+        for address in addresses:
+            self.steps.append(address)
+            yield address, LatencyStats([10.0] * count)
+
+
+class TestStreaming(unittest.TestCase):
+    def test_rows_written_as_probes_complete(self):
+        servers = [model.Server(ip='10.0.0.1', hostname='a'),
+                   model.Server(ip='10.0.0.2', hostname='b'),
+                   model.Server(ip='10.0.0.1', hostname='c')]
+        steps = []
+        stream = StringIO()
+        written = []
+
+        with output.writer('jsonl', [Column('hostname')], stream) as out:
+            for server in model.Vanish.iping(servers, _StepProber(steps)):
+                out.write({'hostname': server.hostname})
+                written.append((len(steps), stream.getvalue().count('\n')))
+
+        # Servers sharing an address are probed once and each row is out
+        # before the next probe starts.
+        self.assertEqual(steps, ['10.0.0.1', '10.0.0.2'])
+        self.assertEqual(written, [(1, 1), (1, 2), (2, 3)])
+        self.assertEqual(servers[2].latency.samples, [10.0])
@@ -0,0 +1,126 @@
+import unittest
+import tempfile
+import shutil
+import time
+from .. import probe, model
+from .support import fake_executable, prepend_path, FAKE_PING
+
+
+class TestSubprocessProber(unittest.TestCase):
+    def setUp(self):
+        self.working_dir = tempfile.mkdtemp()
+        fake_executable(self.working_dir, 'ping', FAKE_PING)
+
+    def tearDown(self):
+        shutil.rmtree(self.working_dir)
+
+    def test_probe(self):
+        prober = probe.SubprocessProber(timeout=1, concurrency=4)
+
+        with prepend_path(self.working_dir):
+            results = prober.probe(['10.0.0.1', '192.0.2.1'])
+
+        self.assertEqual(results['10.0.0.1'].samples, [11.0])
+        self.assertEqual(results['192.0.2.1'].samples, [None])
+
+    def test_samples(self):
+        prober = probe.SubprocessProber(timeout=1, concurrency=4)
+
+        with prepend_path(self.working_dir):
+            results = prober.probe(['10.0.0.1', '198.51.100.1'], count=4)
+
+        self.assertEqual(results['10.0.0.1'].samples, [11, 12, 13, 14])
+        self.assertEqual(results['198.51.100.1'].received, 2)
+        self.assertEqual(results['198.51.100.1'].loss, 0.5)
+
+    def test_concurrency(self):
+        prober = probe.SubprocessProber(timeout=1, concurrency=20)
+        addresses = ['10.0.0.{}'.format(i) for i in range(20)]
+
+        start = time.time()
+
+        with prepend_path(self.working_dir):
+            results = prober.probe(addresses)
+
+        self.assertLess(time.time() - start, 2,
+                        "Probes did not run concurrently")
+        self.assertEqual(sorted(results), sorted(addresses))
+
+    def test_ping_servers(self):
+        servers = [
+            model.Server(ip='10.0.0.1', hostname='a.ipvanish.com'),
+            model.Server(ip='192.0.2.1', hostname='b.ipvanish.com')
+        ]
+
+        with prepend_path(self.working_dir):
+            servers = model.Vanish.ping(
+                servers, probe.SubprocessProber(concurrency=2))
+
+        self.assertEqual(servers[0].rtt, 11.0)
+        self.assertIsNone(servers[1].rtt)
+        self.assertEqual(servers[1].latency.loss, 1.0)
+
+
+class TestLatencyStats(unittest.TestCase):
+    def test_statistics(self):
+        stats = probe.LatencyStats([10.0, None, 30.0, 20.0, None])
+
+        self.assertEqual(stats.sent, 5)
+        self.assertEqual(stats.received, 3)
+        self.assertAlmostEqual(stats.loss, 0.4)
+        self.assertEqual(stats.minimum, 10.0)
+        self.assertEqual(stats.median, 20.0)
+        self.assertEqual(stats.p95, 30.0)
+        self.assertEqual(stats.jitter, 15.0)
+
+    def test_no_replies(self):
+        stats = probe.LatencyStats([None, None])
+
+        self.assertIsNone(stats.median)
+        self.assertEqual(stats.loss, 1.0)
+        self.assertEqual(stats.score, float('inf'))
+
+    def test_score_penalises_loss(self):
+        steady = probe.LatencyStats([20.0, 20.0, 20.0, 20.0])
+        lossy = probe.LatencyStats([15.0, None, 15.0, None])
+
+        self.assertLess(steady.score, lossy.score)
+
+
+class TestIcmpProber(unittest.TestCase):
+    def setUp(self):
+        try:
+            probe.IcmpProber()._socket()[0].close()
+        except OSError:
+            self.skipTest("ICMP sockets are not available")
+
+    def test_probe_localhost(self):
+        prober = probe.IcmpProber(timeout=1)
+
+        results = prober.probe(['127.0.0.1', '127.0.0.2'], count=3)
+
+        self.assertEqual(sorted(results), ['127.0.0.1', '127.0.0.2'])
+
+        for stats in results.values():
+            self.assertEqual(stats.received, 3)
+            self.assertLess(stats.p95, 1000)
+
+    def test_parse(self):
+        prober = probe.IcmpProber()
+        request = prober._packet(7)
+
+        self.assertEqual(prober._checksum(request), 0, "Bad checksum")
+        self.assertIsNone(prober._parse(request, False),
+                          "Echo request treated as a reply")
+
+        reply = bytes([probe.IcmpProber.ECHO_REPLY]) + request[1:]
+        ip_header = bytes([0x45]) + bytes(19)
+
+        self.assertEqual(prober._parse(reply, False), 7)
+        self.assertEqual(prober._parse(ip_header + reply, True), 7)
+
+        other = probe.IcmpProber()
+        other._identifier = (prober._identifier + 1) & 0xffff
+
+        self.assertIsNone(other._parse(ip_header + reply, True),
+                          "Reply to another process accepted")
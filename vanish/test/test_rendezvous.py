@@ -0,0 +1,61 @@
+import unittest
+import collections
+from .. import rendezvous, model
+
+
+def _servers(capacities):
+    return [model.Server(hostname='s{}.ipvanish.com'.format(i), capacity=c)
+            for i, c in enumerate(capacities)]
+
+
+def _assign(nodes, servers):
+    return {n: rendezvous.rank(n, servers)[0].hostname for n in nodes}
+
+
+class TestRendezvous(unittest.TestCase):
+    NODES = ['node-{}'.format(i) for i in range(2000)]
+
+    def test_deterministic(self):
+        servers = _servers([50] * 10)
+        first = rendezvous.rank('node-1', servers)
+
+        self.assertEqual(rendezvous.rank('node-1', list(reversed(servers))),
+                         first)
+        self.assertEqual(sorted(first, key=lambda s: s.hostname), servers)
+        self.assertNotEqual(rendezvous.rank('node-2', servers), first)
+
+    def test_weighted_by_remaining_capacity(self):
+        # Remaining capacity of 75, 50 and 25.
+        servers = _servers([25, 50, 75])
+        counts = collections.Counter(_assign(self.NODES, servers).values())
+        shares = [counts[s.hostname] / len(self.NODES) for s in servers]
+
+        for share, expected in zip(shares, [0.5, 1 / 3, 1 / 6]):
+            self.assertAlmostEqual(share, expected, delta=0.04)
+
+    def test_full_servers(self):
+        servers = _servers([100, 100])
+
+        self.assertEqual(len(set(_assign(self.NODES, servers).values())), 2)
+
+    def test_minimal_movement(self):
+        servers = _servers([50] * 10)
+        before = _assign(self.NODES, servers)
+
+        removed = servers[3].hostname
+        after = _assign(self.NODES, servers[:3] + servers[4:])
+        moved = [n for n in self.NODES if before[n] != after[n]]
+
+        self.assertEqual(moved, [n for n in self.NODES
+                                 if before[n] == removed])
+
+        added = _servers([50] * 11)
+        after = _assign(self.NODES, added)
+        moved = [n for n in self.NODES if before[n] != after[n]]
+
+        self.assertTrue(moved)
+        self.assertTrue(all(after[n] == added[10].hostname for n in moved))
+
+    def test_node_id(self):
+        self.assertEqual(rendezvous.nodeId('rack-7'), 'rack-7')
+        self.assertTrue(rendezvous.nodeId())
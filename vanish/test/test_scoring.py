@@ -0,0 +1,98 @@
+import random
+import unittest
+from .. import scoring
+from ..history import Score
+
+
+class _Server(object):
+    def __init__(self, hostname, capacity):
+        self.hostname = hostname
+        self.capacity = capacity
+
+
+def _score(hostname, rtt, jitter=0.0, loss=0.0):
+    return Score(hostname, rtt, jitter, loss, 0, 1)
+
+
+class TestScorer(unittest.TestCase):
+    BACKEND = 'python'
+
+    def scorer(self, **weights):
+        return scoring.Scorer(weights, self.BACKEND)
+
+    def test_weighted_sum(self):
+        servers = [_Server('a', 50), _Server('b', 10)]
+        latency = {'a': _score('a', 20, 5, 0.1), 'b': _score('b', 80)}
+
+        scores = self.scorer(capacity=1, rtt=2, jitter=1, loss=1).score(
+            servers, latency)
+
+        self.assertAlmostEqual(scores[0], 0.5 + 0.4 + 0.05 + 1)
+        self.assertAlmostEqual(scores[1], 0.1 + 1.6)
+
+    def test_rank(self):
+        servers = [_Server(h, c) for h, c in
+                   [('a', 40), ('b', 10), ('c', 30), ('d', 10)]]
+
+        ranked = self.scorer(capacity=1).rank(servers, k=3)
+
+        self.assertEqual([s.hostname for s, _ in ranked], ['b', 'd', 'c'])
+        self.assertEqual([s for _, s in ranked], [0.1, 0.1, 0.3])
+        self.assertEqual(len(self.scorer(capacity=1).rank(servers)), 4)
+        self.assertEqual(self.scorer(capacity=1).rank(servers, k=0), [])
+
+    def test_unknown_factors_imputed(self):
+        servers = [_Server('a', 0), _Server('b', 0), _Server('c', 0)]
+        latency = {'a': _score('a', 10), 'b': _score('b', 30)}
+
+        scores = self.scorer(rtt=1).score(servers, latency)
+
+        self.assertAlmostEqual(scores[2], 0.2,
+                               msg="Unprobed server wasn't given the mean")
+        self.assertEqual(self.scorer(rtt=1).score(servers), [0.0] * 3)
+
+    def test_distance(self):
+        servers = [_Server('a', 20), _Server('b', 10)]
+        scorer = self.scorer(capacity=1, distance=1)
+
+        self.assertEqual(scorer.rank(servers)[0][0].hostname, 'b')
+        self.assertEqual(scorer.rank(servers, distances=[100, 500])[0][0]
+                         .hostname, 'a')
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            scoring.Scorer({'speed': 1})
+
+        with self.assertRaises(ValueError):
+            scoring.Scorer({}, 'fortran')
+
+
+@unittest.skipIf(scoring._numpy() is None, "NumPy is not installed")
+class TestNumpyScorer(TestScorer):
+    BACKEND = 'numpy'
+
+    def test_matches_python(self):
+        generator = random.Random(1)
+        servers = [_Server('s{}'.format(i), generator.randint(0, 100))
+                   for i in range(2000)]
+        latency = {s.hostname: _score(s.hostname,
+                                      generator.uniform(5, 300),
+                                      generator.uniform(0, 20),
+                                      generator.choice([0, 0, 0.25, 1]))
+                   for s in servers if generator.random() < 0.7}
+        distances = [generator.choice([None, generator.uniform(0, 2e4)])
+                     for _ in servers]
+        weights = {'capacity': 1, 'rtt': 2, 'jitter': 0.5, 'loss': 1,
+                   'distance': 0.3}
+
+        python = scoring.Scorer(weights, 'python')
+        numpy = scoring.Scorer(weights, 'numpy')
+
+        for expected, actual in zip(
+                python.score(servers, latency, distances),
+                numpy.score(servers, latency, distances)):
+            self.assertAlmostEqual(expected, actual)
+
+        self.assertEqual(
+            [s.hostname for s, _ in python.rank(servers, latency, k=50)],
+            [s.hostname for s, _ in numpy.rank(servers, latency, k=50)])
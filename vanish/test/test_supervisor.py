@@ -0,0 +1,198 @@
+import unittest
+import contextlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from io import StringIO
+from .. import supervisor
+from .support import FAKE_OPENVPN, OVPN_TEMPLATE, fake_executable
+
+
+class _Server(object):
+    def __init__(self, hostname):
+        self.hostname = hostname
+
+
+class TestSupervisor(unittest.TestCase):
+    def setUp(self):
+        self.working_dir = tempfile.mkdtemp()
+        self.log = os.path.join(self.working_dir, 'log')
+        self.openvpn = fake_executable(
+            self.working_dir, 'openvpn', FAKE_OPENVPN)
+        os.environ['FAKE_OPENVPN_LOG'] = self.log
+        sys.stdout = StringIO()
+
+    def tearDown(self):
+        sys.stdout = sys.__stdout__
+        del os.environ['FAKE_OPENVPN_LOG']
+        os.environ.pop('FAKE_OPENVPN', None)
+        shutil.rmtree(self.working_dir)
+
+    def _behave(self, **behaviours):
+        os.environ['FAKE_OPENVPN'] = json.dumps(behaviours)
+
+    def _events(self):
+        with open(self.log) as h:
+            return [tuple(line.split()) for line in h]
+
+    @contextlib.contextmanager
+    def _launch(self, server):
+        path = os.path.join(self.working_dir, server.hostname + '.ovpn')
+
+        with open(path, 'w') as h:
+            h.write(OVPN_TEMPLATE.format(hostname=server.hostname))
+
+        tunnel = supervisor.Tunnel(
+            server.hostname, path, 'ca.crt',
+            os.path.join(self.working_dir, server.hostname + '.sock'),
+            openvpn=self.openvpn, bytecount=1)
+
+        try:
+            tunnel.start()
+            yield tunnel
+        finally:
+            tunnel.stop()
+
+    def _supervisor(self, hostnames, **kwargs):
+        return supervisor.Supervisor(
+            [_Server(h) for h in hostnames], self._launch, **kwargs)
+
+    def _stopWhenConnected(self, supervisor, hostname, timeout=10):
+        def stop():
+            deadline = time.monotonic() + timeout
+
+            while time.monotonic() < deadline:
+                tunnel = supervisor.tunnel
+
+                if tunnel and tunnel.name == hostname and tunnel.connected:
+                    break
+
+                time.sleep(0.05)
+
+            supervisor.stop()
+
+        thread = threading.Thread(target=stop)
+        thread.start()
+
+        return thread
+
+    def test_tunnel(self):
+        with self._launch(_Server('a')) as tunnel:
+            deadline = time.monotonic() + 10
+
+            while tunnel.bytesIn == 0 and time.monotonic() < deadline:
+                tunnel.wait(0.5)
+
+            self.assertTrue(tunnel.connected)
+            self.assertGreater(tunnel.bytesIn, 0)
+
+        self.assertEqual(tunnel.returncode, 0)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.working_dir, 'a.sock')))
+        self.assertEqual(self._events()[-1], ('a', 'stopped'))
+
+    def test_failover(self):
+        self._behave(a='fail', b='drop:0.5')
+        s = self._supervisor(['a', 'b', 'c'])
+        stopper = self._stopWhenConnected(s, 'c')
+
+        s.run()
+        stopper.join()
+
+        self.assertEqual(self._events(), [
+            ('a', 'started'), ('a', 'failed'),
+            ('b', 'started'), ('b', 'connected'), ('b', 'dropped'),
+            ('b', 'stopped'),
+            ('c', 'started'), ('c', 'connected'), ('c', 'stopped')
+        ])
+
+    def test_connect_timeout(self):
+        self._behave(a='hang')
+        s = self._supervisor(['a', 'b'], connect_timeout=1)
+        stopper = self._stopWhenConnected(s, 'b')
+
+        s.run()
+        stopper.join()
+
+        self.assertIn('a: timed out connecting', sys.stdout.getvalue())
+        self.assertIn(('b', 'connected'), self._events())
+
+    def test_stall(self):
+        self._behave(a='stall')
+        s = self._supervisor(['a', 'b'], stall_timeout=1.5)
+        stopper = self._stopWhenConnected(s, 'b')
+
+        s.run()
+        stopper.join()
+
+        self.assertIn('a: no traffic', sys.stdout.getvalue())
+
+    def test_exhausted(self):
+        self._behave(a='fail', b='fail')
+
+        with self.assertRaises(supervisor.TunnelError):
+            self._supervisor(['a', 'b']).run()
+
+    def test_missing_openvpn(self):
+        self.openvpn = os.path.join(self.working_dir, 'missing')
+
+        with self.assertRaises(supervisor.TunnelError):
+            self._supervisor(['a']).run()
+
+    def test_race(self):
+        self._behave(a='delay:5')
+        s = self._supervisor(['a', 'b', 'c'], race=3, stagger=0.3)
+        stopper = self._stopWhenConnected(s, 'b')
+
+        s.run()
+        stopper.join()
+
+        events = self._events()
+
+        self.assertIn(('b', 'connected'), events)
+        self.assertNotIn(('a', 'connected'), events)
+        self.assertIn(('a', 'stopped'), events)
+        self.assertLess(events.index(('a', 'stopped')),
+                        events.index(('b', 'stopped')),
+                        "Losing tunnel wasn't torn down once b connected")
+
+    def test_race_failure_starts_next(self):
+        self._behave(a='fail')
+        s = self._supervisor(['a', 'b'], race=2, stagger=30)
+        stopper = self._stopWhenConnected(s, 'b')
+        started = time.monotonic()
+
+        s.run()
+        stopper.join()
+
+        self.assertLess(time.monotonic() - started, 10,
+                        "Waited out the stagger after a failure")
+        self.assertIn(('b', 'connected'), self._events())
+
+    def test_race_failure_refills(self):
+        """A failed racer is replaced while the others are still racing."""
+        self._behave(a='fail', b='hang')
+        s = self._supervisor(['a', 'b', 'c'], race=2, stagger=0,
+                             connect_timeout=8)
+        stopper = self._stopWhenConnected(s, 'c')
+        started = time.monotonic()
+
+        s.run()
+        stopper.join()
+
+        self.assertLess(time.monotonic() - started, 8,
+                        "c only started once b timed out")
+        self.assertIn(('c', 'connected'), self._events())
+        self.assertNotIn('b: timed out connecting', sys.stdout.getvalue())
+
+    def test_no_failover(self):
+        self._behave(a='drop:0.5')
+
+        self._supervisor(['a', 'b'], failover=False).run()
+
+        self.assertNotIn(('b', 'started'), self._events())
+        self.assertIn('a: connection dropped', sys.stdout.getvalue())
@@ -0,0 +1,108 @@
+import unittest
+import json
+import os
+import pstats
+import shutil
+import tempfile
+import threading
+from .. import application, trace
+
+
+class TestTrace(unittest.TestCase):
+    def test_disabled(self):
+        with trace.span('phase', value=1) as span:
+            span.set(other=2)
+
+        self.assertIsNone(trace._tracer)
+
+    def test_nesting(self):
+        with trace.tracing() as tracer:
+            with trace.span('outer'):
+                with trace.span('inner', servers=10) as inner:
+                    inner.set(received=9)
+
+                with trace.span('second'):
+                    pass
+
+        spans = {s.name: s for s in tracer.spans}
+
+        self.assertEqual(len(spans), 3)
+        self.assertIsNone(spans['outer'].parent)
+        self.assertEqual(spans['inner'].parent, spans['outer'].id)
+        self.assertEqual(spans['second'].parent, spans['outer'].id)
+        self.assertEqual(spans['inner'].attributes,
+                         {'servers': 10, 'received': 9})
+        self.assertGreaterEqual(spans['outer'].duration,
+                                spans['inner'].duration)
+        self.assertIsNone(trace._tracer, "Tracer left active")
+
+    def test_threads(self):
+        with trace.tracing() as tracer:
+            with trace.span('outer'):
+                thread = threading.Thread(
+                    target=lambda: trace.span('worker').__enter__()
+                    .__exit__())
+                thread.start()
+                thread.join()
+
+        worker = [s for s in tracer.spans if s.name == 'worker'][0]
+
+        self.assertIsNone(worker.parent,
+                          "Span parented to another thread's span")
+
+    def test_breakdown(self):
+        with trace.tracing() as tracer:
+            with trace.span('connect'):
+                with trace.span('geojson.update'):
+                    pass
+
+        lines = tracer.breakdown().splitlines()
+
+        self.assertTrue(lines[0].startswith('connect '))
+        self.assertTrue(lines[0].endswith('100.0%'))
+        self.assertTrue(lines[1].startswith('  geojson.update '))
+
+    def test_json(self):
+        with trace.tracing() as tracer:
+            with trace.span('connect', country='de'):
+                pass
+
+        spans = json.loads(tracer.toJson())
+
+        self.assertEqual(spans[0]['name'], 'connect')
+        self.assertEqual(spans[0]['attributes'], {'country': 'de'})
+        self.assertIn('duration_ms', spans[0])
+
+
+class TestProfileFlag(unittest.TestCase):
+    def setUp(self):
+        self.working_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.working_dir)
+
+    def test_breakdown(self):
+        with self.assertLogs('vanish') as logs:
+            application.Vanish().run(['--profile', 'version'])
+
+        self.assertTrue(logs.output[0].endswith('100.0%'))
+        self.assertIn('version', logs.output[0])
+
+    def test_json(self):
+        with self.assertLogs('vanish') as logs:
+            application.Vanish().run(
+                ['--profile', '--profile-format', 'json', 'version'])
+
+        spans = json.loads(logs.records[0].msg)
+
+        self.assertEqual(spans[0]['name'], 'version')
+
+    def test_cprofile(self):
+        path = os.path.join(self.working_dir, 'profile')
+
+        with self.assertNoLogs('vanish'):
+            application.Vanish().run(
+                ['--profile-dump', path, '--profile-format', 'json',
+                 'version'])
+
+        self.assertTrue(pstats.Stats(path).total_calls > 0)
@@ -0,0 +1,181 @@
+import unittest
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from .. import utils
+from .support import synthetic_features
+
+
+class TestJsonArrayItems(unittest.TestCase):
+    def _chunks(self, document, size):
+        return (document[i:i + size] for i in range(0, len(document), size))
+
+    def test_chunk_boundaries(self):
+        features = synthetic_features(5)
+        document = json.dumps(features, indent=2)
+
+        for size in (1, 7, 64, len(document)):
+            items = list(utils.json_array_items(self._chunks(document, size)))
+
+            self.assertEqual(items, features, "Failed with chunk size {}"
+                             .format(size))
+
+    def test_numbers(self):
+        items = utils.json_array_items(self._chunks('[12, 345, 6.5]', 2))
+
+        self.assertEqual(list(items), [12, 345, 6.5])
+
+    def test_empty(self):
+        self.assertEqual(list(utils.json_array_items([' [ ] '])), [])
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            list(utils.json_array_items(['{"a": 1}']))
+
+        with self.assertRaises(ValueError):
+            list(utils.json_array_items(['[{"a": 1}, {"b"']))
+
+    def test_malformed(self):
+        for document in ('[1,,2]', '[1 2]', '[1,]', '[,1]', '[{"a": 1} 2]',
+                         '[tru, 1]', '[1x, 2]'):
+            with self.assertRaises(ValueError, msg=document):
+                list(utils.json_array_items(self._chunks(document, 3)))
+
+    def test_malformed_fails_early(self):
+        """A bad item is reported without reading the rest of the document."""
+        read = []
+
+        def chunks():
+            yield '[1, {"a": tru}, '
+
+            for i in range(10000):
+                read.append(i)
+                yield '{"b": 2}, '
+
+            yield '3]'
+
+        with self.assertRaises(ValueError):
+            list(utils.json_array_items(chunks()))
+
+        self.assertEqual(read, [])
+
+    def test_split_literals(self):
+        items = utils.json_array_items(
+            self._chunks('[true, "a,]\\"", 1e5, null, [1, [2]]]', 1))
+
+        self.assertEqual(list(items), [True, 'a,]"', 1e5, None, [1, [2]]])
+
+
+class TestPersistentCache(unittest.TestCase):
+    def setUp(self):
+        self.working_dir = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.working_dir, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.working_dir)
+
+    def test_persist(self):
+        cache = utils.PersistentCache(self.cache_path)
+        self.assertEqual(cache, {})
+
+        cache['a'] = 1
+        cache.update(b=2)
+        del cache['a']
+
+        self.assertEqual(utils.PersistentCache(self.cache_path), {'b': 2})
+
+    def test_persist_every_mutation(self):
+        cache = utils.PersistentCache(self.cache_path)
+        cache.update(a=1, b=2, c=3)
+
+        self.assertEqual(cache.setdefault('d', 4), 4)
+        self.assertEqual(cache.setdefault('a', 5), 1)
+        self.assertEqual(cache.pop('a'), 1)
+        self.assertEqual(cache.pop('a', None), None)
+        self.assertEqual(utils.PersistentCache(self.cache_path),
+                         {'b': 2, 'c': 3, 'd': 4})
+
+        key, _ = cache.popitem()
+
+        self.assertNotIn(key, utils.PersistentCache(self.cache_path))
+
+        cache.clear()
+
+        self.assertEqual(utils.PersistentCache(self.cache_path), {})
+
+
+class TestServiceProvider(unittest.TestCase):
+    def setUp(self):
+        self.provider = utils.ServiceProvider({
+            'singleton': utils.ServiceProvider.singleton(lambda p: object()),
+            'scoped': utils.ServiceProvider.scoped(lambda p: set())
+        })
+
+    def test_singleton(self):
+        self.assertIs(self.provider['singleton'], self.provider['singleton'])
+
+    def test_scoped(self):
+        with self.provider.scope():
+            first = self.provider['scoped']
+            first.add('geojson')
+
+            with self.provider.scope():
+                self.assertIs(self.provider['scoped'], first)
+
+        with self.provider.scope():
+            self.assertEqual(self.provider['scoped'], set())
+
+    def test_scoped_outside_scope(self):
+        with self.assertRaises(RuntimeError):
+            self.provider['scoped']
+
+
+class TestSingleFlight(unittest.TestCase):
+    def test_coalesce(self):
+        flight = utils.SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def work():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return 'result'
+
+        leader = threading.Thread(
+            target=lambda: results.append(flight.do('key', work)))
+        leader.start()
+        started.wait()
+
+        followers = [
+            threading.Thread(
+                target=lambda: results.append(flight.do('key', work)))
+            for _ in range(4)
+        ]
+
+        for thread in followers:
+            thread.start()
+
+        # Give the followers time to join the call in flight.
+        time.sleep(0.1)
+        release.set()
+
+        for thread in [leader] + followers:
+            thread.join()
+
+        self.assertEqual(results, ['result'] * 5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flight.do('key', lambda: 'again'), 'again')
+
+    def test_error(self):
+        flight = utils.SingleFlight()
+
+        with self.assertRaises(ValueError):
+            flight.do('key', lambda: int('x'))
+
+        self.assertEqual(flight.do('key', lambda: 1), 1)
@@ -0,0 +1,196 @@
+import contextlib
+import itertools
+import json
+import threading
+import time
+"""
+This module times named phases of a command as spans.
+
+Wrap a phase in span() to time it:
+
+    with trace.span('geojson.download', url=url):
+        ...
+
+Spans started while another is open on the same thread are its children.
+Nothing is recorded unless a tracer is active, see tracing(), and a disabled
+span() costs no more than a function call.
+"""
+
+_tracer = None
+
+
+class _NoopSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+
+_NOOP = _NoopSpan()
+
+
+class Span(object):
+    __slots__ = ('id', 'parent', 'name', 'attributes', 'thread', 'start',
+                 'end', '_tracer')
+
+    def __init__(self, tracer, id, name, attributes):
+        self.id = id
+        self.parent = None
+        self.name = name
+        self.attributes = attributes
+        self.thread = None
+        self.start = None
+        self.end = None
+        self._tracer = tracer
+
+    @property
+    def duration(self):
+        """Seconds the span was open for."""
+        return self.end - self.start
+
+    def set(self, **attributes):
+        """Add attributes to the span, e.g. the size of its result."""
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        self._tracer._open(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.end = time.perf_counter()
+        self._tracer._close(self)
+        return False
+
+    def toDict(self, origin=0):
+        return {
+            'id': self.id,
+            'parent': self.parent,
+            'name': self.name,
+            'thread': self.thread,
+            'start_ms': round((self.start - origin) * 1000, 3),
+            'duration_ms': round(self.duration * 1000, 3),
+            'attributes': self.attributes
+        }
+
+
+class Tracer(object):
+    def __init__(self):
+        """Collects the spans finished while it's active."""
+        self.spans = []
+        self.started = time.perf_counter()
+        self._ids = itertools.count(1)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def span(self, name, attributes):
+        return Span(self, next(self._ids), name, attributes)
+
+    def breakdown(self):
+        """Format the spans as an indented tree of timings.
+
+        :return: A string with a line per span giving its duration and its
+            share of the root span it belongs to.
+        """
+        children = {}
+
+        for span in sorted(self.spans, key=lambda s: s.start):
+            children.setdefault(span.parent, []).append(span)
+
+        width = max([self._width(s, children) for s in children.get(None, [])]
+                    or [0])
+        lines = []
+
+        def walk(span, depth, total):
+            label = "  " * depth + span.name
+            lines.append("{:<{}}  {:>10.1f} ms  {:>5.1f}%".format(
+                label, width, span.duration * 1000,
+                100 * span.duration / total if total else 100))
+
+            for child in children.get(span.id, []):
+                walk(child, depth + 1, total)
+
+        for root in children.get(None, []):
+            walk(root, 0, root.duration)
+
+        return "\n".join(lines)
+
+    def toJson(self):
+        """Serialise the spans as a JSON array, ordered by start time."""
+        spans = sorted(self.spans, key=lambda s: s.start)
+        return json.dumps([s.toDict(self.started) for s in spans])
+
+    def _width(self, span, children, depth=0):
+        return max([len(span.name) + 2 * depth] + [
+            self._width(c, children, depth + 1)
+            for c in children.get(span.id, [])])
+
+    def _open(self, span):
+        stack = self._stack()
+        span.parent = stack[-1].id if stack else None
+        span.thread = threading.current_thread().name
+        stack.append(span)
+
+    def _close(self, span):
+        stack = self._stack()
+
+        if stack and stack[-1] is span:
+            stack.pop()
+
+        with self._lock:
+            self.spans.append(span)
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+
+        return self._local.stack
+
+
+def span(name, **attributes):
+    """Time a phase while tracing is active.
+
+    :param name: The name of the phase, e.g. geojson.download.
+    :param attributes: Values to record with the span.
+    :return: A context manager.
+    """
+    tracer = _tracer
+
+    if tracer is None:
+        return _NOOP
+
+    return tracer.span(name, attributes)
+
+
+@contextlib.contextmanager
+def tracing(profile_path=None):
+    """Record spans, and optionally a cProfile, for the enclosed code.
+
+    :param profile_path: Path to dump cProfile statistics to.
+    :return: A context manager yielding the Tracer.
+    """
+    global _tracer
+
+    tracer = _tracer = Tracer()
+    profiler = None
+
+    if profile_path:
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    try:
+        yield tracer
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+
+        _tracer = None
@@ -1,5 +1,8 @@
-import hashlib
+import contextlib
 import json
+import os
+import re
+import threading
 
 
 class ServiceProvider(dict):
@@ -7,15 +10,37 @@ class ServiceProvider(dict):
         def __init__(self, callable):
             self._instance = None
             self._callable = callable
+            self._lock = threading.Lock()
 
         def __call__(self, provider):
             if not self._instance:
-                self._instance = self._callable(provider)
+                # Concurrent first uses wait for a single construction.
+                with self._lock:
+                    if not self._instance:
+                        self._instance = self._callable(provider)
 
             return self._instance
 
+    class _Scoped(object):
+        def __init__(self, callable):
+            self._callable = callable
+            self._local = threading.local()
+
+        def __call__(self, provider):
+            if not provider.inScope():
+                raise RuntimeError("Scoped service used outside of a scope")
+
+            if not hasattr(self._local, 'instance'):
+                self._local.instance = self._callable(provider)
+
+            return self._local.instance
+
+        def reset(self):
+            self._local.__dict__.pop('instance', None)
+
     def __init__(self, *args, **kwargs):
         super(ServiceProvider, self).__init__(*args, **kwargs)
+        self._scope = threading.local()
 
     def __getitem__(self, key):
         return super(ServiceProvider, self).__getitem__(key)(self)
@@ -33,40 +58,286 @@ class ServiceProvider(dict):
     def singleton(callback):
         return ServiceProvider._Singleton(callback)
 
+    @staticmethod
+    def scoped(callback):
+        """A service with one instance per scope, see scope()."""
+        return ServiceProvider._Scoped(callback)
+
+    @contextlib.contextmanager
+    def scope(self):
+        """Scope a single request.
+
+        Scoped services are created once within the scope and discarded when
+        it ends. Scopes are per thread so concurrent requests don't share
+        scoped services.
+        """
+        depth = getattr(self._scope, 'depth', 0)
+        self._scope.depth = depth + 1
+
+        try:
+            yield self
+        finally:
+            self._scope.depth = depth
+
+            if not depth:
+                for service in self.values():
+                    if isinstance(service, ServiceProvider._Scoped):
+                        service.reset()
+
+    def inScope(self):
+        return getattr(self._scope, 'depth', 0) > 0
+
+
+class SingleFlight(object):
+    class _Call(object):
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        """Coalesce concurrent calls doing the same work.
+
+        While a call for a key is in flight any other calls for that key
+        wait for it and share its result instead of repeating the work.
+        """
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, callable):
+        """Call callable unless a call for key is already in flight.
+
+        :param key: Identifies the work callable does.
+        :param callable: Does the work.
+        :return: The result of the call.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+
+            if leader:
+                call = self._calls[key] = self._Call()
+
+        if not leader:
+            call.done.wait()
+
+            if call.error is not None:
+                raise call.error
+
+            return call.result
+
+        try:
+            call.result = callable()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+            call.done.set()
+
+        return call.result
+
 
 class PersistentCache(dict):
 
     def __init__(self, cache_path):
         """A manager for caching arbirary data.
 
+        The cache is written back to cache_path whenever it changes.
+
         :param cache_path: Path to the file we should use for caching.
         """
+        super(PersistentCache, self).__init__()
         self._cache_path = cache_path
 
         try:
             with open(cache_path) as h:
-                self = json.loads(h.read())
-        except IOError() as e:
+                super(PersistentCache, self).update(json.load(h))
+        except FileNotFoundError:
+            pass
+        except (IOError, ValueError) as e:
             print("Could not open cache file {}".format(e))
             raise
 
     def _write(self):
-        with open(self._cache_path, 'w') as h:
+        temp_path = self._cache_path + '.tmp'
+
+        with open(temp_path, 'w') as h:
             h.write(json.dumps(self))
 
-    def __setattr__(self, key, value):
-        super(PersistentCache, self).__setattr__(key, value)
+        os.replace(temp_path, self._cache_path)
+
+    def __setitem__(self, key, value):
+        super(PersistentCache, self).__setitem__(key, value)
+        self._write()
+
+    def __delitem__(self, key):
+        super(PersistentCache, self).__delitem__(key)
+        self._write()
+
+    def update(self, *args, **kwargs):
+        super(PersistentCache, self).update(*args, **kwargs)
         self._write()
 
-    def ___delattr__(self, key):
-        super(PersistentCache, self).__delattr__(key)
+    def setdefault(self, key, default=None):
+        if key in self:
+            return self[key]
+
+        self[key] = default
+        return default
+
+    def pop(self, key, *default):
+        present = key in self
+        value = super(PersistentCache, self).pop(key, *default)
+
+        if present:
+            self._write()
+
+        return value
+
+    def popitem(self):
+        item = super(PersistentCache, self).popitem()
         self._write()
+        return item
+
+    def clear(self):
+        super(PersistentCache, self).clear()
+        self._write()
+
+
+_ITEM_TOKENS = re.compile(r'"(?:[^"\\]|\\.)*"|["\[\]{},]')
+
+
+def _itemComplete(buffer, position):
+    """Whether the array item at position ends within buffer.
+
+    Strings are skipped and brackets counted to find the comma or bracket
+    ending the item, so a malformed item is known to be wrong once it's
+    all been read rather than waiting for more data forever.
+    """
+    depth = 0
+
+    for match in _ITEM_TOKENS.finditer(buffer, position):
+        token = match.group()
+
+        if token == '"':
+            # An unterminated string.
+            return False
+
+        if token[0] == '"':
+            continue
+
+        if token in '[{':
+            depth += 1
+        elif token in ']}':
+            depth -= 1
+
+            if depth < 0:
+                return True
+        elif depth == 0:
+            return True
+
+    return False
 
 
 def sha256_checksum(filename, block_size=65536):
+    import hashlib
+
     sha256 = hashlib.sha256()
     with open(filename, 'rb') as f:
         for block in iter(lambda: f.read(block_size), b''):
             sha256.update(block)
 
     return sha256.hexdigest()
+
+
+def json_array_items(chunks):
+    """Incrementally decode the items of a top level JSON array.
+
+    Only the item currently being decoded is buffered so memory scales with
+    the largest item rather than the whole document.
+
+    :param chunks: An iterable of str chunks of the document.
+    :raises ValueError: If the document isn't an array, is malformed or is
+        truncated.
+    :return: A generator of decoded items.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    # What's expected next: '[', an item or ']' first, an item after a comma
+    # or a comma or ']' after an item.
+    expecting = '['
+
+    for chunk in chunks:
+        buffer = buffer[position:] + chunk
+        position = 0
+
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n':
+                position += 1
+
+            if position == len(buffer):
+                break
+
+            character = buffer[position]
+
+            if expecting == '[':
+                if character != '[':
+                    raise ValueError("Expected a JSON array")
+
+                expecting = 'first'
+                position += 1
+                continue
+
+            if expecting == 'delimiter':
+                if character == ']':
+                    return
+
+                if character != ',':
+                    raise ValueError(
+                        "Expected ',' or ']' at {!r}".format(
+                            buffer[position:position + 20]))
+
+                expecting = 'item'
+                position += 1
+                continue
+
+            if character == ']' and expecting == 'first':
+                return
+
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                if _itemComplete(buffer, position):
+                    raise ValueError("Invalid JSON array item {!r}".format(
+                        buffer[position:position + 20]))
+
+                # The item is incomplete so wait for more data.
+                break
+
+            # An item is only complete once it's followed by a delimiter as
+            # a number may continue in the next chunk.
+            after = end
+
+            while after < len(buffer) and buffer[after] in ' \t\r\n':
+                after += 1
+
+            if after == len(buffer):
+                break
+
+            if buffer[after] not in ',]':
+                # A number may go on in the next chunk, e.g. '1e' to '1e5'.
+                if end == after and not _itemComplete(buffer, position):
+                    break
+
+                raise ValueError("Expected ',' or ']' at {!r}".format(
+                    buffer[after:after + 20]))
+
+            expecting = 'delimiter'
+            position = end
+            yield item
+
+    raise ValueError("Truncated JSON array")